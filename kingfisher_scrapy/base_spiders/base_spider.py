@@ -5,7 +5,8 @@ import scrapy
 
 from kingfisher_scrapy.exceptions import IncoherentConfigurationError, MissingEnvVarError, SpiderArgumentError
 from kingfisher_scrapy.items import File, FileItem
-from kingfisher_scrapy.util import add_path_components, add_query_string
+from kingfisher_scrapy.responses import FileResponse
+from kingfisher_scrapy.util import add_path_components, add_query_string, parse_retry_after
 
 
 class BaseSpider(scrapy.Spider):
@@ -73,6 +74,8 @@ class BaseSpider(scrapy.Spider):
     max_attempts = 5
     retry_http_codes = []
     cloudflare_protected = False
+    # Set by base classes whose ``parse`` method reads a FileResponse from its file.
+    spool_responses = False
 
     # Not to be overridden by sub-classes.
     available_steps = {"compile", "check"}
@@ -91,6 +94,7 @@ class BaseSpider(scrapy.Spider):
         table_name=None,
         force_version=None,
         ignore_version=None,
+        upsert=None,
         package_pointer=None,
         release_pointer=None,
         truncate=None,
@@ -113,6 +117,8 @@ class BaseSpider(scrapy.Spider):
             if ``compile_releases`` is ``'true'``
         :param ignore_version: do not raise an error if the versions are inconsistent across packages to merge,
             if ``compile_releases`` is ``'true'``
+        :param upsert: whether to replace only the rows that changed since the last crawl, instead of all rows, when
+            using the :class:`~kingfisher_scrapy.extensions.database_store.DatabaseStore` extension
         :param package_pointer: the JSON Pointer to the value in the package (see the :ref:`pluck` command)
         :param release_pointer: the JSON Pointer to the value in the release (see the :ref:`pluck` command)
         :param truncate: the number of characters to which the value is truncated (see the :ref:`pluck` command)
@@ -150,6 +156,7 @@ class BaseSpider(scrapy.Spider):
         self.database_store_table_name = table_name
         self.database_store_force_version = force_version
         self.database_store_ignore_version = ignore_version == "true"
+        self.database_store_upsert = upsert == "true"
 
         # Pluck pipeline.
         self.pluck_package_pointer = package_pointer
@@ -208,6 +215,13 @@ class BaseSpider(scrapy.Spider):
         if cls.cloudflare_protected and (user_agent := settings.get("CF_USER_AGENT")):
             settings.set("USER_AGENT", user_agent, priority="spider")
 
+        if cls.spool_responses and settings.getint("KINGFISHER_DOWNLOAD_SPOOL_SIZE"):
+            handlers = settings.getdict("DOWNLOAD_HANDLERS")
+            # Don't replace other handlers, like CurlImpersonateDownloadHandler, which spools response bodies itself.
+            for scheme in ("http", "https"):
+                handlers.setdefault(scheme, "kingfisher_scrapy.downloadhandlers.SpoolingDownloadHandler")
+            settings.set("DOWNLOAD_HANDLERS", handlers, priority="spider")
+
     @classmethod
     def from_crawler(cls, crawler, *args, **kwargs):
         spider = super().from_crawler(crawler, *args, **kwargs)
@@ -288,9 +302,23 @@ class BaseSpider(scrapy.Spider):
         date = self.crawl_time or self.crawler.stats.get_value("start_time")
         return date.strftime(date_format)
 
+    def accepts_file_response(self, request):
+        """
+        Return whether the request's callback reads a :class:`~kingfisher_scrapy.responses.FileResponse` from its file.
+
+        If not, download handlers hold the response body in memory, even if the ``KINGFISHER_DOWNLOAD_SPOOL_SIZE``
+        setting is set. By default, only the ``parse`` callback of a spider whose ``spool_responses`` class attribute
+        is ``True`` reads a ``FileResponse``.
+        """
+        return self.spool_responses and request.callback in {None, self.parse}
+
     def get_retry_wait_time(self, response):
-        """Return the number of seconds to wait before retrying a URL."""
-        return int(response.headers.get("Retry-After", 30))
+        """
+        Return the number of seconds to wait before retrying a URL: the ``Retry-After`` header's value, if valid, or
+        30, otherwise.
+        """
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        return 30 if retry_after is None else retry_after
 
     def build_request(self, url, formatter, **kwargs):
         """
@@ -345,14 +373,22 @@ class BaseSpider(scrapy.Spider):
         Return a File item to yield, based on the response to a request.
 
         If the response body starts with a byte-order mark, it is removed.
+
+        If the response is a :class:`~kingfisher_scrapy.responses.FileResponse`, the ``data`` is a file object.
         """
         kwargs.setdefault("file_name", response.request.meta["file_name"])
         kwargs.setdefault("url", response.request.url)
         if "data" not in kwargs:
-            body = response.body
-            # https://tools.ietf.org/html/rfc7159#section-8.1
-            if body.startswith(codecs.BOM_UTF8):  # noqa: FURB188 # bytes instances don't have a removeprefix method.
-                body = body[len(codecs.BOM_UTF8) :]
+            if isinstance(response, FileResponse):
+                body = response.open()
+                # https://tools.ietf.org/html/rfc7159#section-8.1
+                if body.read(len(codecs.BOM_UTF8)) != codecs.BOM_UTF8:
+                    body.seek(0)
+            else:
+                body = response.body
+                # https://tools.ietf.org/html/rfc7159#section-8.1
+                if body.startswith(codecs.BOM_UTF8):  # noqa: FURB188 # bytes instances don't have a removeprefix method.
+                    body = body[len(codecs.BOM_UTF8) :]
             kwargs["data"] = body
         return self.build_file(data_type=data_type, **kwargs)
 
@@ -12,6 +12,10 @@ class BigFileSpider(SimpleSpider):
     #. Inherit from ``BigFileSpider``
     #. Write a ``start()`` method to request the archive files
 
+    To bound memory usage, set the ``KINGFISHER_DOWNLOAD_SPOOL_SIZE`` setting to a number of bytes, to use the
+    :class:`~kingfisher_scrapy.downloadhandlers.SpoolingDownloadHandler`: a package larger than this size is written
+    to a temporary file, from which it is split. Only responses to the ``parse`` callback are spooled.
+
     .. code-block:: python
 
         from kingfisher_scrapy.base_spiders import BigFileSpider
@@ -25,11 +29,13 @@ class BigFileSpider(SimpleSpider):
 
     .. note::
 
-       ``concatenated_json = True``, ``line_delimited = True`` and ``root_path`` are not supported, because this spider
-       yields items whose ``data`` field has ``package`` and ``data`` keys.
+       ``concatenated_json = True``, ``line_delimited = True`` and ``root_path`` are not supported, because the
+       :class:`~kingfisher_scrapy.spidermiddlewares.ResizePackageMiddleware` parses the item's ``data`` as a package.
     """
 
+    # BaseSpider
     resize_package = True
+    spool_responses = True
 
     @classmethod
     def from_crawler(cls, crawler, *args, **kwargs):
@@ -41,11 +47,3 @@ class BigFileSpider(SimpleSpider):
             )
 
         return spider
-
-    def parse(self, response):
-        yield self.build_file(
-            file_name=response.request.meta["file_name"],
-            url=response.request.url,
-            data_type=self.data_type,
-            data={"data": response.body, "package": response.body},
-        )
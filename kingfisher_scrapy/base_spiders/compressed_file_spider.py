@@ -1,3 +1,5 @@
+import shutil
+import tempfile
 from io import BytesIO
 from zipfile import ZipFile
 
@@ -7,6 +9,7 @@ from rarfile import RarFile
 
 from kingfisher_scrapy.base_spiders import BaseSpider
 from kingfisher_scrapy.exceptions import UnknownArchiveFormatError
+from kingfisher_scrapy.responses import FileResponse
 from kingfisher_scrapy.util import get_file_name_and_extension
 
 
@@ -29,6 +32,12 @@ class CompressedFileSpider(BaseSpider):
     #. Optionally, add a ``skip_empty_releases = True`` class attribute to skip files with empty ``releases`` arrays.
     #. Write a ``start()`` method to request the archive files
 
+    To bound memory usage, set the ``KINGFISHER_ARCHIVE_SPOOL_SIZE`` setting to a number of bytes. A nested archive
+    larger than this size is copied to a temporary file, from which its files are read, instead of being read into
+    memory. Similarly, set the ``KINGFISHER_DOWNLOAD_SPOOL_SIZE`` setting to a number of bytes, to use the
+    :class:`~kingfisher_scrapy.downloadhandlers.SpoolingDownloadHandler`: an archive larger than this size is written
+    to a temporary file, from which its files are read. Only responses to the ``parse`` callback are spooled.
+
     .. code-block:: python
 
         from kingfisher_scrapy.base_spiders import CompressedFileSpider
@@ -51,14 +60,24 @@ class CompressedFileSpider(BaseSpider):
 
     # BaseSpider
     dont_truncate = True
+    spool_responses = True
 
     yield_non_archive_file = False
     file_name_must_contain = ""
     file_name_must_not_contain = ""
     skip_empty_releases = False
 
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+
+        spider.archive_spool_size = crawler.settings.getint("KINGFISHER_ARCHIVE_SPOOL_SIZE")
+
+        return spider
+
     def parse(self, response):
-        yield from self.process_archive_file(response, response.request.meta["file_name"], response.body)
+        data = response.open() if isinstance(response, FileResponse) else response.body
+        yield from self.process_archive_file(response, response.request.meta["file_name"], data)
 
     def process_archive_file(self, response, archive_file_name, archive_data):
         archive_name, archive_format = get_file_name_and_extension(archive_file_name)
@@ -79,7 +98,8 @@ class CompressedFileSpider(BaseSpider):
         # If we use a context manager here, the archive file might close before the item pipeline reads from the file
         # handlers of the compressed files.
 
-        archive_file = cls(BytesIO(archive_data))
+        # The archive data is either bytes or, if spooled, a file object.
+        archive_file = cls(archive_data if hasattr(archive_data, "read") else BytesIO(archive_data))
 
         number = 1
         for file_info in archive_file.infolist():
@@ -104,18 +124,15 @@ class CompressedFileSpider(BaseSpider):
             # If the file is itself an archive.
             if file_info.filename.endswith((".rar", ".zip")):
                 with archive_file.open(file_info.filename) as f:
-                    yield from self.process_archive_file(response, file_name, f.read())
+                    data = self._read_archive(f, file_info.file_size)
+                yield from self.process_archive_file(response, file_name, data)
             else:
                 if not file_name.endswith(".json"):
                     file_name += ".json"
 
                 compressed_file = archive_file.open(file_info.filename)
 
-                # If `resize_package = True`, then we need to open the file twice: once to extract the package metadata
-                # and then to extract the releases themselves.
-                if self.resize_package:
-                    data = {"data": compressed_file, "package": archive_file.open(file_info.filename)}
-                elif self.skip_empty_releases:
+                if self.skip_empty_releases and not self.resize_package:
                     data = compressed_file.read()
                     if not orjson.loads(data)["releases"]:
                         continue
@@ -132,3 +149,17 @@ class CompressedFileSpider(BaseSpider):
                 if item:
                     yield item
                     number += 1
+
+    def _read_archive(self, f, size):
+        """
+        Return the archive's data as bytes or, if larger than ``KINGFISHER_ARCHIVE_SPOOL_SIZE``, as a temporary file.
+
+        The temporary file is deleted once it is closed, which occurs once it is no longer referenced by the archive
+        and by the items' file handlers.
+        """
+        if self.archive_spool_size and size > self.archive_spool_size:
+            spooled = tempfile.TemporaryFile()  # noqa: SIM115 # the file must outlive this method
+            shutil.copyfileobj(f, spooled)
+            spooled.seek(0)
+            return spooled
+        return f.read()
@@ -1,11 +1,15 @@
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 import asyncio
-import datetime
+import heapq
+import itertools
 import logging
 import socket
+import time
 
 import scrapy.http
-from scrapy.exceptions import IgnoreRequest
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider, IgnoreRequest
+from scrapy.utils.asyncio import call_later
 from scrapy.utils.defer import deferred_from_coro
 
 from kingfisher_scrapy.responses import JSONResponse
@@ -36,11 +40,20 @@ class ParaguayAuthMiddleware(BaseDownloaderMiddleware):
     (usually 15) and sending the token on each request. The acquisition method of the token is delegated to the spider,
     since each publisher has their own credentials and requirements.
 
-    Apparently, a Downloader Middleware is the best place to set HTTP Request Headers (see
-    https://docs.scrapy.org/en/latest/topics/architecture.html), but it's not enough for this case :(.
-    Tokens should be generated and assigned just before sending a request, but Scrapy does not provide any way to do
-    this, which in turn means that sometimes we accidentally send expired tokens. For now, the issue seems to be
-    avoided by setting the number of concurrent requests to 1, at cost of download speed.
+    The token is set on each request just before it is downloaded. If the token is older than the spider's
+    ``access_token_maximum_age`` minus ``refresh_margin`` seconds, a new token is requested in the background, while
+    the current token is still used. If there is no token, or if it is older than ``access_token_maximum_age``, the
+    requests wait for a new token. Either way, one token request is in flight at a time, which all requests share.
+    As such, the spiders can download concurrently.
+
+    The token request is downloaded directly (without the scheduler or spider middlewares), up to
+    ``max_access_token_attempts`` times. A download error (like a timeout) counts as an attempt. If no token is
+    acquired, or if the token response is an HTTP error, the crawl is stopped.
+
+    If a response is a 401 (Unauthorized) error and its request used the current token, the token is discarded, and the
+    request is retried. If a response is a 429 (Too Many Requests) error, the token is kept, and the request is retried
+    after waiting the spider's ``get_retry_wait_time()``, using the
+    :class:`~kingfisher_scrapy.downloadermiddlewares.DelayedRequestMiddleware`.
 
     .. code-block:: python
 
@@ -48,54 +61,114 @@ class ParaguayAuthMiddleware(BaseDownloaderMiddleware):
             name = 'paraguay'
 
             # ParaguayAuthMiddleware
-            access_token = None
-            access_token_scheduled_at = None
-            # The maximum age is less than the API's limit, since we don't precisely control Scrapy's scheduler.
             access_token_maximum_age = 14 * 60
-            access_token_request_failed = False
-            requests_backlog = []
+            max_access_token_attempts = 5
 
             def build_access_token_request(self):
-                self.access_token_scheduled_at = datetime.datetime.now()
+                return scrapy.Request("https://example.com", meta={"auth": False})
 
-                return scrapy.Request("https://example.com")
+            def parse_access_token(self, response):
+                return response.json().get("access_token")
     """
 
-    def process_request(self, request):
+    # The number of seconds before the maximum age, at which to request a new token in the background.
+    refresh_margin = 60
+
+    def __init__(self, crawler):
+        super().__init__(crawler)
+        self.access_token = None
+        # The time.monotonic() value when the current token was requested.
+        self.access_token_requested_at = None
+        # The task that requests a new token, shared by all requests.
+        self.refreshing = None
+        self.failed = False
+
+    async def process_request(self, request):
         if request.meta.get("auth") is False:
-            return None
-        if self.spider.access_token_request_failed:
-            # See scrapyextensions/closespider.py and the docstring for scrapy.utils.defer._schedule_coro().
-            deferred_from_coro(self.crawler.engine.close_spider_async(reason="access_token_request_failed"))
-            raise IgnoreRequest("Max attempts to get an access token reached. Stopping crawl...")
-        request.headers["Authorization"] = self.spider.access_token
-        if self._expires_soon():
-            return self._add_request_to_backlog_and_build_access_token_request(request)
-        return None
+            return
+        request.headers["Authorization"] = await self.get_access_token()
 
-    def process_response(self, request, response):
-        if response.status in {401, 429}:
-            age = (datetime.datetime.now() - self.spider.access_token_scheduled_at).total_seconds()
-            logger.info("Access token age: %ss", age)
+    async def process_response(self, request, response):
+        if response.status == 401:
+            logger.info("Access token age: %ss", self.age)
             logger.info("%s returned for request to %s", response.status, request.url)
-            if self.spider.access_token != request.headers["Authorization"] and self._expires_soon():
-                return self._add_request_to_backlog_and_build_access_token_request(request)
-            request.headers["Authorization"] = self.spider.access_token
+            # If the token was refreshed since the request was sent, retry with the new token. Else, get a new one.
+            if self.access_token is None or request.headers.get("Authorization") == self.access_token.encode():
+                self.access_token = None
             return request
+        if response.status == 429:
+            wait_time = self.spider.get_retry_wait_time(response)
+            logger.info("%s returned for request to %s, retrying in %ss", response.status, request.url, wait_time)
+            return request.replace(meta={**request.meta, "wait_time": wait_time})
         return response
 
-    def _add_request_to_backlog_and_build_access_token_request(self, request):
-        self.spider.requests_backlog.append(request)
-        logger.info("Added request to backlog until token received: %s", request.url)
-        return self.spider.build_access_token_request()
+    @property
+    def age(self):
+        """Return the age of the current token in seconds, or ``None`` if there is no token."""
+        if self.access_token_requested_at is None:
+            return None
+        return time.monotonic() - self.access_token_requested_at
+
+    async def get_access_token(self):
+        """
+        Return a current token. If there is no token or it is too old, wait for a new token. If it is nearly too old,
+        request a new token in the background.
+        """
+        if self.failed:
+            raise IgnoreRequest("Max attempts to get an access token reached. Stopping crawl...")
 
-    def _expires_soon(self):
-        if self.spider.access_token and self.spider.access_token_scheduled_at:
-            age = (datetime.datetime.now() - self.spider.access_token_scheduled_at).total_seconds()
-            if age < self.spider.access_token_maximum_age:
-                return False
-            logger.info("Access token age: %ss", age)
-        return True
+        maximum_age = self.spider.access_token_maximum_age
+        age = self.age
+        if self.access_token and age < maximum_age:
+            if age >= maximum_age - self.refresh_margin:
+                self._refresh()
+            return self.access_token
+
+        # Don't cancel the shared task, if this request is cancelled.
+        await asyncio.shield(self._refresh())
+        if self.failed:
+            raise IgnoreRequest("Max attempts to get an access token reached. Stopping crawl...")
+        return self.access_token
+
+    def _refresh(self):
+        if self.refreshing is None or self.refreshing.done():
+            self.refreshing = asyncio.ensure_future(self._request_access_token())
+            self.refreshing.add_done_callback(self._log_refresh_error)
+        return self.refreshing
+
+    def _log_refresh_error(self, task):
+        # Retrieve the exception, in case no request awaits the task (if the token is refreshed in the background).
+        if not task.cancelled() and (exception := task.exception()):
+            self.spider.logger.error("Error while requesting access token", exc_info=exception)
+
+    async def _request_access_token(self):
+        for attempt in range(self.spider.max_access_token_attempts):
+            self.spider.logger.info(
+                "Requesting access token, attempt %s of %s", attempt + 1, self.spider.max_access_token_attempts
+            )
+            requested_at = time.monotonic()
+            request = self.spider.build_access_token_request()
+            try:
+                response = await self.crawler.engine.download_async(request)
+            # For example, DownloadFailedError, DownloadTimeoutError or IgnoreRequest.
+            except Exception as e:  # noqa: BLE001
+                self.spider.logger.warning("Access token request failed: %r", e)
+                continue
+            if not self.spider.is_http_success(response):
+                self._fail(f"Authentication failed. Status code: {response.status}")
+                return
+            if token := self.spider.parse_access_token(response):
+                self.spider.logger.info("New access token: %s", token)
+                self.access_token = token
+                self.access_token_requested_at = requested_at
+                return
+        self._fail("Max attempts to get an access token reached.")
+
+    def _fail(self, message):
+        self.failed = True
+        self.spider.logger.error(message)
+        # See scrapyextensions/closespider.py and the docstring for scrapy.utils.defer._schedule_coro().
+        deferred_from_coro(self.crawler.engine.close_spider_async(reason="access_token_request_failed"))
 
 
 class DelayedRequestMiddleware:
@@ -103,12 +176,78 @@ class DelayedRequestMiddleware:
     Downloader middleware that allows for delaying a request by a set 'wait_time' number of seconds.
 
     A delayed request is useful when an API fails and works again after waiting a few minutes.
+
+    A delayed request is removed from the downloader (by raising ``IgnoreRequest``) and held in a queue, ordered by
+    due time. When due, it is sent to the scheduler again, without its ``wait_time`` meta key. As such, a waiting
+    request doesn't occupy a download slot, and other requests are downloaded in the meantime. The spider isn't
+    closed while requests are waiting.
+
+    Since the original request is ignored, its errback (if any) is called with an ``IgnoreRequest`` failure, and the
+    exception is counted in the ``downloader/exception_type_count/scrapy.exceptions.IgnoreRequest`` stat. Delayed
+    requests are counted in the ``delayed_request/count`` stat, to distinguish them from other ignored requests.
     """
 
-    async def process_request(self, request):
+    def __init__(self, crawler):
+        self.crawler = crawler
+        # A heap of (due time, sequence number, request) tuples. The sequence number breaks ties in insertion order.
+        self.queue = []
+        self.counter = itertools.count()
+        # The timer that sends due requests to the scheduler, and its due time.
+        self.timer = None
+        self.timer_due = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        middleware = cls(crawler)
+        crawler.signals.connect(middleware.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def process_request(self, request):
         delay = request.meta.get("wait_time", None)
-        if delay:
-            await asyncio.sleep(delay)
+        if not delay:
+            return
+
+        meta = {key: value for key, value in request.meta.items() if key != "wait_time"}
+        # The request was already seen by the duplicates filter.
+        heapq.heappush(
+            self.queue, (time.monotonic() + delay, next(self.counter), request.replace(meta=meta, dont_filter=True))
+        )
+        self._schedule()
+        self.crawler.stats.inc_value("delayed_request/count")
+        raise IgnoreRequest(f"Delayed {request} by {delay}s")
+
+    def spider_idle(self):
+        if self.queue:
+            raise DontCloseSpider
+
+    def spider_closed(self, spider):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.queue:
+            spider.logger.warning("Dropped %d delayed requests", len(self.queue))
+            self.queue.clear()
+
+    def release(self):
+        """Send the requests that are due to the scheduler, and schedule the timer for the next due request."""
+        self.timer = None
+        now = time.monotonic()
+        while self.queue and self.queue[0][0] <= now:
+            _, _, request = heapq.heappop(self.queue)
+            self.crawler.engine.crawl(request)
+        self._schedule()
+
+    def _schedule(self):
+        if not self.queue:
+            return
+        due = self.queue[0][0]
+        if self.timer is not None:
+            if self.timer_due <= due:
+                return
+            self.timer.cancel()
+        self.timer = call_later(max(due - time.monotonic(), 0), self.release)
+        self.timer_due = due
 
 
 class CloudflareMiddleware(BaseDownloaderMiddleware):
@@ -1,13 +1,26 @@
 # https://docs.scrapy.org/en/latest/topics/download-handlers.html
-import asyncio
 import logging
+import tempfile
+from io import BytesIO
 
-from curl_cffi import requests
 from curl_cffi.const import CurlIpResolve, CurlOpt
+from curl_cffi.requests import AsyncSession
 from curl_cffi.requests.exceptions import RequestException, Timeout
-from scrapy.exceptions import DownloadFailedError, DownloadTimeoutError
-from scrapy.http import Headers
+from scrapy import signals
+from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler, _ScrapyAgent
+from scrapy.exceptions import DownloadCancelledError, DownloadFailedError, DownloadTimeoutError, ResponseDataLossError
+from scrapy.http import Headers, Response
 from scrapy.responsetypes import responsetypes
+from scrapy.utils._download_handlers import (
+    check_stop_download,
+    get_dataloss_msg,
+    get_maxsize_msg,
+    get_warnsize_msg,
+    wrap_twisted_exceptions,
+)
+from scrapy.utils.defer import maybe_deferred_to_future
+
+from kingfisher_scrapy.responses import FileResponse
 
 logger = logging.getLogger(__name__)
 
@@ -35,36 +48,54 @@ class CurlImpersonateDownloadHandler:
        Choose a specific version (like ``"chrome146"``) for a consistent fingerprint across ``curl_cffi`` upgrades.
     -  Set the ``CURL_IP_VERSION`` setting to ``"4"`` or ``"6"`` for a consistent version across requests. If unset,
        ``curl_cffi`` chooses.
+    -  Set the ``impersonate`` request meta key to override the ``CURL_IMPERSONATE`` setting for a request.
+
+    Requests are sent with a long-lived ``AsyncSession`` per browser profile and IP version, which reuses connections
+    and TLS sessions. Each session has at most ``CONCURRENT_REQUESTS_PER_DOMAIN`` connections. Sessions don't store
+    cookies: Scrapy's ``CookiesMiddleware`` sets the ``Cookie`` header.
+
+    Like Scrapy's HTTP/1.1 download handler, response bodies are streamed: the ``headers_received`` and
+    ``bytes_received`` signals are sent, and their handlers can raise ``StopDownload``; and the ``DOWNLOAD_MAXSIZE``
+    and ``DOWNLOAD_WARNSIZE`` settings are respected. Like
+    :class:`~kingfisher_scrapy.downloadhandlers.SpoolingDownloadHandler`, if the body exceeds the
+    ``KINGFISHER_DOWNLOAD_SPOOL_SIZE`` setting and the spider's ``accepts_file_response`` method returns ``True``, it
+    is written to a temporary file, and a :class:`~kingfisher_scrapy.responses.FileResponse` is returned.
     """
 
     lazy = True
 
     IP_RESOLVE = {"4": CurlIpResolve.V4, "6": CurlIpResolve.V6}
 
-    def __init__(self, settings):
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
         self.impersonate = settings.get("CURL_IMPERSONATE") or "chrome"
         self.ip_resolve = self.IP_RESOLVE.get(settings.get("CURL_IP_VERSION"))
+        self.max_clients = settings.getint("CONCURRENT_REQUESTS_PER_DOMAIN", 8)
+        self.maxsize = settings.getint("DOWNLOAD_MAXSIZE")
+        self.warnsize = settings.getint("DOWNLOAD_WARNSIZE")
+        self.spool_size = settings.getint("KINGFISHER_DOWNLOAD_SPOOL_SIZE")
+        # Sessions are created once the event loop is running, by browser profile and IP version.
+        self.sessions = {}
 
     @classmethod
     def from_crawler(cls, crawler):
-        return cls(crawler.settings)
+        return cls(crawler)
 
     async def download_request(self, request):
-        return await asyncio.to_thread(self._download, request)
+        session = self.get_session(request.meta.get("impersonate") or self.impersonate)
 
-    async def close(self):
-        pass
-
-    def _download(self, request):
         kwargs = {
             "method": request.method,
             "url": request.url,
             # curl_cffi expects a plain dict of strings. Join multi-valued headers like Scrapy's HTTP/1.1 handler.
             "headers": {key.decode(): b", ".join(values).decode() for key, values in request.headers.items()},
             "data": request.body,
-            "impersonate": self.impersonate,
             # Let Scrapy's RedirectMiddleware handle redirects.
             "allow_redirects": False,
+            # Let Scrapy's CookiesMiddleware handle cookies.
+            "discard_cookies": True,
+            "stream": True,
         }
         # Scrapy sets the download_timeout meta from the DOWNLOAD_TIMEOUT setting.
         if timeout := request.meta.get("download_timeout"):
@@ -72,20 +103,23 @@ class CurlImpersonateDownloadHandler:
         # curl_cffi must ignore the http_proxy and https_proxy environment variables, unless HTTPPROXY_ENABLED is True.
         proxy = request.meta.get("proxy") or ""
         kwargs["proxies"] = {"http": proxy, "https": proxy}
-        # Force the IP version, so that the request uses, e.g., the same version that solved a Cloudflare challenge.
-        if self.ip_resolve is not None:
-            kwargs["curl_options"] = {CurlOpt.IPRESOLVE: self.ip_resolve}
 
         try:
-            response = requests.request(**kwargs)
+            response = await session.request(**kwargs)
+            try:
+                return await self._read_response(request, response)
+            finally:
+                await response.aclose()
         # Translate curl_cffi exceptions to Scrapy exceptions.
         except Timeout as exception:  # Timeout is a subclass of RequestException.
             raise DownloadTimeoutError(str(exception)) from exception
         except RequestException as exception:
             raise DownloadFailedError(str(exception)) from exception
 
-        # curl_cffi already decompressed the body, so drop Content-Encoding (and the now-incorrect Content-Length), to
-        # stop Scrapy's HttpCompressionMiddleware from trying to decompress it again (raising BadGzipFile).
+    # https://github.com/scrapy/scrapy/blob/2.16.0/scrapy/core/downloader/handlers/http11.py#L509-L574
+    async def _read_response(self, request, response):
+        # curl_cffi decompresses the body, so drop Content-Encoding (and the now-incorrect Content-Length), to stop
+        # Scrapy's HttpCompressionMiddleware from trying to decompress it again (raising BadGzipFile).
         headers = Headers(
             [
                 (name, value)
@@ -93,11 +127,194 @@ class CurlImpersonateDownloadHandler:
                 if name.lower() not in ("content-encoding", "content-length")
             ]
         )
-        response_class = responsetypes.from_args(headers=headers, url=response.url, body=response.content)
-        return response_class(
-            url=response.url,
-            status=response.status_code,
-            headers=headers,
-            body=response.content,
-            request=request,
+        expected_size = int(response.headers.get("Content-Length") or -1)
+        if self.spool_size and self.crawler.spider.accepts_file_response(request):
+            body = SpooledBody(self.spool_size)
+        else:
+            body = BytesIO()
+
+        if stop_download := check_stop_download(
+            signals.headers_received, self.crawler, request, headers=headers, body_length=expected_size
+        ):
+            return self._build_response(request, response, headers, body, stop_download)
+
+        maxsize = request.meta.get("download_maxsize", self.maxsize)
+        warnsize = request.meta.get("download_warnsize", self.warnsize)
+
+        if maxsize and expected_size > maxsize:
+            message = get_maxsize_msg(expected_size, maxsize, request, expected=True)
+            logger.warning(message)
+            raise DownloadCancelledError(message)
+        if warnsize and expected_size > warnsize:
+            logger.warning(get_warnsize_msg(expected_size, warnsize, request, expected=True))
+
+        bytes_received = 0
+        reached_warnsize = False
+        async for chunk in response.aiter_content():
+            body.write(chunk)
+            bytes_received += len(chunk)
+
+            if stop_download := check_stop_download(signals.bytes_received, self.crawler, request, data=chunk):
+                break
+
+            if maxsize and bytes_received > maxsize:
+                message = get_maxsize_msg(bytes_received, maxsize, request, expected=False)
+                logger.warning(message)
+                raise DownloadCancelledError(message)
+            if warnsize and bytes_received > warnsize and not reached_warnsize:
+                reached_warnsize = True
+                logger.warning(get_warnsize_msg(bytes_received, warnsize, request, expected=False))
+
+        return self._build_response(request, response, headers, body, stop_download)
+
+    def _build_response(self, request, response, headers, body, stop_download):
+        kwargs = {"url": response.url, "status": response.status_code, "headers": headers, "request": request}
+        if file := getattr(body, "file", None):
+            file.flush()
+            result = FileResponse(**kwargs, file=file)
+        else:
+            data = body.getvalue()
+            response_class = responsetypes.from_args(headers=headers, url=response.url, body=data)
+            result = response_class(**kwargs, body=data)
+
+        # https://github.com/scrapy/scrapy/blob/2.16.0/scrapy/utils/_download_handlers.py#L94-L121
+        if stop_download:
+            result.flags.append("download_stopped")
+            if stop_download.fail:
+                stop_download.response = result
+                raise stop_download
+        return result
+
+    async def close(self):
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions.clear()
+
+    def get_session(self, impersonate):
+        """Return the session for the browser profile and the ``CURL_IP_VERSION`` setting, creating it if needed."""
+        key = (impersonate, self.ip_resolve)
+        if key not in self.sessions:
+            kwargs = {"impersonate": impersonate, "max_clients": self.max_clients}
+            # Force the IP version, so that requests use, e.g., the same version that solved a Cloudflare challenge.
+            if self.ip_resolve is not None:
+                kwargs["curl_options"] = {CurlOpt.IPRESOLVE: self.ip_resolve}
+            self.sessions[key] = AsyncSession(**kwargs)
+        return self.sessions[key]
+
+
+class SpoolingDownloadHandler(HTTP11DownloadHandler):
+    """
+    A download handler that writes large response bodies to a temporary file, instead of holding them in memory.
+
+    Scrapy's HTTP/1.1 download handler accumulates the response body in memory. This handler accumulates it in memory
+    until it exceeds the ``KINGFISHER_DOWNLOAD_SPOOL_SIZE`` setting (in bytes), after which it writes the body to a
+    temporary file and returns a :class:`~kingfisher_scrapy.responses.FileResponse`, whose ``body`` is empty.
+    If the setting is ``0``, this handler behaves like Scrapy's handler.
+
+    Only responses to requests whose callback reads a ``FileResponse`` from its file are spooled, according to the
+    spider's ``accepts_file_response`` method. Other response bodies are held in memory, for callbacks that read
+    ``response.body``. :class:`~kingfisher_scrapy.base_spiders.CompressedFileSpider` and
+    :class:`~kingfisher_scrapy.base_spiders.BigFileSpider` enable this handler if the setting is non-zero.
+
+    A compressed body (with a ``Content-Encoding`` header) is held in memory, because Scrapy's
+    ``HttpCompressionMiddleware`` decompresses ``response.body``.
+
+    .. warning::
+
+       This handler overrides private methods of Scrapy's HTTP/1.1 download handler, copied from Scrapy 2.16.0. Scrapy
+       is pinned to this version in ``requirements_base.in``, and a test checks the private methods' signatures: check
+       this handler before upgrading Scrapy.
+    """
+
+    def __init__(self, crawler):
+        super().__init__(crawler)
+        self.spool_size = crawler.settings.getint("KINGFISHER_DOWNLOAD_SPOOL_SIZE")
+
+    # https://github.com/scrapy/scrapy/blob/2.16.0/scrapy/core/downloader/handlers/http11.py#L106-L136
+    async def download_request(self, request):
+        if not self.spool_size or not self._crawler.spider.accepts_file_response(request):
+            return await super().download_request(request)
+
+        agent = _SpoolingAgent(
+            spool_size=self.spool_size,
+            contextFactory=self._contextFactory,
+            bindAddress=self._bind_address,
+            pool=self._pool,
+            maxsize=self._default_maxsize,
+            warnsize=self._default_warnsize,
+            fail_on_dataloss=self._fail_on_dataloss,
+            crawler=self._crawler,
+            tls_verbose_logging=self._tls_verbose_logging,
         )
+        try:
+            with wrap_twisted_exceptions():
+                return await maybe_deferred_to_future(agent.download_request(request))
+        except ResponseDataLossError:
+            if not self._fail_on_dataloss_warned:
+                logger.warning(get_dataloss_msg(request.url))
+                self._fail_on_dataloss_warned = True
+            raise
+
+
+class _SpoolingAgent(_ScrapyAgent):
+    # An agent is created for each request, so it can hold the request's body buffer.
+    def __init__(self, *, spool_size, **kwargs):
+        super().__init__(**kwargs)
+        self._spool_size = spool_size
+        self._body_buffer = None
+
+    def _cb_bodyready(self, txresponse, request):
+        if not txresponse.headers.hasHeader(b"Content-Encoding"):
+            deliver_body = txresponse.deliverBody
+
+            # Replace the BytesIO buffer of Scrapy's _ResponseReader protocol before it receives any data.
+            def deliver_spooled_body(protocol):
+                protocol._bodybuf = self._body_buffer = SpooledBody(self._spool_size)  # noqa: SLF001
+                deliver_body(protocol)
+
+            txresponse.deliverBody = deliver_spooled_body
+
+        return super()._cb_bodyready(txresponse, request)
+
+    def _cb_bodydone(self, result, url):
+        response = super()._cb_bodydone(result, url)
+        if self._body_buffer and self._body_buffer.file:
+            self._body_buffer.file.flush()
+            # Response.replace() would pass TextResponse's attributes, like `encoding`.
+            kwargs = {name: getattr(response, name) for name in Response.attributes}
+            return FileResponse(**kwargs, file=self._body_buffer.file)
+        return response
+
+
+class SpooledBody:
+    """
+    A write buffer that holds data in memory until its size exceeds ``max_size``, and in a temporary file thereafter.
+
+    It implements the subset of the ``BytesIO`` interface used by Scrapy's ``_ResponseReader`` protocol.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.buffer = BytesIO()
+        # Set once the data is written to a temporary file.
+        self.file = None
+
+    def write(self, data):
+        if self.file is None and self.buffer.tell() + len(data) > self.max_size:
+            self.file = tempfile.NamedTemporaryFile(prefix="kingfisher-", suffix=".body")  # noqa: SIM115
+            self.file.write(self.buffer.getvalue())
+            self.buffer = BytesIO()
+        if self.file is None:
+            self.buffer.write(data)
+        else:
+            self.file.write(data)
+
+    def truncate(self, size):
+        if self.file is None:
+            self.buffer.truncate(size)
+        else:
+            self.file.truncate(size)
+
+    def getvalue(self):
+        """Return the data if held in memory. Otherwise, return an empty bytestring."""
+        return self.buffer.getvalue()
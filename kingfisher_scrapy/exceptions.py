@@ -10,12 +10,12 @@ class MissingEnvVarError(KingfisherScrapyError):
     """Raised when a required environment variable is missing, from a spider's from_crawler method."""
 
 
-class IncoherentConfigurationError(KingfisherScrapyError):
-    """Raised when a spider is misconfigured by a developer, from a spider's __init__ method."""
+class InvalidSettingError(KingfisherScrapyError):
+    """Raised when a setting's value is invalid, from an extension's from_crawler method."""
 
 
-class AccessTokenError(KingfisherScrapyError):
-    """Raised when the maximum number of attempts to retrieve an access token is reached, from a spider callback."""
+class IncoherentConfigurationError(KingfisherScrapyError):
+    """Raised when a spider is misconfigured by a developer, from a spider's __init__ method."""
 
 
 class MissingNextLinkError(KingfisherScrapyError):
@@ -1,3 +1,4 @@
+from kingfisher_scrapy.extensions.adaptive_concurrency import AdaptiveConcurrency
 from kingfisher_scrapy.extensions.database_store import DatabaseStore
 from kingfisher_scrapy.extensions.files_store import FilesStore
 from kingfisher_scrapy.extensions.item_count import ItemCount
@@ -6,6 +7,7 @@ from kingfisher_scrapy.extensions.pluck import Pluck
 from kingfisher_scrapy.extensions.sentry_logging import SentryLogging
 
 __all__ = (
+    "AdaptiveConcurrency",
     "DatabaseStore",
     "FilesStore",
     "ItemCount",
@@ -0,0 +1,110 @@
+import collections
+import time
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.asyncio import call_later
+
+from kingfisher_scrapy.util import parse_retry_after
+
+
+class AdaptiveConcurrency:
+    """
+    If the ``KINGFISHER_ADAPTIVE_CONCURRENCY_ENABLED`` setting is ``True``, adjusts the concurrency of each download
+    slot (by default, each domain) according to the server's responses.
+
+    The concurrency starts at the ``CONCURRENT_REQUESTS_PER_DOMAIN`` setting. After
+    ``KINGFISHER_ADAPTIVE_CONCURRENCY_INCREASE_AFTER`` consecutive 2xx or 3xx responses, the concurrency is increased
+    by 1, up to ``KINGFISHER_ADAPTIVE_CONCURRENCY_MAX``. After a 403, 429 or 5xx response, the concurrency is halved,
+    down to 1. Error responses to requests that were sent before the last decrease are ignored, so that one burst of
+    errors halves the concurrency once. The ``CONCURRENT_REQUESTS`` setting still limits the total concurrency.
+
+    If an error response has a ``Retry-After`` header, no requests are sent to the slot until that time, by setting
+    the slot's download delay. The request itself is retried by the
+    :class:`~kingfisher_scrapy.spidermiddlewares.HttpErrorMiddleware`, after the wait time returned by
+    :meth:`~kingfisher_scrapy.base_spiders.BaseSpider.get_retry_wait_time`.
+
+    The current state of each slot is in the ``adaptive_concurrency/<slot>/concurrency``,
+    ``adaptive_concurrency/<slot>/decrease_count`` and ``adaptive_concurrency/<slot>/retry_after`` crawl stats.
+
+    .. note::
+
+       Don't enable Scrapy's AutoThrottle extension at the same time, because it also sets slots' download delays.
+    """
+
+    def __init__(self, crawler, *, maximum=8, increase_after=20):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.maximum = maximum
+        self.increase_after = increase_after
+
+        # The number of consecutive successful responses, by slot.
+        self.successes = collections.Counter()
+        # The time of the last decrease, by slot.
+        self.decreased_at = {}
+        # The slot's delay and randomize_delay before a pause, and the timer that resumes it, by slot.
+        self.paused = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("KINGFISHER_ADAPTIVE_CONCURRENCY_ENABLED"):
+            raise NotConfigured("KINGFISHER_ADAPTIVE_CONCURRENCY_ENABLED is not set.")
+
+        extension = cls(
+            crawler,
+            maximum=crawler.settings.getint("KINGFISHER_ADAPTIVE_CONCURRENCY_MAX", 8),
+            increase_after=crawler.settings.getint("KINGFISHER_ADAPTIVE_CONCURRENCY_INCREASE_AFTER", 20),
+        )
+        crawler.signals.connect(extension.response_downloaded, signal=signals.response_downloaded)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+
+        return extension
+
+    def response_downloaded(self, response, request, spider):
+        key = request.meta.get("download_slot")
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is None:
+            return
+
+        status = response.status
+        if status in {403, 429} or status >= 500:
+            self.successes[key] = 0
+            # Scrapy sets the download_latency meta once the response is received.
+            now = time.time()
+            if now - request.meta.get("download_latency", 0) >= self.decreased_at.get(key, 0):
+                self.decreased_at[key] = now
+                slot.concurrency = max(1, slot.concurrency // 2)
+                self.stats.inc_value(f"adaptive_concurrency/{key}/decrease_count")
+
+            if retry_after := parse_retry_after(response.headers.get("Retry-After")):
+                self.pause(key, slot, retry_after)
+        elif status < 400:
+            self.successes[key] += 1
+            if self.successes[key] >= self.increase_after and slot.concurrency < self.maximum:
+                self.successes[key] = 0
+                slot.concurrency += 1
+
+        self.stats.set_value(f"adaptive_concurrency/{key}/concurrency", slot.concurrency)
+
+    def spider_closed(self, spider):
+        for _, _, timer in self.paused.values():
+            timer.cancel()
+        self.paused.clear()
+
+    def pause(self, key, slot, seconds):
+        """Send no requests to the slot for the number of seconds."""
+        if key in self.paused:
+            delay, randomize_delay, timer = self.paused[key]
+            timer.cancel()
+        else:
+            delay, randomize_delay = slot.delay, slot.randomize_delay
+
+        # Scrapy sends a slot's next request once its delay has elapsed since its last request.
+        slot.delay = max(delay, seconds)
+        slot.randomize_delay = False
+        self.paused[key] = (delay, randomize_delay, call_later(seconds, self.resume, key, slot))
+        self.stats.set_value(f"adaptive_concurrency/{key}/retry_after", seconds)
+
+    def resume(self, key, slot):
+        """Restore the slot's download delay."""
+        slot.delay, slot.randomize_delay, _ = self.paused.pop(key)
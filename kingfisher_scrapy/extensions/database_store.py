@@ -1,6 +1,15 @@
+import contextlib
 import datetime
+import itertools
+import multiprocessing
 import os
+import queue
+import tempfile
+import time
 import warnings
+import zlib
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import ijson
 import orjson
@@ -8,11 +17,164 @@ import psycopg
 from ocdskit.combine import merge
 from ocdskit.exceptions import MergeErrorWarning
 from psycopg import sql
+from psycopg.copy import QueuedLibpqWriter
+from psycopg.types.json import Jsonb
 from scrapy import signals
 from scrapy.exceptions import NotConfigured
 
 from kingfisher_scrapy import util
-from kingfisher_scrapy.extensions.files_store import FilesStore
+from kingfisher_scrapy.exceptions import InvalidSettingError
+from kingfisher_scrapy.extensions.files_store import FilesStore, Segments
+
+# The extensions of the JSON files written by the FilesStore extension, with or without compression.
+JSON_EXTENSIONS = (".json", *(f".json{extension}" for extension in util.COMPRESSION_EXTENSIONS.values()))
+
+# The extensions of compressed files written by the FilesStore extension.
+COMPRESSED_EXTENSIONS = tuple(util.COMPRESSION_EXTENSIONS.values())
+
+# The number of items to send from a worker process at once.
+BATCH_SIZE = 100
+
+# The maximum number of files (or batches of items in segment files) to read in one task in a worker process.
+TASKS_PER_GROUP = 100
+
+# The ways in which to copy data into the database.
+COPY_MODES = ("file", "stream", "binary")
+
+
+def _dumps(obj):
+    return orjson.dumps(obj, default=util.default).replace(b"\x00", b"")
+
+
+def compile_shard(path, output, kwargs):
+    """
+    Merge the release packages or individual releases in the JSONL file, and write the compiled releases to the output
+    JSONL file. Return the warnings, as message and category pairs.
+
+    This function is called in worker processes.
+    """
+    with warnings.catch_warnings(record=True) as wlist:
+        warnings.simplefilter("always", category=MergeErrorWarning)
+
+        with open(path, "rb") as f, open(output, "wb") as o:
+            # Security: Potential SSRF via extension URLs (within OCDS publication).
+            releases = merge((orjson.loads(line) for line in f), convert_exceptions_to_warnings=True, **kwargs)
+            o.writelines(_dumps(release) + b"\n" for release in releases)
+
+    return [(str(w.message), w.category) for w in wlist]
+
+
+class PhaseTimer:
+    """
+    Measure the time spent in each phase, excluding the time spent in any phase nested within it.
+
+    For example, the time spent writing items excludes the time spent reading items from a timed generator.
+    """
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.stack = []
+        self.mark = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        now = time.perf_counter()
+        if self.stack:
+            self.totals[self.stack[-1]] += now - self.mark
+        self.stack.append(name)
+        self.mark = now
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.totals[self.stack.pop()] += now - self.mark
+            self.mark = now
+
+    def iterate(self, iterable, name):
+        """Yield the values of the iterable, timing the phase while each value is produced."""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    value = next(iterator)
+                except StopIteration:
+                    return
+            yield value
+
+
+def _iter_prefix(obj, keys):
+    # Like ijson.items, for a parsed object.
+    if not keys:
+        yield obj
+    elif keys[0] == "item":
+        if isinstance(obj, list):
+            for value in obj:
+                yield from _iter_prefix(value, keys[1:])
+    elif isinstance(obj, dict) and keys[0] in obj:
+        yield from _iter_prefix(obj[keys[0]], keys[1:])
+
+
+def read_items(path, ranges, prefix, max_size=0):
+    """
+    Yield the items at the prefix in the JSON file, or in the ranges of the segment file.
+
+    A JSON file is parsed with orjson, which is faster than ijson, but which reads the whole file into memory. If the
+    file is larger than ``max_size`` bytes, or if it is compressed (as its uncompressed size isn't known), it is parsed
+    with ijson, instead.
+
+    :param str path: the path to a JSON file or segment file
+    :param list ranges: ``None`` for a JSON file, or the offsets and lengths of the items in a segment file
+    :param str prefix: the prefix of the items, in ijson's format
+    :param int max_size: the maximum size of a JSON file to parse with orjson, or ``0`` for no maximum
+    """
+    keys = prefix.split(".") if prefix else []
+    with util.open_file(path) as f:
+        if ranges is not None:
+            for offset, length in ranges:
+                f.seek(offset)
+                yield from _iter_prefix(orjson.loads(f.read(length)), keys)
+        elif max_size and (path.endswith(COMPRESSED_EXTENSIONS) or os.path.getsize(path) > max_size):
+            yield from ijson.items(f, prefix)
+        else:
+            yield from _iter_prefix(orjson.loads(f.read()), keys)
+
+
+# The queue and event of a worker process, set by _init_worker.
+_worker = {}
+
+
+def _init_worker(batches, stop):
+    # A multiprocessing.Queue can only be shared with a process when it is started, not passed to a task.
+    _worker["batches"] = batches
+    _worker["stop"] = stop
+    # If the main process stops reading, don't wait to flush the queue when exiting.
+    batches.cancel_join_thread()
+
+
+def _put(value):
+    while not _worker["stop"].is_set():
+        try:
+            _worker["batches"].put(value, timeout=1)
+        except queue.Full:
+            continue
+        return True
+    return False
+
+
+def put_items(number, tasks, prefix, max_size):
+    """
+    Put batches of at most ``BATCH_SIZE`` items from :func:`read_items` for each task on the queue, and then the
+    number of the task group.
+
+    This function is called in worker processes.
+    """
+    try:
+        iterator = itertools.chain.from_iterable(read_items(path, ranges, prefix, max_size) for path, ranges in tasks)
+        while batch := list(itertools.islice(iterator, BATCH_SIZE)):
+            if not _put(batch):
+                return
+    finally:
+        _put(number)
 
 
 class DatabaseStore:
@@ -38,11 +200,60 @@ class DatabaseStore:
        not supported. If it isn't set, then spiders that return records without compiled releases are not supported.
 
     To perform incremental updates, the OCDS data in the crawl directory must not be deleted between crawls.
+
+    If the ``upsert`` spider argument is set, this extension instead reads only the files written since the last time
+    that it stored data from the crawl directory, and replaces the matching rows in the table: the individual releases
+    with the same ``ocid``, ``id`` and ``date``, or the compiled releases with the same ``ocid``. If the
+    ``compile_releases`` spider argument is set, compiled releases are recreated only for the changed OCIDs, using all
+    their individual releases in the crawl directory.
+
+    If the ``KINGFISHER_DATABASE_STORE_WORKERS`` setting is non-zero, the crawl directory's files are read by that
+    number of worker processes, in no particular order, and sent to the main process in batches. Each task reads a
+    group of up to 100 files, and a few tasks are submitted at a time. Workers stream files larger than the
+    ``KINGFISHER_DATABASE_STORE_MAX_SIZE`` setting (in bytes), to bound memory use. If the setting is non-zero,
+    compressed files are also streamed, since their uncompressed size isn't known, and files are grouped up to this
+    size.
+
+    By default, the data is written to a ``data.jsonl`` file in the crawl directory, which is then copied into the
+    table. If the ``KINGFISHER_DATABASE_STORE_COPY_MODE`` setting is "stream", the data is instead copied into the
+    table as it is read, without the file. If it is "binary", the data is copied in PostgreSQL's binary format. While
+    streaming, the table is locked for longer, since it is replaced (or upserted) while the data is read. The
+    ``KINGFISHER_DATABASE_STORE_COPY_BLOCK_SIZE`` setting sets the number of bytes sent to the database at once.
+
+    If the ``KINGFISHER_DATABASE_STORE_UNLOGGED`` setting is ``True``, the table is recreated as an ``UNLOGGED`` table,
+    and is changed to a ``LOGGED`` table once the data is copied. If the ``KINGFISHER_DATABASE_STORE_CONCURRENT_INDEX``
+    setting is ``True``, the index on the ``date`` field is built concurrently, after the data is committed.
+
+    The time spent in each phase (read, merge, write, copy, upsert and index) is recorded in the crawl stats, like
+    ``database_store_read_time_seconds``.
+
+    If the ``compile_releases`` spider argument is set and the ``KINGFISHER_DATABASE_STORE_COMPILE_SHARDS`` setting is
+    non-zero, the releases are partitioned by OCID into that number of temporary files, which are merged separately, by
+    the worker processes if any. Memory use is then bounded by the largest shard, rather than by all releases.
     """
 
-    def __init__(self, database_url, files_store_directory):
+    def __init__(
+        self,
+        database_url,
+        files_store_directory,
+        *,
+        workers=0,
+        max_size=0,
+        copy_mode="file",
+        shards=0,
+        block_size=65536,
+        unlogged=False,
+        concurrent_index=False,
+    ):
         self.database_url = database_url
         self.files_store_directory = files_store_directory
+        self.workers = workers
+        self.max_size = max_size
+        self.copy_mode = copy_mode
+        self.shards = shards
+        self.block_size = block_size
+        self.unlogged = unlogged
+        self.concurrent_index = concurrent_index
 
         self.connection = None
         self.cursor = None
@@ -57,7 +268,21 @@ class DatabaseStore:
         if not directory:
             raise NotConfigured("FILES_STORE is not set.")
 
-        extension = cls(database_url, directory)
+        copy_mode = crawler.settings.get("KINGFISHER_DATABASE_STORE_COPY_MODE") or "file"
+        if copy_mode not in COPY_MODES:
+            raise InvalidSettingError(f"KINGFISHER_DATABASE_STORE_COPY_MODE must be one of {', '.join(COPY_MODES)}.")
+
+        extension = cls(
+            database_url,
+            directory,
+            workers=crawler.settings.getint("KINGFISHER_DATABASE_STORE_WORKERS"),
+            max_size=crawler.settings.getint("KINGFISHER_DATABASE_STORE_MAX_SIZE"),
+            copy_mode=copy_mode,
+            shards=crawler.settings.getint("KINGFISHER_DATABASE_STORE_COMPILE_SHARDS"),
+            block_size=crawler.settings.getint("KINGFISHER_DATABASE_STORE_COPY_BLOCK_SIZE", 65536),
+            unlogged=crawler.settings.getbool("KINGFISHER_DATABASE_STORE_UNLOGGED"),
+            concurrent_index=crawler.settings.getbool("KINGFISHER_DATABASE_STORE_CONCURRENT_INDEX"),
+        )
         crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
         crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
 
@@ -110,66 +335,355 @@ class DatabaseStore:
         spider.logger.info("Reading the %s crawl directory with the %s prefix", crawl_directory, prefix or "empty")
         table_name = self.get_table_name(spider)
 
-        data = self.yield_items_from_directory(crawl_directory, prefix)
-        if spider.database_store_compile_releases:
-            spider.logger.info("Creating generator of compiled releases")
-            # Security: Potential SSRF via extension URLs (within OCDS publication).
-            data = merge(
-                data,
-                force_version=spider.database_store_force_version,
-                ignore_version=spider.database_store_ignore_version,
-                convert_exceptions_to_warnings=True,
-            )
-
-        filename = os.path.join(crawl_directory, "data.jsonl")
-        spider.logger.info("Writing the JSON data to the %s JSONL file", filename)
-        count = 0
-        with open(filename, "wb") as f:
-            with warnings.catch_warnings(record=True) as wlist:
-                warnings.simplefilter("always", category=MergeErrorWarning)
+        marker = os.path.join(crawl_directory, ".database_store")
+        since = os.path.getmtime(marker) if spider.database_store_upsert and os.path.exists(marker) else None
 
+        timer = PhaseTimer()
+        data = timer.iterate(self.yield_items_from_directory(crawl_directory, prefix, since=since), "read")
+        if spider.database_store_compile_releases:
+            if since is not None:
+                ocids = set()
                 for item in data:
-                    f.write(orjson.dumps(item, default=util.default).replace(b"\x00", b"") + b"\n")
-                    count += 1
-
-            errors = []
-            for w in wlist:
-                if issubclass(w.category, MergeErrorWarning):
-                    errors.append(w)
+                    ocids.update(
+                        release.get("ocid") for release in (item.get("releases", []) if prefix == "" else [item])
+                    )
+                spider.logger.info("Recompiling the releases of %d changed OCIDs", len(ocids))
+                data = timer.iterate(self.yield_items_from_directory(crawl_directory, prefix), "read")
+                data = self._filter_ocids(data, prefix, ocids)
 
-                warnings.warn_explicit(w.message, w.category, w.filename, w.lineno, source=w.source)
+            spider.logger.info("Creating generator of compiled releases")
+            kwargs = {
+                "force_version": spider.database_store_force_version,
+                "ignore_version": spider.database_store_ignore_version,
+            }
+            if self.shards:
+                data = self.compile_in_shards(data, prefix, crawl_directory, kwargs)
+            else:
+                # Security: Potential SSRF via extension URLs (within OCDS publication).
+                data = merge(data, convert_exceptions_to_warnings=True, **kwargs)
+            data = timer.iterate(data, "merge")
 
-            if errors:
-                spider.logger.error("%d OCIDs can't be merged due to structural errors", len(errors))
+        filename = os.path.join(crawl_directory, "data.jsonl")
+        action = "Upserting" if spider.database_store_upsert else "Replacing"
+        if self.copy_mode == "file":
+            spider.logger.info("Writing the JSON data to the %s JSONL file", filename)
+            with timer.phase("write"), open(filename, "wb") as f:
+                count = self.write_items(spider, data, lambda item: f.write(_dumps(item) + b"\n"))
+            spider.logger.info("%s the JSON data in the %s table (%s rows)", action, table_name, count)
 
-        spider.logger.info("Replacing the JSON data in the %s table (%s rows)", table_name, count)
         self.connection = psycopg.connect(self.database_url)
         self.cursor = self.connection.cursor()
         try:
-            self.execute("DROP TABLE {table}", table=table_name)
-            self.create_table(table_name)
-            with open(filename, "rb") as f:
-                statement = "COPY {table} (data) FROM stdin CSV QUOTE e'\x01' DELIMITER e'\x02'"
-                with self.cursor.copy(self.format(statement, table=table_name)) as copy:
-                    while block := f.read(65536):
-                        copy.write(block)
-            statement = "CREATE INDEX {index} ON {table} ((data ->> 'date'))"
-            self.execute(statement, table=table_name, index=f"idx_{table_name}")
+            if spider.database_store_upsert:
+                target = f"{table_name}_staging"
+                self.execute("CREATE TEMPORARY TABLE {table} (data jsonb) ON COMMIT DROP", table=target)
+            else:
+                target = table_name
+                self.execute("DROP TABLE {table}", table=table_name)
+                self.create_table(table_name, unlogged=self.unlogged)
+
+            with timer.phase("copy"):
+                if self.copy_mode == "file":
+                    self.copy(target, filename)
+                else:
+                    spider.logger.info("Streaming the JSON data to the %s table", table_name)
+                    count = self.copy_items(spider, target, data)
+                    spider.logger.info("%s the JSON data in the %s table (%s rows)", action, table_name, count)
+
+                if self.unlogged and not spider.database_store_upsert:
+                    self.execute("ALTER TABLE {table} SET LOGGED", table=table_name)
+
+            if spider.database_store_upsert:
+                if spider.database_store_compile_releases or "release" not in spider.data_type:
+                    keys = ["ocid"]
+                else:
+                    keys = ["ocid", "id", "date"]
+                with timer.phase("upsert"):
+                    self.upsert(table_name, target, keys)
+
+            if not self.concurrent_index:
+                with timer.phase("index"):
+                    self.create_index(table_name)
             self.connection.commit()
+
+            if spider.database_store_upsert:
+                with open(marker, "w"):
+                    pass
+
+            if self.concurrent_index:
+                # CREATE INDEX CONCURRENTLY can't run inside a transaction block.
+                self.connection.autocommit = True
+                with timer.phase("index"):
+                    self.create_index(table_name, concurrently=True)
         finally:
             self.cursor.close()
             self.connection.close()
-            os.remove(filename)
+            if self.copy_mode == "file":
+                os.remove(filename)
+
+        for name, seconds in timer.totals.items():
+            spider.crawler.stats.set_value(f"database_store_{name}_time_seconds", seconds)
 
-    def create_table(self, table):
-        self.execute("CREATE TABLE IF NOT EXISTS {table} (data jsonb)", table=table)
+    def create_table(self, table, *, unlogged=False):
+        unlogged = sql.SQL("UNLOGGED " if unlogged else "")
+        self.execute("CREATE {unlogged}TABLE IF NOT EXISTS {table} (data jsonb)", table=table, unlogged=unlogged)
 
-    def yield_items_from_directory(self, crawl_directory, prefix=""):
+    def create_index(self, table, *, concurrently=False):
+        concurrently = sql.SQL("CONCURRENTLY " if concurrently else "")
+        statement = "CREATE INDEX {concurrently}IF NOT EXISTS {index} ON {table} ((data ->> 'date'))"
+        self.execute(statement, table=table, index=f"idx_{table}", concurrently=concurrently)
+
+    def write_items(self, spider, data, write):
+        """Call ``write`` with each item, log any merge errors, and return the number of items."""
+        count = 0
+        with warnings.catch_warnings(record=True) as wlist:
+            warnings.simplefilter("always", category=MergeErrorWarning)
+
+            for item in data:
+                write(item)
+                count += 1
+
+        errors = []
+        for w in wlist:
+            if issubclass(w.category, MergeErrorWarning):
+                errors.append(w)
+
+            warnings.warn_explicit(w.message, w.category, w.filename, w.lineno, source=w.source)
+
+        if errors:
+            spider.logger.error("%d OCIDs can't be merged due to structural errors", len(errors))
+
+        return count
+
+    def copy(self, table, filename):
+        """Copy the JSONL file into the table."""
+        with open(filename, "rb") as f:
+            statement = "COPY {table} (data) FROM stdin CSV QUOTE e'\x01' DELIMITER e'\x02'"
+            with self.cursor.copy(self.format(statement, table=table)) as copy:
+                while block := f.read(self.block_size):
+                    copy.write(block)
+
+    def copy_items(self, spider, table, data):
+        """
+        Copy the items into the table, and return the number of items.
+
+        The rows are sent by a background thread, so that serializing items and sending rows overlap.
+        """
+        if self.copy_mode == "binary":
+            statement = "COPY {table} (data) FROM stdin (FORMAT BINARY)"
+        else:
+            statement = "COPY {table} (data) FROM stdin CSV QUOTE e'\x01' DELIMITER e'\x02'"
+
+        with self.cursor.copy(self.format(statement, table=table), writer=QueuedLibpqWriter(self.cursor)) as copy:
+            if self.copy_mode == "binary":
+                copy.set_types(["jsonb"])
+                return self.write_items(spider, data, lambda item: copy.write_row((Jsonb(item, dumps=_dumps),)))
+
+            buffer = bytearray()
+
+            def write(item):
+                buffer.extend(_dumps(item))
+                buffer.extend(b"\n")
+                if len(buffer) >= self.block_size:
+                    copy.write(bytes(buffer))
+                    buffer.clear()
+
+            count = self.write_items(spider, data, write)
+            if buffer:
+                copy.write(bytes(buffer))
+            return count
+
+    def upsert(self, table, staging, keys):
+        """
+        Replace the rows in the table with the rows in the staging table with the same keys.
+
+        The first key is compared with ``=``, so that PostgreSQL can use the index on it (or a hash or merge join).
+        Rows whose first key is null are matched in a separate statement.
+        """
+        first, *rest = keys
+        self.execute(
+            "CREATE INDEX IF NOT EXISTS {index} ON {table} ((data ->> {key}))",
+            table=table,
+            index=f"idx_{table}_{first}",
+            key=sql.Literal(first),
+        )
+        # Temporary tables aren't analyzed by autovacuum.
+        self.execute("ANALYZE {staging}", staging=staging)
+
+        # The other keys are filters on the rows found with the first key, so IS NOT DISTINCT FROM is acceptable.
+        rest = [
+            sql.SQL("t.data ->> {key} IS NOT DISTINCT FROM s.data ->> {key}").format(key=sql.Literal(key))
+            for key in rest
+        ]
+        for condition in (
+            sql.SQL("t.data ->> {key} = s.data ->> {key}").format(key=sql.Literal(first)),
+            sql.SQL("t.data ->> {key} IS NULL AND s.data ->> {key} IS NULL").format(key=sql.Literal(first)),
+        ):
+            self.execute(
+                "DELETE FROM {table} t USING {staging} s WHERE {condition}",
+                table=table,
+                staging=staging,
+                condition=sql.SQL(" AND ").join([condition, *rest]),
+            )
+        self.execute("INSERT INTO {table} (data) SELECT data FROM {staging}", table=table, staging=staging)
+
+    def compile_in_shards(self, data, prefix, crawl_directory, kwargs):
+        # If the prefix is empty, the items are release packages. Otherwise, they are releases. Each package is written
+        # to every shard, so that every shard merges with the same versions and extensions.
+        with tempfile.TemporaryDirectory(prefix=".shards-", dir=crawl_directory) as directory:
+            paths = [os.path.join(directory, f"{number}.jsonl") for number in range(self.shards)]
+            counts = [0] * self.shards
+
+            with contextlib.ExitStack() as stack:
+                files = [stack.enter_context(open(path, "wb")) for path in paths]
+                for item in data:
+                    if prefix == "":
+                        shards = [[] for _ in range(self.shards)]
+                        for release in item.get("releases", []):
+                            shards[self._shard(release)].append(release)
+                        for number, releases in enumerate(shards):
+                            files[number].write(_dumps({**item, "releases": releases}) + b"\n")
+                            counts[number] += len(releases)
+                    else:
+                        number = self._shard(item)
+                        files[number].write(_dumps(item) + b"\n")
+                        counts[number] += 1
+
+            tasks = [(path, f"{path[:-6]}.compiled.jsonl") for path, count in zip(paths, counts, strict=True) if count]
+
+            if self.workers:
+                context = multiprocessing.get_context("spawn")
+                with ProcessPoolExecutor(self.workers, mp_context=context) as executor:
+                    futures = {executor.submit(compile_shard, path, output, kwargs): output for path, output in tasks}
+                    for future in as_completed(futures):
+                        yield from self._read_compiled_shard(futures[future], future.result())
+            else:
+                for path, output in tasks:
+                    yield from self._read_compiled_shard(output, compile_shard(path, output, kwargs))
+
+    def _shard(self, release):
+        return zlib.crc32(str(release.get("ocid")).encode()) % self.shards
+
+    @staticmethod
+    def _read_compiled_shard(path, caught):
+        # Re-issue the warnings from the worker process, so that they are counted and logged like other warnings.
+        for message, category in caught:
+            warnings.warn(message, category, stacklevel=1)
+        with open(path, "rb") as f:
+            for line in f:
+                yield orjson.loads(line)
+
+    @staticmethod
+    def _filter_ocids(data, prefix, ocids):
+        # If the prefix is empty, the items are release packages. Otherwise, they are releases.
+        for item in data:
+            if prefix == "":
+                yield {
+                    **item,
+                    "releases": [release for release in item.get("releases", []) if release.get("ocid") in ocids],
+                }
+            elif item.get("ocid") in ocids:
+                yield item
+
+    def yield_items_from_directory(self, crawl_directory, prefix="", since=None):
+        """
+        Yield the items at the prefix in the crawl directory's files.
+
+        :param float since: if set, read only the files modified since this timestamp
+        """
+        if self.workers:
+            yield from self._yield_items_from_directory_in_parallel(crawl_directory, prefix, since)
+            return
+
+        for name, path in self._walk(crawl_directory, since):
+            if name.endswith(JSON_EXTENSIONS):
+                with util.open_file(path) as f:
+                    yield from ijson.items(f, prefix)
+            elif name.endswith(".index"):
+                for data in Segments.read(path):
+                    yield from ijson.items(data, prefix)
+
+    @staticmethod
+    def _walk(crawl_directory, since):
         for root, _, files in os.walk(crawl_directory):
             for name in files:
-                if name.endswith(".json"):
-                    with open(os.path.join(root, name), "rb") as f:
-                        yield from ijson.items(f, prefix)
+                path = os.path.join(root, name)
+                if since is None or os.path.getmtime(path) > since:
+                    yield name, path
+
+    def _yield_items_from_directory_in_parallel(self, crawl_directory, prefix, since):
+        context = multiprocessing.get_context("spawn")
+        # Limit the number of batches held in memory. Workers wait while the queue is full.
+        batches = context.Queue(self.workers * 2)
+        stop = context.Event()
+        executor = ProcessPoolExecutor(
+            self.workers, mp_context=context, initializer=_init_worker, initargs=(batches, stop)
+        )
+        groups = enumerate(self._task_groups(crawl_directory, since))
+        pending = {}
+
+        def submit(n):
+            for number, tasks in itertools.islice(groups, n):
+                pending[number] = executor.submit(put_items, number, tasks, prefix, self.max_size)
+
+        try:
+            # Limit the number of submitted task groups, to not hold a future for each file.
+            submit(self.workers * 2)
+            while pending:
+                try:
+                    value = batches.get(timeout=1)
+                except queue.Empty:
+                    # If a worker process was killed, its task group's number isn't put on the queue.
+                    for future in pending.values():
+                        if future.done():
+                            # Raise any exception from the worker process, like BrokenProcessPool.
+                            future.result()
+                    continue
+                if isinstance(value, int):
+                    pending.pop(value).result()
+                    submit(1)
+                else:
+                    yield from value
+        finally:
+            # If the items are no longer needed, stop the workers.
+            stop.set()
+            executor.shutdown(cancel_futures=True)
+            batches.close()
+
+    def _task_groups(self, crawl_directory, since):
+        # Group the tasks from `_tasks`, to submit fewer tasks to worker processes. A group has at most TASKS_PER_GROUP
+        # tasks and (unless it has one task) at most `max_size` bytes, so that large files are read in parallel.
+        group = []
+        size = 0
+        for path, ranges in self._tasks(crawl_directory, since):
+            task_size = os.path.getsize(path) if ranges is None else sum(length for _, length in ranges)
+            if group and (len(group) == TASKS_PER_GROUP or (self.max_size and size + task_size > self.max_size)):
+                yield group
+                group = []
+                size = 0
+            group.append((path, ranges))
+            size += task_size
+        if group:
+            yield group
+
+    def _tasks(self, crawl_directory, since):
+        # Yield JSON files, and batches of up to `max_size` bytes of items in segment files.
+        for name, path in self._walk(crawl_directory, since):
+            if name.endswith(JSON_EXTENSIONS):
+                yield path, None
+            elif name.endswith(".index"):
+                segment = f"{path[:-6]}.jsonl"
+                ranges = []
+                size = 0
+                for offset, length in Segments.ranges(path):
+                    if ranges and self.max_size and size + length > self.max_size:
+                        yield segment, ranges
+                        ranges = []
+                        size = 0
+                    ranges.append((offset, length))
+                    size += length
+                if ranges:
+                    yield segment, ranges
 
     # Copied from kingfisher-summarize
     def format(self, statement, **kwargs):
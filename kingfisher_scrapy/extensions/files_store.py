@@ -1,20 +1,147 @@
+import asyncio
 import math
 import os
+import threading
 import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 import orjson
 from scrapy import signals
 from scrapy.exceptions import NotConfigured
+from scrapy.utils.defer import deferred_from_coro
 
 from kingfisher_scrapy import util
+from kingfisher_scrapy.exceptions import InvalidSettingError
 from kingfisher_scrapy.items import File, FileItem
 
+# Sent by the FilesStore extension once an item's file is written, with `item`, `response` and `spider` arguments.
+item_stored = object()
+
+
+def _serialize(data):
+    if isinstance(data, bytes):
+        return data
+    if isinstance(data, str):
+        return data.encode()  # NOTE: should be UTF-8
+    return orjson.dumps(data, default=util.default)
+
+
+class Segments:
+    """
+    Append data to rolling segment files in a directory.
+
+    Each segment file, like ``000001.jsonl``, has an index file, like ``000001.index``, with one line per item: the
+    item's offset and length in the segment file, and the item's path relative to the crawl directory, separated by
+    tabs. Items are separated by newlines in the segment file, but needn't be on one line.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.number = None
+        self.name = None
+        self.file = None
+        self.index = None
+        self.size = 0
+
+    @staticmethod
+    def ranges(path):
+        """Yield the offset and length of each item in the index file."""
+        with open(path, "rb") as index:
+            for line in index:
+                # Ignore a partial line, if the crawl was interrupted.
+                if not line.endswith(b"\n"):
+                    break
+                offset, length, _ = line.split(b"\t", 2)
+                yield int(offset), int(length)
+
+    @classmethod
+    def read(cls, path):
+        """Yield the data of each item in the segment file for the given index file."""
+        with open(f"{path[:-6]}.jsonl", "rb") as f:
+            for offset, length in cls.ranges(path):
+                f.seek(offset)
+                yield f.read(length)
+
+    def write(self, relative_file_path, data):
+        """Append the data to the current segment file, and return the segment file's name, offset and length."""
+        with self.lock:
+            if self.file is None or (self.size and self.size + len(data) > self.max_size):
+                self._roll()
+            offset = self.size
+            self.file.write(data)
+            self.file.write(b"\n")
+            self.file.flush()
+            # Write the index entry after the data, so that an entry never references missing data.
+            self.index.write(f"{offset}\t{len(data)}\t{relative_file_path}\n".encode())
+            self.index.flush()
+            self.size += len(data) + 1
+            return self.name, offset, len(data)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.index.close()
+                self.file = None
+
+    def _roll(self):
+        if self.file is None:
+            # Don't overwrite the segment files of a previous run of the crawl.
+            os.makedirs(self.directory, exist_ok=True)
+            numbers = [int(name[:-6]) for name in os.listdir(self.directory) if name.endswith(".jsonl")]
+            self.number = max(numbers, default=0)
+        else:
+            self.file.close()
+            self.index.close()
+
+        self.number += 1
+        self.name = f"{self.number:06d}.jsonl"
+        self.file = open(os.path.join(self.directory, self.name), "wb")  # noqa: SIM115 # closed by close()
+        self.index = open(os.path.join(self.directory, f"{self.number:06d}.index"), "wb")  # noqa: SIM115 # ditto
+        self.size = 0
+
 
 class FilesStore:
-    """Write items' data to individual files in a directory. See the :ref:`how-it-works` documentation."""
+    """
+    Write items' data to individual files in a directory. See the :ref:`how-it-works` documentation.
+
+    If the ``KINGFISHER_FILES_STORE_WORKERS`` setting is non-zero, files are written by that number of background
+    threads, so that the reactor doesn't wait for the filesystem. Either way, the ``item_scraped`` signal completes
+    once the file is written, and the ``item_stored`` signal is then sent, to which the
+    :class:`~kingfisher_scrapy.extensions.kingfisher_process_api2.KingfisherProcessAPI2` extension connects.
 
-    def __init__(self, directory):
+    If the ``FILES_STORE_COMPRESSION`` setting is "gzip" or "zstd", files are compressed, and their names end in
+    ``.gz`` or ``.zst``, respectively. The :class:`~kingfisher_scrapy.extensions.database_store.DatabaseStore`
+    extension reads compressed files; Kingfisher Process doesn't, so the
+    :class:`~kingfisher_scrapy.extensions.kingfisher_process_api2.KingfisherProcessAPI2` extension raises an error if
+    this setting is set.
+
+    If the ``KINGFISHER_RESUME`` setting is ``True``, the paths of the written files are also recorded in the crawl
+    directory, so that a crawl that is restarted with the same ``crawl_time`` spider argument skips the files that are
+    already stored. See :class:`~kingfisher_scrapy.pipelines.Validate` and
+    :class:`~kingfisher_scrapy.spidermiddlewares.ResumeMiddleware`.
+
+    If the ``FILES_STORE_SEGMENT_SIZE`` setting is non-zero, items' data is instead appended to segment files of about
+    that number of bytes in the crawl directory's ``segments`` subdirectory, and the item's ``path`` is set to
+    ``<segment file path>:<offset>:<length>``. This avoids creating millions of small files for large crawls. The
+    :class:`~kingfisher_scrapy.extensions.database_store.DatabaseStore` extension reads segment files; Kingfisher
+    Process doesn't, so the :class:`~kingfisher_scrapy.extensions.kingfisher_process_api2.KingfisherProcessAPI2`
+    extension raises an error if this setting is set. Segment files aren't compressed.
+    """
+
+    def __init__(self, directory, signals, *, resume=False, workers=0, compression=None, segment_size=0):
         self.directory = directory
+        self.signals = signals
+        self.suffix = util.COMPRESSION_EXTENSIONS[compression] if compression else ""
+        self.resume = resume
+        self.stored = None
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="kingfisher-files-store") if workers else None
+        # The directories that exist, to call `os.makedirs` at most once per directory.
+        self.directories = set()
+        self.segment_size = segment_size
+        self.segments = None
 
     @classmethod
     def relative_crawl_directory(cls, spider):
@@ -25,6 +152,21 @@ class FilesStore:
 
         return os.path.join(spider_directory, spider.get_start_time("%Y%m%d_%H%M%S"))
 
+    @classmethod
+    def fingerprint_file(cls, directory, spider, name):
+        """Return the crawl's named set of fingerprints, which persists across restarts of the crawl."""
+        return util.FingerprintFile(os.path.join(directory, cls.relative_crawl_directory(spider), f".{name}.bin"))
+
+    @classmethod
+    def relative_file_path(cls, item):
+        """Return the path of the item's file, relative to the crawl directory."""
+        file_name = item.file_name
+        if isinstance(item, FileItem):
+            name, extension = util.get_file_name_and_extension(file_name)
+            file_name = f"{name}-{item.number}.{extension}"
+
+        return os.path.join(cls._get_subdirectory(file_name), file_name)
+
     @classmethod
     def from_crawler(cls, crawler):
         directory = crawler.settings["FILES_STORE"]
@@ -32,7 +174,24 @@ class FilesStore:
         if not directory:
             raise NotConfigured("FILES_STORE is not set.")
 
-        extension = cls(directory)
+        compression = crawler.settings["FILES_STORE_COMPRESSION"]
+        if compression and compression not in util.COMPRESSION_EXTENSIONS:
+            raise InvalidSettingError(
+                f"FILES_STORE_COMPRESSION must be one of {', '.join(util.COMPRESSION_EXTENSIONS)}."
+            )
+
+        segment_size = crawler.settings.getint("FILES_STORE_SEGMENT_SIZE")
+        if compression and segment_size:
+            raise InvalidSettingError("FILES_STORE_COMPRESSION and FILES_STORE_SEGMENT_SIZE can't both be set.")
+
+        extension = cls(
+            directory,
+            crawler.signals,
+            resume=crawler.settings.getbool("KINGFISHER_RESUME"),
+            workers=crawler.settings.getint("KINGFISHER_FILES_STORE_WORKERS"),
+            compression=compression,
+            segment_size=segment_size,
+        )
         crawler.signals.connect(extension.item_scraped, signal=signals.item_scraped)
         crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
 
@@ -44,6 +203,13 @@ class FilesStore:
             self._write_file(path, spider._job)
 
     def spider_closed(self, spider, reason):
+        if self.executor is not None:
+            self.executor.shutdown()
+        if self.segments is not None:
+            self.segments.close()
+        if self.stored is not None:
+            self.stored.close()
+
         if reason not in {"finished", "sample"} or spider.pluck:
             return
 
@@ -62,24 +228,52 @@ class FilesStore:
         spider.logger.info(f"| {' ' * message_length} |")  # noqa: G004
         spider.logger.info(f"+-{'-' * message_length}-+")  # noqa: G004
 
-    def item_scraped(self, item, spider):
+    def item_scraped(self, item, spider, response=None):
         """
-        If the item is a File or FileItem, write its data to the filename in a subdirectory of the crawl directory.
+        If the item is a File or FileItem, write its data to the filename in a subdirectory of the crawl directory, and
+        set the item's ``path``.
 
-        Return a dict with the metadata.
+        If there are background threads, return a Deferred that fires once the file is written.
         """
         if not isinstance(item, File | FileItem):
-            return
+            return None
 
-        file_name = item.file_name
-        if isinstance(item, FileItem):
-            name, extension = util.get_file_name_and_extension(file_name)
-            file_name = f"{name}-{item.number}.{extension}"
+        relative_file_path = self.relative_file_path(item)
+
+        if self.segment_size:
+            if self.segments is None:
+                directory = os.path.join(self.directory, self.relative_crawl_directory(spider), "segments")
+                self.segments = Segments(directory, self.segment_size)
+        else:
+            item.path = os.path.join(self.relative_crawl_directory(spider), relative_file_path) + self.suffix
 
-        path = os.path.join(self.relative_crawl_directory(spider), self._get_subdirectory(file_name), file_name)
-        self._write_file(path, item.data)
+        if self.executor is None:
+            self._write_item_data(item, relative_file_path, spider)
+            self._item_stored(relative_file_path, spider)
+            self.signals.send_catch_log(signal=item_stored, item=item, response=response, spider=spider)
+            return None
 
-        item.path = path
+        return deferred_from_coro(self._write_item(item, relative_file_path, response, spider))
+
+    async def _write_item(self, item, relative_file_path, response, spider):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._write_item_data, item, relative_file_path, spider)
+        self._item_stored(relative_file_path, spider)
+        await self.signals.send_catch_log_async(signal=item_stored, item=item, response=response, spider=spider)
+
+    def _write_item_data(self, item, relative_file_path, spider):
+        if self.segments is None:
+            self._write_file(item.path, item.data)
+        else:
+            name, offset, length = self.segments.write(relative_file_path, _serialize(item.data))
+            path = os.path.join(self.relative_crawl_directory(spider), "segments", name)
+            item.path = f"{path}:{offset}:{length}"
+
+    def _item_stored(self, relative_file_path, spider):
+        if self.resume:
+            if self.stored is None:
+                self.stored = self.fingerprint_file(self.directory, spider, "files")
+            self.stored.add(relative_file_path)
 
     # https://github.com/rails/rails/blob/05ed261/activesupport/lib/active_support/cache/file_store.rb#L150-L175
     @staticmethod
@@ -91,12 +285,10 @@ class FilesStore:
 
     def _write_file(self, path, data):
         path = os.path.join(self.directory, path)
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-
-        with open(path, "wb") as f:
-            if isinstance(data, bytes):
-                f.write(data)
-            elif isinstance(data, str):
-                f.write(data.encode())  # NOTE: should be UTF-8
-            else:
-                f.write(orjson.dumps(data, default=util.default))
+        directory = os.path.dirname(path)
+        if directory not in self.directories:
+            os.makedirs(directory, exist_ok=True)
+            self.directories.add(directory)
+
+        with util.open_file(path, "wb") as f:
+            f.write(_serialize(data))
@@ -1,15 +1,232 @@
 import asyncio
+import collections
 import functools
+import logging
 from urllib.parse import urljoin
 
 import orjson
+import pika
 import requests
 from scrapy import signals
 from scrapy.exceptions import NotConfigured
+from scrapy.utils.asyncio import run_in_thread
+from twisted.internet.defer import Deferred
+from urllib3.util import Retry
 from yapw.clients import Async
 
+from kingfisher_scrapy.exceptions import InvalidSettingError
+from kingfisher_scrapy.extensions.files_store import item_stored
 from kingfisher_scrapy.items import PluckedItem
 
+logger = logging.getLogger(__name__)
+
+# The RabbitMQ clients that are shared by the crawlers in the process, by RabbitMQ URL and exchange name.
+publishers = {}
+
+
+class _Retry(Retry):
+    # A 502 or 504 response can be sent after Kingfisher Process reads the request, so only retry a POST request (which
+    # isn't idempotent) if Kingfisher Process is unavailable. Connection errors are retried for all methods.
+    def is_retry(self, method, status_code, has_retry_after=False):  # noqa: FBT002 # urllib3
+        if method == "POST":
+            return status_code == 503
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+@functools.cache
+def session():
+    """
+    Return the HTTP session that is shared by all crawlers in the process, to reuse connections to Kingfisher Process.
+
+    Requests are retried if the connection fails, or if the server or a proxy is temporarily unavailable. Requests
+    aren't retried after the server reads them, as Kingfisher Process might have acted on them: for example, POST
+    requests aren't retried after 502 or 504 responses.
+    """
+    retry = _Retry(
+        total=3,
+        connect=3,
+        read=0,
+        status=3,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}),
+        backoff_factor=1,
+        raise_on_status=False,
+    )
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=32, max_retries=retry)
+    instance = requests.Session()
+    instance.mount("http://", adapter)
+    instance.mount("https://", adapter)
+    return instance
+
+
+class Publisher(Async):
+    """
+    A RabbitMQ client that queues messages, and publishes them in batches with publisher confirms.
+
+    Queued messages are published at most once per iteration of the event loop, up to ``window`` unconfirmed messages.
+    Messages that RabbitMQ rejects, or that are unconfirmed when the connection closes, are published again.
+
+    If ``max_pending`` messages are queued or unconfirmed, each subscriber's ``on_pause`` callback is called. Once half
+    as many are, each subscriber's ``on_resume`` callback is called.
+
+    Use :meth:`shared` to share one client (and its connection) among the crawlers in the process.
+    """
+
+    def __init__(self, *, window=1000, max_pending=10000, **kwargs):
+        super().__init__(**kwargs)
+        self.window = window
+        self.max_pending = max_pending
+        # The subscribers' pause and resume callbacks.
+        self.subscribers = {}
+
+        self.queue = collections.deque()
+        # Delivery tags and messages, in the order published.
+        self.unconfirmed = {}
+        self.delivery_tag = 0
+        # Whether the channel is in confirm mode.
+        self.confirming = False
+        self.scheduled = False
+        self.paused = False
+        self.closing = None
+
+    @classmethod
+    def shared(cls, url, exchange, **kwargs):
+        """
+        Return the client for the RabbitMQ URL and exchange that is shared by the crawlers in the process, creating
+        and starting it if there is none, or if it is closing.
+
+        The keyword arguments are used only if the client is created. Subscribe to the client with :meth:`subscribe`.
+        """
+        key = (url, exchange)
+        client = publishers.get(key)
+        if client is None or client.closing is not None:
+            client = cls(url=url, exchange=exchange, **kwargs)
+            publishers[key] = client
+            client.start()
+        return client
+
+    def subscribe(self, key, on_pause=None, on_resume=None):
+        """Add a subscriber, whose callbacks are called when publishing is paused or resumed."""
+        self.subscribers[key] = (on_pause, on_resume)
+        if self.paused and on_pause:
+            on_pause(self.pending)
+
+    def unsubscribe(self, key):
+        """
+        Remove a subscriber. If it was the last, close the client.
+
+        Return a future that is done once the client is interrupted, or immediately if other subscribers remain.
+        """
+        self.subscribers.pop(key, None)
+        if self.subscribers:
+            future = self.connection.ioloop.create_future()
+            future.set_result(None)
+            return future
+
+        for shared_key, client in list(publishers.items()):
+            if client is self:
+                del publishers[shared_key]
+        return self.close()
+
+    @property
+    def pending(self):
+        """Return the number of messages that are queued or unconfirmed."""
+        return len(self.queue) + len(self.unconfirmed)
+
+    def queue_message(self, message, routing_key):
+        """Queue the ``message`` with the ``routing_key``, to publish in the next batch."""
+        self.queue.append((message, routing_key))
+        self._schedule()
+
+        if not self.paused and self.max_pending and self.pending >= self.max_pending:
+            self.paused = True
+            for on_pause, _ in list(self.subscribers.values()):
+                if on_pause:
+                    on_pause(self.pending)
+
+    def close(self):
+        """
+        Interrupt the client once all messages are confirmed, or after 60 seconds.
+
+        If the channel isn't in confirm mode (like while reconnecting), the queued messages are published once it is.
+
+        Return a future that is done once the client is interrupted.
+        """
+        if self.closing is None:
+            self.closing = self.connection.ioloop.create_future()
+            if self.pending:
+                self.connection.ioloop.call_later(60, self._interrupt)
+            else:
+                self._interrupt()
+        return self.closing
+
+    def reset(self):
+        super().reset()
+        # Publish the unconfirmed messages again, once reconnected.
+        self.queue.extendleft(reversed(self.unconfirmed.values()))
+        self.unconfirmed.clear()
+        self.delivery_tag = 0
+        self.confirming = False
+
+    def exchange_ready(self):
+        self.channel.confirm_delivery(self.confirm_callback, callback=self.confirm_selectok_callback)
+
+    def connection_unblocked_callback(self, connection, method):
+        super().connection_unblocked_callback(connection, method)
+        self._schedule()
+
+    def confirm_selectok_callback(self, method):
+        self.confirming = True
+        self._schedule()
+
+    def confirm_callback(self, frame):
+        method = frame.method
+        confirmed = []
+        if method.multiple:
+            while self.unconfirmed and (tag := next(iter(self.unconfirmed))) <= method.delivery_tag:
+                confirmed.append(self.unconfirmed.pop(tag))
+        elif method.delivery_tag in self.unconfirmed:
+            confirmed.append(self.unconfirmed.pop(method.delivery_tag))
+
+        if isinstance(method, pika.spec.Basic.Nack):
+            logger.warning("RabbitMQ rejected %d messages, publishing again", len(confirmed))
+            self.queue.extend(confirmed)
+
+        if self.paused and self.pending <= self.max_pending // 2:
+            self.paused = False
+            for _, on_resume in list(self.subscribers.values()):
+                if on_resume:
+                    on_resume(self.pending)
+
+        if self.closing is not None and not self.pending:
+            self._interrupt()
+        else:
+            self._schedule()
+
+    def _schedule(self):
+        if not self.scheduled:
+            self.scheduled = True
+            self.connection.ioloop.call_soon_threadsafe(self._flush)
+
+    def _flush(self):
+        self.scheduled = False
+        # The exchange_ready and connection_unblocked callbacks flush the queue once publishing is possible.
+        if not self.confirming or self.blocked:
+            return
+        while self.queue and len(self.unconfirmed) < self.window:
+            message, routing_key = self.queue.popleft()
+            self.publish(message, routing_key)
+            self.delivery_tag += 1
+            self.unconfirmed[self.delivery_tag] = (message, routing_key)
+
+    def _interrupt(self):
+        if self.closing.done():
+            return
+        if self.pending:
+            logger.error("Closing the RabbitMQ connection with %d messages unconfirmed", self.pending)
+        self.closing.set_result(None)
+        self.interrupt()
+
 
 class KingfisherProcessAPI2:
     """
@@ -19,8 +236,16 @@ class KingfisherProcessAPI2:
     When the spider is opened, a collection is created in Kingfisher Process via its web API. The API also receives the
     ``note`` and ``steps`` spider arguments (if set) and the spider's ``ocds_version`` class attribute.
 
-    When an item is scraped, a message is published to the exchange for Kingfisher Process in RabbitMQ, with the path
-    to the file written by the :class:`~kingfisher_scrapy.extensions.files_store.FilesStore` extension.
+    API requests are sent from a thread, with an HTTP session that is shared by all crawlers in the process, so that a
+    slow API doesn't block other crawlers (like when running the :ref:`crawlall` command). The crawl doesn't start
+    until the collection is created.
+
+    When an item is stored, a message is published to the exchange for Kingfisher Process in RabbitMQ, with the path
+    to the file written by the :class:`~kingfisher_scrapy.extensions.files_store.FilesStore` extension. Messages are
+    published in batches, with publisher confirms: at most ``RABBIT_PUBLISH_WINDOW`` messages are unconfirmed at once.
+    If ``RABBIT_MAX_PENDING`` messages are waiting, because RabbitMQ is slow, the crawl is paused until half are
+    confirmed. The crawlers in the process share one RabbitMQ connection, which is closed once the last crawler is
+    closed. As such, these settings are read from the first crawler to connect.
 
     When the spider is closed, the collection is closed in Kingfisher Process via its web API, unless the
     ``keep_collection_open`` spider argument was set to ``'true'``. The API also receives the crawl statistics and the
@@ -34,14 +259,24 @@ class KingfisherProcessAPI2:
     .. note::
 
        This extension ignores items generated by the :ref:`pluck` command.
+
+    .. note::
+
+       Kingfisher Process reads only the paths of plain JSON files. If the ``FILES_STORE_SEGMENT_SIZE`` or
+       ``FILES_STORE_COMPRESSION`` setting is set, this extension raises an
+       :class:`~kingfisher_scrapy.exceptions.InvalidSettingError` exception.
     """
 
-    def __init__(self, url, stats, rabbit_url, rabbit_exchange_name, rabbit_routing_key):
+    def __init__(
+        self, url, stats, rabbit_url, rabbit_exchange_name, rabbit_routing_key, *, window=1000, max_pending=10000
+    ):
         self.url = url
         self.stats = stats
         self.rabbit_url = rabbit_url
         self.rabbit_exchange_name = rabbit_exchange_name
         self.routing_key = rabbit_routing_key
+        self.window = window
+        self.max_pending = max_pending
 
         # The client and collection ID are set by the spider_opened handler.
         self.client = None
@@ -66,14 +301,32 @@ class KingfisherProcessAPI2:
         if not rabbit_routing_key:
             raise NotConfigured("RABBIT_ROUTING_KEY is not set.")
 
-        extension = cls(url, crawler.stats, rabbit_url, rabbit_exchange_name, rabbit_routing_key)
+        # Kingfisher Process reads only the paths of plain JSON files.
+        if crawler.settings.getint("FILES_STORE_SEGMENT_SIZE"):
+            raise InvalidSettingError(
+                "FILES_STORE_SEGMENT_SIZE can't be set, as Kingfisher Process can't read segments."
+            )
+        if crawler.settings["FILES_STORE_COMPRESSION"]:
+            raise InvalidSettingError(
+                "FILES_STORE_COMPRESSION can't be set, as Kingfisher Process can't read compressed files."
+            )
+
+        extension = cls(
+            url,
+            crawler.stats,
+            rabbit_url,
+            rabbit_exchange_name,
+            rabbit_routing_key,
+            window=crawler.settings.getint("RABBIT_PUBLISH_WINDOW", 1000),
+            max_pending=crawler.settings.getint("RABBIT_MAX_PENDING", 10000),
+        )
         crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
-        crawler.signals.connect(extension.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(extension.item_stored, signal=item_stored)
         crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
 
         return extension
 
-    def spider_opened(self, spider):
+    async def spider_opened(self, spider):
         """Send an API request to create a collection in Kingfisher Process."""
         data_version = spider.get_start_time("%Y-%m-%d %H:%M:%S")
 
@@ -92,8 +345,8 @@ class KingfisherProcessAPI2:
         for step in spider.kingfisher_process_steps:
             data[step] = True
 
-        # This request must be synchronous, to have the collection ID for the item_scraped handler.
-        response = self._post_synchronous(spider, "/api/collections/", data)
+        # The spider_opened signal waits for this request, to have the collection ID for the item_stored handler.
+        response = await self._post(spider, "/api/collections/", data)
 
         if response.ok:
             # https://docs.scrapy.org/en/latest/topics/asyncio.html#handling-a-pre-installed-reactor
@@ -105,34 +358,43 @@ class KingfisherProcessAPI2:
             # process_manager/task/collect.py file in the open-contracting/data-registry repository to match.
             spider.logger.info("Created collection %d in Kingfisher Process (%s)", self.collection_id, data_version)
 
-            self.client = Async(
-                url=self.rabbit_url,
-                exchange=self.rabbit_exchange_name,
+            # Connect to RabbitMQ only if a collection_id is set, as other signals don't use RabbitMQ, otherwise.
+            self.client = Publisher.shared(
+                self.rabbit_url,
+                self.rabbit_exchange_name,
                 routing_key_template="{routing_key}",
                 # When running `scrapy crawl`, the event loop isn't running when __init__ is called.
                 custom_ioloop=asyncio.get_running_loop(),
                 manage_ioloop=False,
+                window=self.window,
+                max_pending=self.max_pending,
+            )
+            self.client.subscribe(
+                self,
+                on_pause=lambda pending: self._pause(spider, pending),
+                on_resume=lambda pending: self._resume(spider, pending),
             )
 
-            # Connect to RabbitMQ only if a collection_id is set, as other signals don't use RabbitMQ, otherwise.
-            self.client.start()
-
-            # Ensure the RabbitMQ connection is closed during reactor shutdown.
+            # Ensure the RabbitMQ connection is closed during reactor shutdown, if the spider isn't closed.
             self.shutdown_trigger_id = reactor.addSystemEventTrigger("before", "shutdown", self.disconnect)
         else:
             self._response_error(spider, "Failed to create collection", response)
 
-    def spider_closed(self, spider, reason):
+    async def spider_closed(self, spider, reason):
         """Send an API request to close the collection in Kingfisher Process."""
         if not self.collection_id:
             return
 
+        # Publish the messages before closing the collection, if this is the last crawler using the connection.
+        if future := self._unsubscribe():
+            await future
+
         # Scrapyd's cancel.json endpoint sends a SIGINT signal to the Scrapy process, which uses the "shutdown" reason.
         # If a process is cancelled, don't close the collection, as this triggers compilation of release collections.
         if spider.pluck or spider.kingfisher_process_keep_collection_open or reason == "shutdown":
             return
 
-        response = self._post_synchronous(
+        response = await self._post(
             spider,
             f"/api/collections/{self.collection_id}/close/",
             {
@@ -146,7 +408,7 @@ class KingfisherProcessAPI2:
         else:
             self._response_error(spider, "Failed to close collection", response)
 
-    def item_scraped(self, item, spider):
+    def item_stored(self, item, spider):
         """Publish a RabbitMQ message to store the file or file item in Kingfisher Process."""
         if not self.collection_id:
             return
@@ -160,29 +422,36 @@ class KingfisherProcessAPI2:
             "path": item.path,
         }
 
-        cb = functools.partial(self._when_ready, self.client.publish, data, self.routing_key)
-        self.client.connection.ioloop.call_soon_threadsafe(cb)
+        self.client.queue_message(data, self.routing_key)
 
         # WARNING! Kingfisher Process's API reads this value.
         self.stats.inc_value("kingfisher_process_expected_files_count")
 
     def disconnect(self):
-        """Close the RabbitMQ connection."""
-        cb = functools.partial(self._when_ready, self.client.interrupt)
-        self.client.connection.ioloop.call_soon_threadsafe(cb)
-
-    def _post_synchronous(self, spider, path, data):
-        """POST synchronous API requests to Kingfisher Process."""
+        """Close the RabbitMQ connection, once the queued messages are published, if no other crawlers use it."""
+        if future := self._unsubscribe():
+            return Deferred.fromFuture(future)
+        return None
+
+    def _unsubscribe(self):
+        if self.client is None:
+            return None
+        client, self.client = self.client, None
+        return client.unsubscribe(self)
+
+    async def _post(self, spider, path, data):
+        """POST API requests to Kingfisher Process, without blocking the reactor."""
         url = urljoin(self.url, path)
-        spider.logger.debug("Sending synchronous request to Kingfisher Process at %s with %s", url, data)
-        return requests.post(url, json=data, timeout=3600)  # 1h
+        spider.logger.debug("Sending request to Kingfisher Process at %s with %s", url, data)
+        return await run_in_thread(session().post, url, json=data, timeout=3600)  # 1h
 
-    def _when_ready(self, function, *args):
-        # Scrapy can sometimes reach signals before yapw reaches exchange_ready.
-        if self.client.ready:
-            function(*args)
-        else:
-            self.client.connection.ioloop.call_soon(self._when_ready, function, *args)
+    def _pause(self, spider, pending):
+        spider.logger.warning("Pausing the crawl, while %d messages are published to RabbitMQ", pending)
+        spider.crawler.engine.pause()
+
+    def _resume(self, spider, pending):
+        spider.logger.info("Resuming the crawl, with %d messages to publish to RabbitMQ", pending)
+        spider.crawler.engine.unpause()
 
     def _response_error(self, spider, message, response):
         spider.logger.critical(
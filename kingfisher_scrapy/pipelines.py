@@ -1,8 +1,10 @@
 # https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 # https://docs.scrapy.org/en/latest/topics/signals.html#item-signals
+import functools
 import os
 import pkgutil
 import tempfile
+import types
 import warnings
 
 import ijson
@@ -11,11 +13,13 @@ import jsonref
 import orjson
 from flattentool import unflatten
 from flattentool.exceptions import FlattenToolWarning
+from flattentool.schema import SchemaParser
 from scrapy.exceptions import DropItem, NotSupported
 from scrapy.utils.defer import deferred_from_coro
 
+from kingfisher_scrapy.extensions.files_store import FilesStore
 from kingfisher_scrapy.items import File, FileItem, PluckedItem
-from kingfisher_scrapy.util import transcode
+from kingfisher_scrapy.util import BloomFilter, FingerprintSet, ProcessPool, transcode
 
 
 class BasePipeline:
@@ -32,26 +36,60 @@ class BasePipeline:
 
 # https://docs.scrapy.org/en/latest/topics/item-pipeline.html#duplicates-filter
 class Validate:
-    """Drops duplicate files based on ``file_name`` and file items based on ``file_name`` and ``number``."""
+    """
+    Drops duplicate files based on ``file_name`` and file items based on ``file_name`` and ``number``.
+
+    To bound memory use, only 64-bit fingerprints of the keys are stored. If the ``KINGFISHER_VALIDATE_BLOOM_CAPACITY``
+    setting is non-zero, a Bloom filter for that number of keys is used instead, which uses less memory, but which
+    drops about 1 in 1,000,000 non-duplicate items as duplicates.
+
+    If the ``KINGFISHER_RESUME`` and ``FILES_STORE`` settings are set, also drops files and file items that the
+    :class:`~kingfisher_scrapy.extensions.FilesStore` extension stored in a previous run of the crawl.
+    """
+
+    def __init__(self, bloom_capacity=0, stored=None):
+        """
+        :param int bloom_capacity: the capacity of the Bloom filter, or 0 to not use a Bloom filter
+        :param stored: the paths of the files stored by previous runs of the crawl, relative to the crawl directory
+        """
+        if bloom_capacity:
+            self.files = BloomFilter(bloom_capacity)
+            self.file_items = BloomFilter(bloom_capacity)
+        else:
+            self.files = FingerprintSet()
+            self.file_items = FingerprintSet()
+        self.stored = stored
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        stored = None
+        if crawler.settings.getbool("KINGFISHER_RESUME") and (directory := crawler.settings["FILES_STORE"]):
+            # This pipeline only reads the file. The FilesStore extension appends to it.
+            stored = FilesStore.fingerprint_file(directory, crawler.spider, "files")
 
-    def __init__(self):
-        self.files = set()
-        self.file_items = set()
+        return cls(crawler.settings.getint("KINGFISHER_VALIDATE_BLOOM_CAPACITY"), stored)
 
     def process_item(self, item):
         if isinstance(item, FileItem):
             key = (item.file_name, item.number)
-            if key in self.file_items:
+            self._check_stored(item, key)
+            fingerprint_key = f"{item.file_name}\0{item.number}"
+            if fingerprint_key in self.file_items:
                 raise DropItem(f"Duplicate FileItem: {key!r}")
-            self.file_items.add(key)
+            self.file_items.add(fingerprint_key)
         elif isinstance(item, File):
             key = item.file_name
+            self._check_stored(item, key)
             if key in self.files:
                 raise DropItem(f"Duplicate File: {key!r}")
             self.files.add(key)
 
         return item
 
+    def _check_stored(self, item, key):
+        if self.stored and FilesStore.relative_file_path(item) in self.stored:
+            raise DropItem(f"Stored {type(item).__name__}: {key!r}", log_level="DEBUG")
+
 
 class Sample(BasePipeline):
     """Drops items and closes the spider once the sample size is reached."""
@@ -130,9 +168,24 @@ class Pluck(BasePipeline):
 
 
 class Unflatten(BasePipeline):
-    """Converts an item's data from CSV/XLSX to JSON, using the ``unflatten`` command from Flatten Tool."""
+    """
+    Converts an item's data from CSV/XLSX to JSON, using the ``unflatten`` command from Flatten Tool.
 
-    def process_item(self, item):
+    If the ``KINGFISHER_UNFLATTEN_MAX_WORKERS`` setting is non-zero, the conversion runs in a pool of that number of
+    worker processes, which is the number of concurrent conversions, so that it doesn't block the reactor.
+    """
+
+    def __init__(self, crawler):
+        super().__init__(crawler)
+        self.pool = None
+        if max_workers := crawler.settings.getint("KINGFISHER_UNFLATTEN_MAX_WORKERS"):
+            self.pool = ProcessPool(max_workers)
+
+    def close_spider(self):
+        if self.pool:
+            self.pool.close()
+
+    async def process_item(self, item):
         if not self.spider.unflatten or not isinstance(item, File | FileItem):
             return item
 
@@ -155,38 +208,93 @@ class Unflatten(BasePipeline):
             extension = os.path.splitext(input_name)[1]
             raise NotSupported(f"Unsupported extension '{extension}' of {input_name} from {item.url}")
 
-        with tempfile.TemporaryDirectory() as directory:
-            input_path = os.path.join(directory, input_name)
-            output_name = os.path.join(directory, item.file_name)
-            if input_format == "csv":
-                input_name = directory
-            elif input_format == "xlsx":
-                input_name = input_path
-
-            with open(input_path, "wb") as f:
-                f.write(item.data)
-
-            with warnings.catch_warnings():
-                warnings.filterwarnings("ignore", category=FlattenToolWarning)
-
-                unflatten(
-                    input_name,
-                    root_list_path="releases",
-                    root_id="ocid",
-                    schema=jsonref.loads(
-                        pkgutil.get_data("kingfisher_scrapy", f"schema/{self.spider.ocds_version}.json")
-                    ),
-                    input_format=input_format,
-                    output_name=output_name,
-                    **self.spider.unflatten_args,
-                )
-
-            with open(output_name, "rb") as f:
-                item.data = f.read()
+        args = (
+            item.data,
+            input_name,
+            item.file_name,
+            input_format,
+            self.spider.ocds_version,
+            self.spider.unflatten_args,
+        )
+        if self.pool:
+            item.data = await self.pool.apply(_unflatten, *args)
+        else:
+            item.data = _unflatten(*args)
 
         return item
 
 
+def _unflatten(data, input_name, output_name, input_format, ocds_version, unflatten_args):
+    with tempfile.TemporaryDirectory() as directory:
+        input_path = os.path.join(directory, input_name)
+        output_name = os.path.join(directory, output_name)
+        if input_format == "csv":
+            input_name = directory
+        elif input_format == "xlsx":
+            input_name = input_path
+
+        with open(input_path, "wb") as f:
+            f.write(data)
+
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", category=FlattenToolWarning)
+
+            cached_unflatten(
+                input_name,
+                root_list_path="releases",
+                root_id="ocid",
+                schema=dereferenced_schema(ocds_version),
+                input_format=input_format,
+                output_name=output_name,
+                **unflatten_args,
+            )
+
+        with open(output_name, "rb") as f:
+            return f.read()
+
+
+@functools.cache
+def dereferenced_schema(ocds_version):
+    """Return the release schema for the OCDS version, with its ``$ref`` properties resolved, once per process."""
+    return jsonref.loads(pkgutil.get_data("kingfisher_scrapy", f"schema/{ocds_version}.json"))
+
+
+class CachedSchemaParser(SchemaParser):
+    """A Flatten Tool schema parser that parses its schema once, so that it can be reused across conversions."""
+
+    parsed = False
+
+    def parse(self):
+        if not self.parsed:
+            super().parse()
+            self.parsed = True
+
+
+_schema_parsers = {}
+
+
+def _schema_parser(schema_filename=None, **kwargs):
+    # The schema is either a URL (like `metatab_schema`) or a dict returned by `dereferenced_schema()`.
+    schema_key = id(schema_filename) if isinstance(schema_filename, dict) else schema_filename
+    key = (schema_key, repr(sorted(kwargs.items())))
+    if key not in _schema_parsers:
+        _schema_parsers[key] = CachedSchemaParser(schema_filename=schema_filename, **kwargs)
+    return _schema_parsers[key]
+
+
+# Flatten Tool's `unflatten` function, with `_schema_parser` instead of the SchemaParser class in its globals.
+# `unflatten` otherwise reads (and, for URLs, downloads) and parses its schemas on every call. Unlike patching the
+# flattentool module, this doesn't affect other callers of Flatten Tool.
+cached_unflatten = types.FunctionType(
+    unflatten.__code__,
+    {**unflatten.__globals__, "SchemaParser": _schema_parser},
+    unflatten.__name__,
+    unflatten.__defaults__,
+    unflatten.__closure__,
+)
+cached_unflatten.__kwdefaults__ = unflatten.__kwdefaults__
+
+
 def _resolve_pointer(data, pointer):
     try:
         return jsonpointer.resolve_pointer(data, pointer)
@@ -1,5 +1,7 @@
+import os
+
 import orjson
-from scrapy.http import TextResponse
+from scrapy.http import Response, TextResponse
 from scrapy.http.response.text import _NONE
 
 
@@ -9,3 +11,30 @@ class JSONResponse(TextResponse):
         if self._cached_decoded_json is _NONE:
             self._cached_decoded_json = orjson.loads(self.body)
         return self._cached_decoded_json
+
+
+class FileResponse(Response):
+    """
+    A response whose body is stored in a temporary file, instead of in memory. Its ``body`` is empty.
+
+    Download handlers return it only if the spider's ``accepts_file_response`` method returns ``True`` for the request,
+    so that callbacks that read ``response.body`` never receive it.
+
+    The temporary file is deleted once the response is garbage collected. File objects returned by :meth:`open`
+    remain readable after deletion. They share the file's position, so read from only one at a time.
+
+    .. seealso:: :class:`~kingfisher_scrapy.downloadhandlers.SpoolingDownloadHandler`
+    """
+
+    attributes = (*Response.attributes, "file")
+
+    def __init__(self, *args, file, **kwargs):
+        self.file = file
+        super().__init__(*args, **kwargs)
+
+    def open(self):
+        """Return a new file object, to read the body from the start."""
+        # Duplicate the file descriptor, because a temporary file can't be reopened by name on Windows.
+        f = os.fdopen(os.dup(self.file.fileno()), "rb")
+        f.seek(0)
+        return f
@@ -52,6 +52,8 @@ SPIDER_MIDDLEWARES = {
     "kingfisher_scrapy.spidermiddlewares.AddPackageMiddleware": 300,
     "kingfisher_scrapy.spidermiddlewares.ResizePackageMiddleware": 200,
     "kingfisher_scrapy.spidermiddlewares.ReadDataMiddleware": 100,
+    # Active only if `KINGFISHER_RESUME = True`. It must see the items that are sent to the item pipelines.
+    "kingfisher_scrapy.spidermiddlewares.ResumeMiddleware": 10,
     # `process_spider_exception` is invoked in decreasing order.
     # Scrapy's HttpErrorMiddleware is at priority 50. We need to prevent it from logging and ignoring HttpError.
     # https://docs.scrapy.org/en/latest/topics/settings.html#spider-middlewares-base
@@ -74,6 +76,8 @@ DOWNLOADER_MIDDLEWARES = {
 EXTENSIONS = {
     "kingfisher_scrapy.extensions.SentryLogging": -1,
     "kingfisher_scrapy.extensions.Pluck": 1,
+    # Active only if `KINGFISHER_ADAPTIVE_CONCURRENCY_ENABLED = True`.
+    "kingfisher_scrapy.extensions.AdaptiveConcurrency": 10,
     # `FilesStore` must run before `KingfisherProcessAPI2`, because the file needs to be written before the
     # request is sent to Kingfisher Process.
     "kingfisher_scrapy.extensions.FilesStore": 100,
@@ -149,10 +153,30 @@ SENTRY_DSN = os.getenv("SENTRY_DSN")
 # This setting is not the same as the Scrapy setting. (The project previously used FilesPipeline.)
 # Used by FilesStore extension.
 FILES_STORE = os.getenv("FILES_STORE", "data")
+# The number of background threads that write files. 0 (default) writes files on the reactor's thread.
+KINGFISHER_FILES_STORE_WORKERS = 0
+# To compress files with "gzip" or "zstd".
+FILES_STORE_COMPRESSION = os.getenv("FILES_STORE_COMPRESSION")
+# To append files to segment files of about this number of bytes, instead of writing one file per item.
+FILES_STORE_SEGMENT_SIZE = int(os.getenv("FILES_STORE_SEGMENT_SIZE", "0"))
 
 # To store items into a PostgreSQL database.
 # Used by DatabaseStore extension.
 DATABASE_URL = None
+# The number of worker processes that read the crawl directory. 0 (default) reads it in the main process.
+KINGFISHER_DATABASE_STORE_WORKERS = 0
+# Files larger than this number of bytes are streamed by a worker process, instead of read into memory.
+KINGFISHER_DATABASE_STORE_MAX_SIZE = 64 * 1024 * 1024
+# To copy data into the database via a "file" in the crawl directory, or to "stream" it as text or "binary".
+KINGFISHER_DATABASE_STORE_COPY_MODE = "file"
+# To compile releases in this number of shards, partitioned by OCID. 0 compiles all releases at once.
+KINGFISHER_DATABASE_STORE_COMPILE_SHARDS = 0
+# The number of bytes to send to the database at once, when copying data.
+KINGFISHER_DATABASE_STORE_COPY_BLOCK_SIZE = 65536
+# To copy data into an UNLOGGED table, which is changed to LOGGED once the data is copied.
+KINGFISHER_DATABASE_STORE_UNLOGGED = False
+# To build the table's index concurrently, after the data is committed.
+KINGFISHER_DATABASE_STORE_CONCURRENT_INDEX = False
 
 # To send items to Kingfisher Process (version 2).
 # Used by KingfisherProcessAPI2 extension.
@@ -160,6 +184,43 @@ KINGFISHER_API2_URL = os.getenv("KINGFISHER_API2_URL")
 RABBIT_URL = os.getenv("RABBIT_URL")
 RABBIT_EXCHANGE_NAME = os.getenv("RABBIT_EXCHANGE_NAME")
 RABBIT_ROUTING_KEY = os.getenv("RABBIT_ROUTING_KEY")
+# The maximum number of messages awaiting publisher confirms.
+RABBIT_PUBLISH_WINDOW = 1000
+# The number of messages waiting to be published or confirmed, at which to pause the crawl.
+RABBIT_MAX_PENDING = 10000
+
+# To write response bodies larger than this number of bytes to temporary files, instead of holding them in memory.
+# Used by SpoolingDownloadHandler (enabled by CompressedFileSpider and BigFileSpider) and by
+# CurlImpersonateDownloadHandler, if the spider's accepts_file_response method returns True. 0 disables spooling.
+KINGFISHER_DOWNLOAD_SPOOL_SIZE = 0
+
+# To copy nested archives larger than this number of bytes to temporary files, instead of reading them into memory.
+# Used by CompressedFileSpider. 0 disables spooling.
+KINGFISHER_ARCHIVE_SPOOL_SIZE = 0
+
+# To adjust each domain's concurrency according to its 403, 429 and 5xx responses and Retry-After headers.
+# Used by AdaptiveConcurrency.
+KINGFISHER_ADAPTIVE_CONCURRENCY_ENABLED = False
+# The maximum concurrency of each domain.
+KINGFISHER_ADAPTIVE_CONCURRENCY_MAX = 8
+# The number of consecutive successful responses from a domain, after which to increase its concurrency.
+KINGFISHER_ADAPTIVE_CONCURRENCY_INCREASE_AFTER = 20
+
+# To parse JSON in this number of worker processes, instead of in the reactor's process.
+# Used by ConcatenatedJSONMiddleware, RootPathMiddleware and ResizePackageMiddleware. 0 disables the process pool.
+KINGFISHER_PROCESS_POOL_WORKERS = 0
+
+# The number of worker processes in which to convert CSV/XLSX to JSON, which is the number of concurrent conversions.
+# Used by Unflatten pipeline. 0 (default) converts on the reactor's thread.
+KINGFISHER_UNFLATTEN_MAX_WORKERS = 0
+
+# To detect duplicate files with a Bloom filter for this number of files, instead of with a set of fingerprints.
+# Used by Validate pipeline. 0 disables the Bloom filter.
+KINGFISHER_VALIDATE_BLOOM_CAPACITY = 0
+
+# To skip the requests and files that were stored by a previous run of a crawl, with the same `crawl_time`.
+# Used by ResumeMiddleware, Validate pipeline and FilesStore extension.
+KINGFISHER_RESUME = False
 
 # Used by Pluck extension.
 KINGFISHER_PLUCK_PATH = os.getenv("KINGFISHER_PLUCK_PATH", "")
@@ -1,22 +1,38 @@
-import copy
+import contextlib
+import functools
+import io
+import itertools
 import logging
+import os
+import shutil
+import tempfile
+import weakref
+from typing import NamedTuple
 from zipfile import BadZipFile
 
 import ijson
 import orjson
-from scrapy.exceptions import DropItem
+from scrapy import Request, signals
+from scrapy.exceptions import DropItem, NotConfigured
 from scrapy.spidermiddlewares.httperror import HttpError
 from scrapy.utils.asyncio import run_in_thread
 from scrapy.utils.log import logformatter_adapter
+from scrapy.utils.request import fingerprint
 
 from kingfisher_scrapy import util
 from kingfisher_scrapy.exceptions import RetryableError
+from kingfisher_scrapy.extensions.files_store import FilesStore, item_stored
 from kingfisher_scrapy.items import File, FileItem
 
 MAX_GROUP_SIZE = 100
+# The number of bytes of releases or records to hold in memory while splitting a package, before using a temp file.
+SPOOL_MAX_SIZE = 16 * 1024 * 1024  # 16 MiB
 
 logger = logging.getLogger(__name__)
 
+# The process pools that are shared by the spider middlewares of each crawler.
+pools = weakref.WeakKeyDictionary()
+
 
 # Avoid reading the rest of a large file, since the rest of the items will be dropped.
 def sample_filled(spider, number):
@@ -36,18 +52,179 @@ def read_data_from_file_if_any(item):
         item.data = content
 
 
+class FileSlice(NamedTuple):
+    """A file and the offset at which its data starts, to send a file-like object to a worker process."""
+
+    path: str
+    offset: int
+
+
+@contextlib.contextmanager
+def open_data(data):
+    """Open the data, if it is a :class:`FileSlice`. Otherwise, return the data as-is."""
+    if isinstance(data, FileSlice):
+        with open(data.path, "rb") as f:
+            f.seek(data.offset)
+            yield f
+    else:
+        yield data
+
+
+def _copy_to_file(data):
+    with tempfile.NamedTemporaryFile(prefix="kingfisher-", suffix=".json", delete=False) as f:
+        shutil.copyfileobj(data, f)
+    return f.name
+
+
+@contextlib.asynccontextmanager
+async def picklable_data(data):
+    """Return the data as bytes or a :class:`FileSlice`, which can be sent to a worker process."""
+    if not hasattr(data, "read"):
+        yield data
+    elif isinstance(data, io.BufferedReader) and isinstance(data.name, str):
+        yield FileSlice(data.name, data.tell())
+    else:
+        # Archive members can't be reopened by another process, so they are decompressed to a temporary file.
+        path = await run_in_thread(_copy_to_file, data)
+        try:
+            yield FileSlice(path, 0)
+        finally:
+            os.remove(path)
+
+
+def iter_items(data, encoding, prefix, limit, *, multiple_values=False):
+    """Yield at most ``limit`` objects at the prefix. If ``limit`` is ``0`` or ``None``, yield all objects."""
+    with open_data(data) as f:
+        iterable = ijson.items(util.transcode_data(f, encoding), prefix, multiple_values=multiple_values)
+        yield from itertools.islice(iterable, limit or None)
+
+
+def iter_packages(data, encoding, prefix, key, is_package, version, size, limit):
+    """
+    Yield at most ``limit`` packages, each combining ``size`` releases, records or packages at the prefix. If ``limit``
+    is ``0`` or ``None``, yield all packages.
+    """
+    iterable = iter_items(data, encoding, prefix, None)
+    for items in itertools.islice(util.grouper(iterable, size), limit or None):
+        # Omit the None values returned by `grouper(*, fillvalue=None)`.
+        items = filter(None, items)
+
+        if is_package:
+            # Assume that the `extensions` are the same for all packages.
+            package = next(items)
+            try:
+                releases_or_records = package[key]
+            except KeyError as e:
+                logger.warning("%(key)s not set in %(data)r", {"key": e, "data": package})
+            for other in items:
+                try:
+                    releases_or_records.extend(other[key])
+                except KeyError as e:
+                    logger.warning("%(key)s not set in %(data)r", {"key": e, "data": other})
+        else:
+            package = {"version": version, key: list(items)}
+
+        yield package
+
+
+def split_package(data, encoding, key, size, limit, ocid_fallback=None, groups=None):
+    """
+    Return the package metadata, and a file with one group of releases or records per line.
+
+    :param data: bytes, a file-like object or a :class:`FileSlice`
+    :param str encoding: the encoding of the data
+    :param str key: the key of the releases or records array
+    :param int size: the number of releases or records per group
+    :param int limit: the maximum number of releases or records to read
+    :param ocid_fallback: a function that accepts a release or record and returns an ``ocid`` value
+    :param groups: the file to write to, or ``None`` to write to a new temporary file
+    :returns: the package metadata and the file, at its start
+    :rtype: tuple
+    """
+    if groups is None:
+        groups = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)  # noqa: SIM115 # closed by the caller
+
+    package = {}
+    with open_data(data) as f:
+        iterable = util.items_and_package(ijson.parse(util.transcode_data(f, encoding)), key, package, limit=limit)
+        for entries in util.grouper(iterable, size):
+            # Omit the None values returned by `grouper(*, fillvalue=None)`.
+            entries = list(filter(None, entries))
+
+            # Kingfisher Process merges only releases and records with OCIDs.
+            if ocid_fallback:
+                for entry in entries:
+                    if "ocid" not in entry:
+                        entry["ocid"] = ocid_fallback(entry)
+
+            groups.write(orjson.dumps(entries, default=util.default))
+            groups.write(b"\n")
+
+    groups.seek(0)
+    return package, groups
+
+
+def split_package_to_path(*args):
+    """Call :func:`split_package` with a named temporary file, and return the package metadata and the file's path."""
+    with tempfile.NamedTemporaryFile(prefix="kingfisher-", suffix=".jsonl", delete=False) as f:
+        package, _ = split_package(*args, groups=f)
+    return package, f.name
+
+
+def process_pool(crawler):
+    """
+    Return the process pool that is shared by the crawler's spider middlewares, creating it if needed, or ``None`` if
+    the ``KINGFISHER_PROCESS_POOL_WORKERS`` setting is zero. The pool is closed when the spider is closed.
+    """
+    if crawler not in pools:
+        pool = None
+        if max_workers := crawler.settings.getint("KINGFISHER_PROCESS_POOL_WORKERS"):
+            pool = util.ProcessPool(max_workers)
+            crawler.signals.connect(pool.close, signal=signals.spider_closed)
+        pools[crawler] = pool
+    return pools[crawler]
+
+
+def _open_and_remove(path):
+    f = open(path, "rb")  # noqa: SIM115 # closed by the caller
+    # The file is deleted once closed.
+    os.remove(path)
+    return f
+
+
 class BaseSpiderMiddleware:
-    """Base class for spider middlewares that need access to the spider instance."""
+    """
+    Base class for spider middlewares that need access to the spider instance.
+
+    If the ``KINGFISHER_PROCESS_POOL_WORKERS`` setting is non-zero, middlewares that parse JSON do so in a pool of
+    worker processes, so that a crawl can use more than one CPU core. The middlewares share one pool per crawler.
+    """
 
     def __init__(self, crawler):
         self.spider = crawler.spider
         self.logformatter = crawler.logformatter
         self.stats = crawler.stats
+        self.pool = process_pool(crawler)
 
     @classmethod
     def from_crawler(cls, crawler):
         return cls(crawler)
 
+    async def iterate(self, function, data, *args):
+        """
+        Yield the values yielded by the function, in a worker process if there is a process pool.
+
+        :param function: a generator function, whose first argument is bytes, a file-like object or a
+                         :class:`FileSlice`, and whose other arguments are picklable
+        """
+        if self.pool:
+            async with picklable_data(data) as picklable:
+                async for value in self.pool.iterate(function, picklable, *args):
+                    yield value
+        else:
+            for value in function(data, *args):
+                yield value
+
 
 class ConcatenatedJSONMiddleware(BaseSpiderMiddleware):
     """
@@ -62,13 +239,14 @@ class ConcatenatedJSONMiddleware(BaseSpiderMiddleware):
                 yield item
                 continue
 
-            data = item.data
-
             # ijson can read from bytes or a file-like object.
-            for number, obj in enumerate(util.transcode(self.spider, ijson.items, data, "", multiple_values=True), 1):
-                if sample_filled(self.spider, number):
-                    return
+            # ProcessPool passes positional arguments, so bind the keyword argument. A partial object is picklable.
+            function = functools.partial(iter_items, multiple_values=True)
+            iterable = self.iterate(function, item.data, self.spider.encoding, "", self.spider.sample)
 
+            number = 0
+            async for obj in iterable:
+                number += 1
                 yield self.spider.build_file_item(number, obj, item)
 
 
@@ -144,8 +322,6 @@ class RootPathMiddleware(BaseSpiderMiddleware):
             if isinstance(data, dict):
                 data = orjson.dumps(data, default=util.default)
 
-            iterable = util.transcode(self.spider, ijson.items, data, self.spider.root_path)
-
             if "item" in self.spider.root_path.split("."):
                 # Two common issues in OCDS data are:
                 #
@@ -166,35 +342,28 @@ class RootPathMiddleware(BaseSpiderMiddleware):
                     key = "records"
                     item.data_type = "record_package"
 
-                for number, items in enumerate(util.grouper(iterable, group_size(self.spider)), 1):
-                    if sample_filled(self.spider, number):
-                        return
-
-                    # Omit the None values returned by `grouper(*, fillvalue=None)`.
-                    items = filter(None, items)
-
-                    if is_package:
-                        # Assume that the `extensions` are the same for all packages.
-                        package = next(items)
-                        try:
-                            releases_or_records = package[key]
-                        except KeyError as e:
-                            logger.warning("%(key)s not set in %(data)r", {"key": e, "data": package})
-                        for other in items:
-                            try:
-                                releases_or_records.extend(other[key])
-                            except KeyError as e:
-                                logger.warning("%(key)s not set in %(data)r", {"key": e, "data": other})
-                    else:
-                        package = {"version": self.spider.ocds_version, key: list(items)}
-
+                iterable = self.iterate(
+                    iter_packages,
+                    data,
+                    self.spider.encoding,
+                    self.spider.root_path,
+                    key,
+                    is_package,
+                    self.spider.ocds_version,
+                    group_size(self.spider),
+                    self.spider.sample,
+                )
+
+                number = 0
+                async for package in iterable:
+                    number += 1
                     yield self.spider.build_file_item(number, package, item)
             else:
                 # Iterates at most once.
-                for number, obj in enumerate(iterable, 1):
-                    if sample_filled(self.spider, number):
-                        return
-
+                iterable = self.iterate(
+                    iter_items, data, self.spider.encoding, self.spider.root_path, self.spider.sample
+                )
+                async for obj in iterable:
                     item.data = obj
 
                     yield item
@@ -233,67 +402,52 @@ class ResizePackageMiddleware(BaseSpiderMiddleware):
     If the spider's ``resize_package`` class attribute is ``True``, split the package into packages of 100 releases or
     records each. Otherwise, yield the original item.
 
+    The package is parsed once. Since the package metadata can follow the ``releases`` or ``records`` array, the groups
+    of releases or records are serialized to a temporary file until the metadata is complete. The package metadata is
+    then serialized once, and each new package is the concatenation of the two.
+
     Optionally, implement an ``ocid_fallback`` method on the spider, which accepts a release (or record) and returns an
     an ``ocid`` value, to be used if the ``ocid`` field is not set.
     """
 
     async def process_spider_output(self, response, result):
-        """
-        Return a generator of FileItem objects, in which the ``data`` field is a string.
-
-        The spider must yield items whose ``data`` field has ``package`` and ``data`` keys.
-        """
+        """Return a generator of FileItem objects, in which the ``data`` field is bytes."""
         async for item in result:
             if not self.spider.resize_package or not isinstance(item, File):
                 yield item
                 continue
 
-            data = item.data
-
             key = "releases" if item.data_type == "release_package" else "records"
 
-            # Parse JSON in a worker thread so the reactor can dispatch other work (e.g. pika callbacks
-            # for the kingfisher_process_api2 extension) while big files are split.
-            template = await run_in_thread(self._get_package_metadata, data["package"], key, item.data_type)
-            iterable = util.transcode(self.spider, ijson.items, data["data"], f"{key}.item")
-            grouped = util.grouper(iterable, group_size(self.spider))
+            template, groups = await self._split_package(item.data, key)
+            if "package" not in item.data_type:
+                template = {}
 
-            number = 0
-            while True:
-                items = await run_in_thread(next, grouped, None)
-                if items is None:
-                    break
+            # Serialize the package metadata once, and splice each serialized group into it, as the last member.
+            header = orjson.dumps(template, default=util.default)[:-1]
+            if template:
+                header += b","
+            header += b'"%s":' % key.encode()
 
-                number += 1
-                if sample_filled(self.spider, number):
-                    return
+            with groups:
+                for number, line in enumerate(groups, 1):
+                    yield self.spider.build_file_item(number, b"%s%s}" % (header, line.rstrip()), item)
 
-                # Kingfisher Process merges only releases and records with OCIDs.
-                if hasattr(self.spider, "ocid_fallback"):
-                    for entry in items:
-                        if entry and "ocid" not in entry:
-                            entry["ocid"] = self.spider.ocid_fallback(entry)
+    async def _split_package(self, data, key):
+        size = group_size(self.spider)
+        # Avoid building the rest of the releases or records, since the rest of the items will be dropped.
+        limit = self.spider.sample * size if self.spider.sample else None
+        args = (self.spider.encoding, key, size, limit)
 
-                package = copy.deepcopy(template)
-                # Omit the None values returned by `grouper(*, fillvalue=None)`.
-                package[key] = list(filter(None, items))
+        # The spider's `ocid_fallback` method can't be sent to a worker process.
+        if self.pool and not hasattr(self.spider, "ocid_fallback"):
+            async with picklable_data(data) as picklable:
+                package, path = await self.pool.apply(split_package_to_path, picklable, *args)
+            return package, _open_and_remove(path)
 
-                yield self.spider.build_file_item(number, package, item)
-
-    def _get_package_metadata(self, data, skip_key, data_type):
-        """
-        Return the package metadata from a file object.
-
-        :param data: a data object
-        :param str skip_key: the key to skip
-        :returns: the package metadata
-        :rtype: dict
-        """
-        package = {}
-        if "package" in data_type:
-            for item in util.items(util.transcode(self.spider, ijson.parse, data), "", skip_key=skip_key):
-                package.update(item)
-        return package
+        # Parse JSON in a worker thread so the reactor can dispatch other work (e.g. pika callbacks
+        # for the kingfisher_process_api2 extension) while big files are split.
+        return await run_in_thread(split_package, data, *args, getattr(self.spider, "ocid_fallback", None))
 
 
 class ReadDataMiddleware(BaseSpiderMiddleware):
@@ -318,6 +472,106 @@ class ReadDataMiddleware(BaseSpiderMiddleware):
             yield item
 
 
+class ResumeMiddleware(BaseSpiderMiddleware):
+    """
+    If the ``KINGFISHER_RESUME`` and ``FILES_STORE`` settings are set, skip the requests whose responses were stored by
+    a previous run of the crawl, with the same ``crawl_time`` spider argument. Otherwise, do nothing.
+
+    A response is stored if it yielded at least one item and no requests, and if all its items were stored or dropped.
+    Requests whose responses yield requests (like the pages of a paginated API) are never skipped, since these requests
+    are needed to discover the other requests. Their items are dropped by the
+    :class:`~kingfisher_scrapy.pipelines.Validate` pipeline, if already stored.
+
+    .. warning::
+
+       Only use this setting if the URLs of the stored responses always return the same data.
+    """
+
+    def __init__(self, crawler):
+        super().__init__(crawler)
+        self.stored = FilesStore.fingerprint_file(crawler.settings["FILES_STORE"], self.spider, "requests")
+        # The number of items that each response yielded, and the number of those that were stored or dropped.
+        self.yielded = {}
+        self.processed = {}
+
+        crawler.signals.connect(self.item_stored, signal=item_stored)
+        crawler.signals.connect(self.item_dropped, signal=signals.item_dropped)
+        crawler.signals.connect(self.item_error, signal=signals.item_error)
+        crawler.signals.connect(self.close, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("KINGFISHER_RESUME"):
+            raise NotConfigured("KINGFISHER_RESUME is not set.")
+        if not crawler.settings["FILES_STORE"]:
+            raise NotConfigured("FILES_STORE is not set.")
+
+        return cls(crawler)
+
+    def close(self):
+        self.stored.close()
+
+    async def process_start(self, start):
+        async for request in start:
+            if not self._is_stored(request):
+                yield request
+
+    async def process_spider_output(self, response, result):
+        """Return a generator of objects, without the requests whose responses are stored."""
+        yielded_request = False
+        yielded_items = 0
+        self.processed[response] = 0
+
+        try:
+            async for value in result:
+                if isinstance(value, Request):
+                    if self._is_stored(value):
+                        continue
+                    yielded_request = True
+                elif isinstance(value, File | FileItem):
+                    yielded_items += 1
+
+                yield value
+        except BaseException:
+            # The response isn't stored, so that its request is retried the next time the crawl is run.
+            self.processed.pop(response, None)
+            raise
+
+        # An item error also means that the response isn't stored.
+        if yielded_request or not yielded_items or response not in self.processed:
+            self.processed.pop(response, None)
+        else:
+            self.yielded[response] = yielded_items
+            self._check(response)
+
+    def item_stored(self, item, response):
+        self._item_processed(response)
+
+    def item_dropped(self, item, response):
+        self._item_processed(response)
+
+    def item_error(self, item, response):
+        self.processed.pop(response, None)
+        self.yielded.pop(response, None)
+
+    def _item_processed(self, response):
+        if response in self.processed:
+            self.processed[response] += 1
+            self._check(response)
+
+    def _check(self, response):
+        if response in self.yielded and self.processed[response] == self.yielded[response]:
+            del self.processed[response]
+            del self.yielded[response]
+            self.stored.add(fingerprint(response.request).hex())
+
+    def _is_stored(self, request):
+        if fingerprint(request).hex() in self.stored:
+            self.stats.inc_value("resume_skipped_request_count")
+            return True
+        return False
+
+
 class HttpErrorMiddleware(BaseSpiderMiddleware):
     """
     Handle HTTP errors raised by Scrapy's HttpErrorMiddleware.
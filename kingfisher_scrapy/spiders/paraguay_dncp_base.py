@@ -1,11 +1,10 @@
-import datetime
 from abc import abstractmethod
 
 import orjson
 import scrapy
 
 from kingfisher_scrapy.base_spiders import SimpleSpider
-from kingfisher_scrapy.exceptions import AccessTokenError, MissingEnvVarError
+from kingfisher_scrapy.exceptions import MissingEnvVarError
 from kingfisher_scrapy.util import (
     MAX_DOWNLOAD_TIMEOUT,
     components,
@@ -16,7 +15,6 @@ from kingfisher_scrapy.util import (
 
 class ParaguayDNCPBase(SimpleSpider):
     custom_settings = {
-        "CONCURRENT_REQUESTS": 1,
         "DOWNLOADER_MIDDLEWARES": {
             "kingfisher_scrapy.downloadermiddlewares.ParaguayAuthMiddleware": 543,
         },
@@ -29,15 +27,11 @@ class ParaguayDNCPBase(SimpleSpider):
     date_required = True
 
     # ParaguayAuthMiddleware
-    access_token = None
-    access_token_scheduled_at = None
-    # The maximum age is less than the API's limit, since we don't precisely control Scrapy's scheduler.
+    # The maximum age is less than the API's limit, to allow for slow downloads.
     access_token_maximum_age = 13 * 60
-    access_token_request_failed = False
-    requests_backlog = []
+    max_access_token_attempts = 10
 
     # Local
-    max_access_token_attempts = 10
     url_prefix = "https://www.contrataciones.gov.py/datos/api/v3/doc/"
 
     @classmethod
@@ -68,46 +62,25 @@ class ParaguayDNCPBase(SimpleSpider):
             ):
                 yield scrapy.Request(
                     url,
-                    # send duplicate requests when the token expired and in the continuation of requests_backlog saved.
+                    # ParaguayAuthMiddleware retries requests when the token expired.
                     dont_filter=True,
                     callback=self.parse_pages,
                 )
 
-    def build_access_token_request(self, attempt=0):
-        self.logger.info("Requesting access token, attempt %s of %s", attempt + 1, self.max_access_token_attempts)
-
-        self.access_token_scheduled_at = datetime.datetime.now()
-
+    # ParaguayAuthMiddleware
+    def build_access_token_request(self):
         return scrapy.Request(
             f"{self.url_prefix}oauth/token",
             method="POST",
             headers={"Accept": "application/json", "Content-Type": "application/json"},
             body=orjson.dumps({"request_token": self.request_token}),
-            meta={"attempt": attempt + 1, "auth": False, "handle_httpstatus_all": True},
-            callback=self.parse_access_token,
+            meta={"auth": False},
             dont_filter=True,
-            priority=1000,
         )
 
+    # ParaguayAuthMiddleware
     def parse_access_token(self, response):
-        if self.is_http_success(response):
-            token = response.json().get("access_token")
-            if token:
-                self.logger.info("New access token: %s", token)
-                self.access_token = token
-                # continue scraping where it stopped after getting the token
-                while self.requests_backlog:
-                    yield self.requests_backlog.pop(0)
-            else:
-                attempt = response.request.meta["attempt"]
-                if attempt == self.max_access_token_attempts:
-                    self.access_token_request_failed = True
-                    raise AccessTokenError("Max attempts to get an access token reached.")
-                else:
-                    yield self.build_access_token_request(attempt=attempt)
-        else:
-            self.access_token_request_failed = True
-            raise AccessTokenError(f"Authentication failed. Status code: {response.status}")
+        return response.json().get("access_token")
 
     def parse_pages(self, response):
         data = response.json()
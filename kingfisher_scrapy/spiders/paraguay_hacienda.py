@@ -1,10 +1,8 @@
-import datetime
-
 import orjson
 import scrapy
 
 from kingfisher_scrapy.base_spiders import BaseSpider
-from kingfisher_scrapy.exceptions import AccessTokenError, MissingEnvVarError
+from kingfisher_scrapy.exceptions import MissingEnvVarError
 from kingfisher_scrapy.util import components, date_range_by_year
 
 
@@ -30,7 +28,6 @@ class ParaguayHacienda(BaseSpider):
 
     name = "paraguay_hacienda"
     custom_settings = {
-        "CONCURRENT_REQUESTS": 1,
         "DOWNLOADER_MIDDLEWARES": {
             "kingfisher_scrapy.downloadermiddlewares.ParaguayAuthMiddleware": 543,
         },
@@ -44,15 +41,11 @@ class ParaguayHacienda(BaseSpider):
     dont_truncate = True
 
     # ParaguayAuthMiddleware
-    access_token = None
-    access_token_scheduled_at = None
-    # The maximum age is less than the API's limit, since we don't precisely control Scrapy's scheduler.
+    # The maximum age is less than the API's limit, to allow for slow downloads.
     access_token_maximum_age = 14 * 60
-    access_token_request_failed = False
-    requests_backlog = []
+    max_access_token_attempts = 5
 
     # Local
-    max_access_token_attempts = 5
     url_prefix = "https://datos.hacienda.gov.py:443/odmh-api-v1/rest/api/v1/"
     release_ids = []
 
@@ -77,7 +70,7 @@ class ParaguayHacienda(BaseSpider):
             yield scrapy.Request(
                 f"{self.url_prefix}pagos/cdp?page=1&by_anho={year}",
                 meta={"meta": True, "first": True, "year": year},
-                # Send duplicate requests when the token expired and in the continuation of requests_backlog saved.
+                # ParaguayAuthMiddleware retries requests when the token expired.
                 dont_filter=True,
             )
 
@@ -116,41 +109,19 @@ class ParaguayHacienda(BaseSpider):
         else:
             yield self.build_file_from_response(response, data_type="release_package")
 
-    def build_access_token_request(self, body=None, attempt=0):
-        self.logger.info("Requesting access token, attempt %s of %s", attempt + 1, self.max_access_token_attempts)
-
-        if body is None:
-            body = orjson.dumps({"clientSecret": self.client_secret})
-
-        self.access_token_scheduled_at = datetime.datetime.now()
-
+    # ParaguayAuthMiddleware
+    def build_access_token_request(self):
         return scrapy.Request(
             f"{self.url_prefix}auth/token",
             method="POST",
             headers={"Authorization": self.request_token, "Content-Type": "application/json"},
-            body=body,
-            meta={"attempt": attempt + 1, "auth": False, "handle_httpstatus_all": True},
-            callback=self.parse_access_token,
+            body=orjson.dumps({"clientSecret": self.client_secret}),
+            meta={"auth": False},
             dont_filter=True,
-            priority=1000,
         )
 
+    # ParaguayAuthMiddleware
     def parse_access_token(self, response):
-        if self.is_http_success(response):
-            token = response.json().get("accessToken")
-            if token:
-                self.logger.info("New access token: %s", token)
-                self.access_token = f"Bearer {token}"
-                # continue scraping where it stopped after getting the token
-                while self.requests_backlog:
-                    yield self.requests_backlog.pop(0)
-            else:
-                attempt = response.request.meta["attempt"]
-                if attempt == self.max_access_token_attempts:
-                    self.access_token_request_failed = True
-                    raise AccessTokenError("Max attempts to get an access token reached.")
-                else:
-                    yield self.build_access_token_request(response.request.body, attempt=attempt)
-        else:
-            self.access_token_request_failed = True
-            raise AccessTokenError(f"Authentication failed. Status code: {response.status}")
+        if token := response.json().get("accessToken"):
+            return f"Bearer {token}"
+        return None
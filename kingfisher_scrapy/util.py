@@ -1,12 +1,23 @@
 import datetime
+import email.utils
+import gzip
+import hashlib
 import itertools
 import logging
+import math
+import multiprocessing
+import os
+import queue
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 from decimal import Decimal
 from os.path import splitext
 from urllib.parse import parse_qs, quote, urlencode, urljoin, urlsplit
 
 import requests
-from ijson import ObjectBuilder, utils
+import zstandard
+from ijson import ObjectBuilder
+from scrapy.utils.asyncio import run_in_thread
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +25,13 @@ BROWSER_USER_AGENT = (
     "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/78.0.3904.108 Safari/537.36"
 )
 MAX_DOWNLOAD_TIMEOUT = 1800  # 30min
+# The file extensions of the compression formats of the FILES_STORE_COMPRESSION setting.
+COMPRESSION_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+try:
+    UTC = datetime.UTC
+except AttributeError:  # Python 3.10
+    UTC = datetime.timezone.utc  # noqa: UP017
 
 
 def pluck_filename(opts):
@@ -181,39 +199,47 @@ def add_path_components(method, path):
     return wrapper
 
 
-@utils.coroutine
-def items_basecoro(target, prefix, map_type=None, skip_key=None):
+def items_and_package(events, key, package, limit=None):
     """
-    Replicate the same function from ``ijson/common.py``.
-
-    A ``skip_key`` argument is added. If the ``skip_key`` is in the current path, the current event is skipped.
-    Otherwise, the method is identical.
+    Yield the items of the array at the ``key`` of the top-level object, and update the ``package`` dict with the
+    object's other members, in a single pass over the ijson ``events``.
+
+    The other members can occur before or after the array, so the ``package`` dict is complete only once the generator
+    is exhausted. If ``limit`` is set, the items after the first ``limit`` items are skipped (not built).
+
+    >>> import ijson
+    >>> package = {}
+    >>> list(items_and_package(ijson.parse(b'{"uri": "a", "releases": [1, 2], "version": "1"}'), "releases", package))
+    [1, 2]
+    >>> package
+    {'uri': 'a', 'version': '1'}
     """
-    while True:
-        current, event, value = yield
-        if skip_key and skip_key in current:
-            continue
+    prefix = f"{key}.item"
+    nested = f"{key}."
+    events = iter(events)
+    builder = ObjectBuilder()
+    number = 0
+    for current, event, value in events:
         if current == prefix:
+            number += 1
             if event in {"start_map", "start_array"}:
-                builder = ObjectBuilder(map_type=map_type)
+                item_builder = None if limit and number > limit else ObjectBuilder()
                 end_event = event.replace("start", "end")
                 while (current, event) != (prefix, end_event):
-                    builder.event(event, value)
-                    current, event, value = yield
-                del builder.containers[:]
-                target.send(builder.value)
-            else:
-                target.send(value)
-
-
-def items(events, prefix, map_type=None, skip_key=None):
-    """
-    Replicate the same function from ``ijson/common.py``.
+                    if item_builder:
+                        item_builder.event(event, value)
+                    current, event, value = next(events)
+                if item_builder:
+                    yield item_builder.value
+            elif not limit or number <= limit:
+                yield value
+        elif current == key or current.startswith(nested) or (not current and event == "map_key" and value == key):
+            continue
+        else:
+            builder.event(event, value)
 
-    A ``skip_key`` argument is added, which is passed as a keyword argument to
-    :meth:`~kingfisher_scrapy.util.items_basecoro`. Otherwise, the method is identical.
-    """
-    return utils.coros2gen(events, (items_basecoro, (prefix,), {"map_type": map_type, "skip_key": skip_key}))
+    if isinstance(getattr(builder, "value", None), dict):
+        package.update(builder.value)
 
 
 def default(obj):
@@ -234,19 +260,277 @@ class TranscodeFile:
         return transcode_bytes(data, self.encoding)
 
 
+def parse_retry_after(value):
+    """
+    Return the number of seconds to wait, from the value of a ``Retry-After`` header, which is either a number of
+    seconds or an HTTP date. Return ``None`` if the value is missing or invalid.
+
+    >>> parse_retry_after(b"120")
+    120
+    >>> parse_retry_after(b"Wed, 21 Oct 2015 07:28:00 GMT")
+    0
+    >>> parse_retry_after(b"soon") is None
+    True
+    """
+    if not value:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode("latin-1")
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=UTC)
+    return max(0, math.ceil((date - datetime.datetime.now(tz=UTC)).total_seconds()))
+
+
 def transcode_bytes(data, encoding):
     """Re-encodes bytes to UTF-8."""
     return data.decode(encoding).encode()
 
 
 def transcode(spider, function, data, *args, **kwargs):
-    if spider.encoding != "utf-8":
+    return function(transcode_data(data, spider.encoding), *args, **kwargs)
+
+
+def transcode_data(data, encoding):
+    """Re-encodes bytes or a file-like object to UTF-8, if the encoding isn't UTF-8."""
+    if encoding != "utf-8":
         if hasattr(data, "read"):
-            data = TranscodeFile(data, spider.encoding)
-        else:
-            data = transcode_bytes(data, spider.encoding)
+            return TranscodeFile(data, encoding)
+        return transcode_bytes(data, encoding)
+    return data
+
+
+class ProcessPool:
+    """
+    A pool of worker processes, to run CPU-bound functions outside the reactor's process.
 
-    return function(data, *args, **kwargs)
+    The workers start on first use. They are spawned, not forked, because forking a process with running threads is
+    unsafe. The functions and their arguments must be picklable.
+    """
+
+    def __init__(self, max_workers, batch_size=100, max_batches=8):
+        """
+        :param int max_workers: the number of worker processes
+        :param int batch_size: the number of values to send from a worker process at once
+        :param int max_batches: the number of batches to queue, before the worker process waits for the reactor
+        """
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.executor = None
+        self.manager = None
+
+    def start(self):
+        if self.executor is None:
+            context = multiprocessing.get_context("spawn")
+            self.executor = ProcessPoolExecutor(self.max_workers, mp_context=context)
+            self.manager = context.Manager()
+        return self.executor
+
+    async def apply(self, function, *args):
+        """Call the function in a worker process, and return its result."""
+        future = self.start().submit(function, *args)
+        return await run_in_thread(future.result)
+
+    async def iterate(self, function, *args):
+        """Call the generator function in a worker process, and yield its values in order, as batches arrive."""
+        executor = self.start()
+        batches = self.manager.Queue(self.max_batches)
+        stop = self.manager.Event()
+        future = executor.submit(_produce, batches, stop, self.batch_size, function, *args)
+        try:
+            while (batch := await run_in_thread(_consume, batches, future)) is not None:
+                for value in batch:
+                    yield value
+            # Raise any exception from the worker process.
+            await run_in_thread(future.result)
+        finally:
+            # Stop the worker process, if the values are no longer needed (for example, if the sample is filled).
+            stop.set()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.manager.shutdown()
+            self.executor = None
+            self.manager = None
+
+
+def _put(batches, stop, value):
+    while not stop.is_set():
+        try:
+            batches.put(value, timeout=1)
+        except queue.Full:
+            continue
+        return True
+    return False
+
+
+def _produce(batches, stop, batch_size, function, *args):
+    try:
+        iterator = iter(function(*args))
+        while batch := list(itertools.islice(iterator, batch_size)):
+            if not _put(batches, stop, batch):
+                return
+    finally:
+        _put(batches, stop, None)
+
+
+def _consume(batches, future):
+    while True:
+        try:
+            return batches.get(timeout=1)
+        except queue.Empty:
+            if future.done():
+                # Raise any exception from the pool, like BrokenProcessPool.
+                future.result()
+                return None
+
+
+def fingerprint(string):
+    """
+    Return a non-zero 64-bit fingerprint of the string.
+
+    >>> fingerprint("test.json")
+    15197242871741011553
+    """
+    return int.from_bytes(hashlib.blake2b(string.encode(), digest_size=8).digest(), "little") or 1
+
+
+class FingerprintSet:
+    """
+    A set of strings, which stores only their 64-bit fingerprints, in an array with open addressing.
+
+    At most half the slots are used, so each string takes 16 to 32 bytes.
+
+    >>> strings = FingerprintSet()
+    >>> strings.add("test.json")
+    >>> "test.json" in strings, "other.json" in strings, len(strings)
+    (True, False, 1)
+    """
+
+    def __init__(self, capacity=1024):
+        """:param int capacity: the initial number of slots, rounded up to a power of 2"""
+        # Indexes are masked with the number of slots minus 1, which must be a power of 2.
+        capacity = 1 << max(capacity - 1, 0).bit_length()
+        self.slots = array("Q", bytes(8 * capacity))
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, string):
+        return self._find(fingerprint(string))[1]
+
+    def add(self, string):
+        self.add_fingerprint(fingerprint(string))
+
+    def add_fingerprint(self, value):
+        """Add the fingerprint, and return whether it was added."""
+        index, found = self._find(value)
+        if found:
+            return False
+        self.slots[index] = value
+        self.length += 1
+        if self.length * 2 > len(self.slots):
+            self._resize()
+        return True
+
+    def _find(self, value):
+        mask = len(self.slots) - 1
+        index = value & mask
+        # Linear probing. 0 marks an empty slot.
+        while (slot := self.slots[index]) and slot != value:
+            index = (index + 1) & mask
+        return index, bool(slot)
+
+    def _resize(self):
+        values = self.slots
+        self.slots = array("Q", bytes(16 * len(values)))
+        for value in values:
+            if value:
+                self.slots[self._find(value)[0]] = value
+
+
+class FingerprintFile(FingerprintSet):
+    """
+    A :class:`~kingfisher_scrapy.util.FingerprintSet` that is loaded from a file, if it exists, and that appends new
+    fingerprints to the file.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.file = None
+
+        if os.path.exists(path):
+            values = array("Q")
+            with open(path, "rb") as f:
+                data = f.read()
+            # Ignore a partial fingerprint, if the process stopped while writing.
+            values.frombytes(data[: len(data) - len(data) % values.itemsize])
+            for value in values:
+                super().add_fingerprint(value)
+
+    def add_fingerprint(self, value):
+        added = super().add_fingerprint(value)
+        if added:
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.file = open(self.path, "ab")  # noqa: SIM115 # closed in close()
+            self.file.write(array("Q", [value]).tobytes())
+            self.file.flush()
+        return added
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class BloomFilter:
+    """
+    A set of strings, which can return false positives at the given rate, but which uses less memory than
+    :class:`~kingfisher_scrapy.util.FingerprintSet`: for example, 3.6 bytes per string at a rate of 1 in 1,000,000.
+
+    >>> strings = BloomFilter(1000)
+    >>> strings.add("test.json")
+    >>> "test.json" in strings, "other.json" in strings, len(strings)
+    (True, False, 1)
+    """
+
+    def __init__(self, capacity, error_rate=1e-6):
+        """
+        :param int capacity: the number of strings to add, after which the false positive rate is exceeded
+        :param float error_rate: the false positive rate, at capacity
+        """
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray(math.ceil(self.size / 8))
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, string):
+        return all(self.bits[index >> 3] & (1 << (index & 7)) for index in self._indices(string))
+
+    def add(self, string):
+        for index in self._indices(string):
+            self.bits[index >> 3] |= 1 << (index & 7)
+        self.length += 1
+
+    def _indices(self, string):
+        # Double hashing, using the two halves of the fingerprint.
+        value = fingerprint(string)
+        first, second = value & 0xFFFFFFFF, (value >> 32) | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
 
 
 # See `grouper` recipe: https://docs.python.org/3/library/itertools.html#recipes
@@ -255,6 +539,16 @@ def grouper(iterable, n, fillvalue=None):
     return itertools.zip_longest(*args, fillvalue=fillvalue)
 
 
+def open_file(path, mode="rb"):
+    """Open the file, compressing or decompressing it if its extension is ``.gz`` or ``.zst``."""
+    if path.endswith(COMPRESSION_EXTENSIONS["gzip"]):
+        # The default level (9) is much slower than level 6, for little benefit.
+        return gzip.open(path, mode, compresslevel=6)
+    if path.endswith(COMPRESSION_EXTENSIONS["zstd"]):
+        return zstandard.open(path, mode)
+    return open(path, mode)  # closed by the caller
+
+
 def get_file_name_and_extension(filename):
     """
     Given a ``filename``, return its name and extension in two separate strings.
@@ -1,38 +1,45 @@
-import asyncio
 import time
 
-from scrapy import Request
-from scrapy.core.downloader import DownloaderMiddlewareManager
-from scrapy.utils.reactor import install_reactor
+from scrapy import Request, Spider
+from scrapy.crawler import CrawlerProcess
 
-from tests import spider_with_crawler
 
-install_reactor("twisted.internet.asyncioreactor.AsyncioSelectorReactor")
+class DelayedSpider(Spider):
+    name = "delayed"
+    custom_settings = {
+        "CONCURRENT_REQUESTS": 1,
+        "DOWNLOADER_MIDDLEWARES": {
+            "scrapy.downloadermiddlewares.offsite.OffsiteMiddleware": None,
+            "kingfisher_scrapy.downloadermiddlewares.DelayedRequestMiddleware": 543,
+        },
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.start_time = time.time()
+        self.responses = []
+
+    async def start(self):
+        # The delayed request mustn't block the other request, even with one concurrent request.
+        yield Request("data:,delayed", meta={"wait_time": 1})
+        yield Request("data:,immediate")
+
+    def parse(self, response):
+        self.responses.append((response.text, time.time() - self.start_time))
 
 
 # Running this as a pytest test raises "twisted.internet.error.ReactorAlreadyRunning".
 def delayed_request_middleware():
-    async def download_func(request):
-        return request
-
-    spider = spider_with_crawler(
-        settings={
-            "DOWNLOADER_MIDDLEWARES": {
-                "scrapy.downloadermiddlewares.offsite.OffsiteMiddleware": None,
-                "kingfisher_scrapy.downloadermiddlewares.DelayedRequestMiddleware": 543,
-            },
-        }
-    )
-    request = Request("http://example.com", meta={"wait_time": 1})
-    # The request is sent to all the downloader middlewares, including the delayed request middleware.
-    manager = DownloaderMiddlewareManager.from_crawler(spider.crawler)
-
-    start = time.time()
-    result = asyncio.get_event_loop().run_until_complete(manager.download_async(download_func, request))
-    spent = time.time() - start
-
-    assert result == request, result
-    assert 1 <= spent <= 1.5, spent
+    process = CrawlerProcess({"LOG_LEVEL": "WARNING"})
+    crawler = process.create_crawler(DelayedSpider)
+    process.crawl(crawler)
+    process.start()
+
+    responses = crawler.spider.responses
+
+    assert [text for text, _ in responses] == ["immediate", "delayed"], responses
+    assert responses[0][1] < 1, responses
+    assert 1 <= responses[1][1] <= 1.5, responses
 
 
 if __name__ == "__main__":
@@ -1,5 +1,6 @@
 import datetime
 import os
+import tempfile
 
 from scrapy import Request
 from scrapy.crawler import CrawlerRunner
@@ -8,7 +9,7 @@ from scrapy.utils.test import get_reactor_settings
 
 from kingfisher_scrapy.base_spiders import BaseSpider
 from kingfisher_scrapy.log_formatter import LogFormatter
-from kingfisher_scrapy.responses import JSONResponse
+from kingfisher_scrapy.responses import FileResponse, JSONResponse
 
 FILE_LENGTH = 5
 FILE_ITEM_LENGTH = FILE_LENGTH + 1
@@ -26,6 +27,16 @@ def response_fixture(meta=None, url_path="", **kwargs):
     return JSONResponse(request.url, encoding="utf-8", request=request, **kwargs)
 
 
+def file_response_fixture(body, meta=None):
+    if meta is None:
+        meta = {"file_name": "test"}
+    request = Request("http://example.com", meta=meta)
+    file = tempfile.NamedTemporaryFile()  # noqa: SIM115 # deleted with the response
+    file.write(body)
+    file.flush()
+    return FileResponse(request.url, request=request, file=file)
+
+
 def spider_with_crawler(spider_class=BaseSpider, *, settings=None, **kwargs):
     if settings is None:
         settings = {}
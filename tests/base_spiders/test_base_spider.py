@@ -1,3 +1,4 @@
+import codecs
 from unittest.mock import Mock
 
 import pytest
@@ -7,7 +8,7 @@ from scrapy.http import TextResponse
 from kingfisher_scrapy.base_spiders import BaseSpider
 from kingfisher_scrapy.exceptions import MissingEnvVarError, SpiderArgumentError
 from kingfisher_scrapy.items import File
-from tests import spider_with_crawler
+from tests import file_response_fixture, spider_with_crawler
 
 
 @pytest.mark.parametrize(
@@ -40,6 +41,24 @@ def test_is_http_success(status, expected):
     assert spider.is_http_success(response) == expected
 
 
+@pytest.mark.parametrize(
+    ("headers", "expected"),
+    [({}, 30), ({"Retry-After": "120"}, 120), ({"Retry-After": "0"}, 0), ({"Retry-After": "invalid"}, 30)],
+)
+def test_get_retry_wait_time(headers, expected):
+    spider = BaseSpider(name="test")
+
+    response = TextResponse("http://example.com", status=429, headers=headers)
+
+    assert spider.get_retry_wait_time(response) == expected
+
+
+def test_accepts_file_response():
+    spider = BaseSpider(name="test")
+
+    assert not spider.accepts_file_response(scrapy.Request("http://example.com"))
+
+
 def test_build_file_from_response():
     spider = BaseSpider(name="test")
 
@@ -59,6 +78,18 @@ def test_build_file_from_response():
     )
 
 
+@pytest.mark.parametrize("bom", [b"", codecs.BOM_UTF8])
+def test_build_file_from_response_file_response(bom):
+    spider = BaseSpider(name="test")
+
+    response = file_response_fixture(bom + b'{"key": "value"}', meta={"file_name": "file.json"})
+
+    actual = spider.build_file_from_response(response, data_type="release_package")
+
+    assert actual.file_name == "file.json"
+    assert actual.data.read() == b'{"key": "value"}'
+
+
 def test_build_file():
     spider = BaseSpider(name="test")
 
@@ -1,11 +1,12 @@
 import orjson
 import pydantic
 import pytest
+from scrapy import Request
 
 from kingfisher_scrapy.base_spiders import BigFileSpider
 from kingfisher_scrapy.exceptions import IncoherentConfigurationError
 from kingfisher_scrapy.items import File
-from tests import FILE_LENGTH, response_fixture, spider_with_crawler
+from tests import FILE_LENGTH, file_response_fixture, response_fixture, spider_with_crawler
 
 
 @pytest.mark.parametrize("data_type", ["release", "record", None, "other"])
@@ -44,8 +45,51 @@ def test_parse_package(sample, len_items, len_releases, data_type, key):
     assert item.file_name == "test.json"
     assert item.url == pydantic.HttpUrl("http://example.com")
     assert item.data_type == data_type
-    assert item.data["package"] is not None
-    assert item.data["data"] is not None
+    assert item.data == orjson.dumps(package)
 
     with pytest.raises(StopIteration):
         next(generator)
+
+
+def test_parse_file_response():
+    spider = spider_with_crawler(spider_class=BigFileSpider, data_type="release_package")
+
+    response = file_response_fixture(orjson.dumps({"releases": [{"key": "value"}]}), meta={"file_name": "test.json"})
+    generator = spider.parse(response)
+    item = next(generator)
+
+    assert type(item) is File
+    assert item.data.read() == b'{"releases":[{"key":"value"}]}'
+
+    with pytest.raises(StopIteration):
+        next(generator)
+
+
+@pytest.mark.parametrize(
+    ("spool_size", "expected"),
+    [
+        (0, {}),
+        (
+            1,
+            {
+                "http": "kingfisher_scrapy.downloadhandlers.SpoolingDownloadHandler",
+                "https": "kingfisher_scrapy.downloadhandlers.SpoolingDownloadHandler",
+            },
+        ),
+    ],
+)
+def test_update_settings(spool_size, expected):
+    spider_class = type("TestSpider", (BigFileSpider,), {"name": "test", "custom_settings": {}})
+    spider = spider_with_crawler(
+        spider_class, data_type="release_package", settings={"KINGFISHER_DOWNLOAD_SPOOL_SIZE": spool_size}
+    )
+
+    assert spider.crawler.settings.getdict("DOWNLOAD_HANDLERS") == expected
+
+
+def test_accepts_file_response():
+    spider = spider_with_crawler(spider_class=BigFileSpider, data_type="release_package")
+
+    assert spider.accepts_file_response(Request("https://example.com"))
+    assert spider.accepts_file_response(Request("https://example.com", callback=spider.parse))
+    assert not spider.accepts_file_response(Request("https://example.com", callback=spider.parse_date_argument))
@@ -5,11 +5,12 @@ from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
 import orjson
 import pydantic
 import pytest
+from scrapy import Request
 
 from kingfisher_scrapy.base_spiders import CompressedFileSpider
 from kingfisher_scrapy.exceptions import UnknownArchiveFormatError
 from kingfisher_scrapy.items import File
-from tests import FILE_LENGTH, path, response_fixture, spider_with_crawler
+from tests import FILE_LENGTH, file_response_fixture, path, response_fixture, spider_with_crawler
 
 
 @pytest.mark.parametrize("file_name", ["test", "test.json"])
@@ -90,8 +91,7 @@ def test_parse_release_package(sample, len_items, len_releases, file_name):
     assert item.file_name == f"{file_name}-test.json"
     assert item.url == pydantic.HttpUrl("http://example.com")
     assert item.data_type == "release_package"
-    assert item.data["package"] is not None
-    assert item.data["data"] is not None
+    assert item.data.read() == orjson.dumps(package)
 
     with pytest.raises(StopIteration):
         next(generator)
@@ -235,3 +235,91 @@ def test_parse_unknown_format():
 
     with pytest.raises(UnknownArchiveFormatError):
         next(generator)
+
+
+@pytest.mark.parametrize(
+    ("spool_size", "cloudflare_protected", "expected"),
+    [
+        (0, False, {}),
+        (
+            1,
+            False,
+            {
+                "http": "kingfisher_scrapy.downloadhandlers.SpoolingDownloadHandler",
+                "https": "kingfisher_scrapy.downloadhandlers.SpoolingDownloadHandler",
+            },
+        ),
+        (
+            1,
+            True,
+            {
+                "http": "kingfisher_scrapy.downloadhandlers.SpoolingDownloadHandler",
+                "https": "kingfisher_scrapy.downloadhandlers.CurlImpersonateDownloadHandler",
+            },
+        ),
+    ],
+)
+def test_update_settings(spool_size, cloudflare_protected, expected):
+    spider_class = type(
+        "TestSpider",
+        (CompressedFileSpider,),
+        {"name": "test", "cloudflare_protected": cloudflare_protected, "custom_settings": {}},
+    )
+    spider = spider_with_crawler(spider_class, settings={"KINGFISHER_DOWNLOAD_SPOOL_SIZE": spool_size})
+
+    assert spider.crawler.settings.getdict("DOWNLOAD_HANDLERS") == expected
+
+
+def test_accepts_file_response():
+    spider = spider_with_crawler(spider_class=CompressedFileSpider)
+
+    assert spider.accepts_file_response(Request("https://example.com"))
+    assert spider.accepts_file_response(Request("https://example.com", callback=spider.parse))
+    assert not spider.accepts_file_response(Request("https://example.com", callback=spider.parse_date_argument))
+
+
+@pytest.mark.parametrize("spool_size", [0, 1])
+def test_parse_nested_archive_spooled(spool_size):
+    spider = spider_with_crawler(
+        spider_class=CompressedFileSpider, settings={"KINGFISHER_ARCHIVE_SPOOL_SIZE": spool_size}
+    )
+    spider.data_type = "release_package"
+
+    inner = BytesIO()
+    with ZipFile(inner, "w", compression=ZIP_DEFLATED) as zipfile:
+        zipfile.writestr("test.json", '{"releases": []}')
+
+    io = BytesIO()
+    with ZipFile(io, "w", compression=ZIP_DEFLATED) as zipfile:
+        zipfile.writestr("nested.zip", inner.getbuffer())
+
+    response = response_fixture(body=io.getvalue(), meta={"file_name": "test.zip"})
+    generator = spider.parse(response)
+    item = next(generator)
+
+    assert type(item) is File
+    assert item.file_name == "test-nested-test.json"
+    assert item.data.read() == b'{"releases": []}'
+
+    with pytest.raises(StopIteration):
+        next(generator)
+
+
+def test_parse_file_response():
+    spider = spider_with_crawler(spider_class=CompressedFileSpider)
+    spider.data_type = "release_package"
+
+    io = BytesIO()
+    with ZipFile(io, "w", compression=ZIP_DEFLATED) as zipfile:
+        zipfile.writestr("test.json", "{}")
+
+    response = file_response_fixture(io.getvalue(), meta={"file_name": "test.zip"})
+    generator = spider.parse(response)
+    item = next(generator)
+
+    assert type(item) is File
+    assert item.file_name == "test-test.json"
+    assert item.data.read() == b"{}"
+
+    with pytest.raises(StopIteration):
+        next(generator)
@@ -0,0 +1,101 @@
+from unittest.mock import Mock
+
+import pytest
+from scrapy import Request
+from scrapy.core.downloader import Slot
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Response
+
+from kingfisher_scrapy.extensions import AdaptiveConcurrency
+from tests import spider_with_crawler
+
+
+def extension_with_slot(concurrency=2, **settings):
+    spider = spider_with_crawler(settings={"KINGFISHER_ADAPTIVE_CONCURRENCY_ENABLED": True, **settings})
+    slot = Slot(concurrency=concurrency, delay=0.5, randomize_delay=True)
+    spider.crawler.engine = Mock()
+    spider.crawler.engine.downloader.slots = {"example.com": slot}
+    return AdaptiveConcurrency.from_crawler(spider.crawler), slot
+
+
+def respond(extension, status, headers=None, latency=0):
+    request = Request("http://example.com", meta={"download_slot": "example.com", "download_latency": latency})
+    response = Response(request.url, status=status, headers=headers, request=request)
+    extension.response_downloaded(response, request, extension.crawler.spider)
+
+
+def test_from_crawler_disabled():
+    spider = spider_with_crawler()
+
+    with pytest.raises(NotConfigured) as excinfo:
+        AdaptiveConcurrency.from_crawler(spider.crawler)
+
+    assert str(excinfo.value) == "KINGFISHER_ADAPTIVE_CONCURRENCY_ENABLED is not set."
+
+
+def test_increase():
+    extension, slot = extension_with_slot(
+        KINGFISHER_ADAPTIVE_CONCURRENCY_MAX=3, KINGFISHER_ADAPTIVE_CONCURRENCY_INCREASE_AFTER=2
+    )
+
+    for status in (200, 404, 304):
+        respond(extension, status)
+
+    assert slot.concurrency == 3
+
+    for _ in range(4):
+        respond(extension, 200)
+
+    assert slot.concurrency == 3  # maximum
+    assert extension.stats.get_value("adaptive_concurrency/example.com/concurrency") == 3
+
+
+@pytest.mark.parametrize("status", [403, 429, 500, 503])
+def test_decrease(status):
+    extension, slot = extension_with_slot(concurrency=8)
+
+    respond(extension, status)
+
+    assert slot.concurrency == 4
+
+    # A response to a request that was sent before the decrease.
+    respond(extension, status, latency=60)
+
+    assert slot.concurrency == 4
+
+    respond(extension, status)
+    respond(extension, status)
+    respond(extension, status)
+
+    assert slot.concurrency == 1
+    assert extension.stats.get_value("adaptive_concurrency/example.com/concurrency") == 1
+    assert extension.stats.get_value("adaptive_concurrency/example.com/decrease_count") == 4
+
+
+async def test_retry_after():
+    extension, slot = extension_with_slot()
+
+    respond(extension, 429, headers={"Retry-After": "120"})
+
+    assert slot.delay == 120
+    assert not slot.randomize_delay
+    assert extension.stats.get_value("adaptive_concurrency/example.com/retry_after") == 120
+
+    respond(extension, 503, headers={"Retry-After": "60"})
+
+    assert slot.delay == 60
+
+    extension.resume("example.com", slot)
+
+    assert slot.delay == 0.5
+    assert slot.randomize_delay
+    assert extension.paused == {}
+
+
+async def test_spider_closed():
+    extension, _ = extension_with_slot()
+
+    respond(extension, 429, headers={"Retry-After": "120"})
+    extension.spider_closed(extension.crawler.spider)
+
+    assert extension.paused == {}
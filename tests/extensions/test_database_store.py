@@ -1,16 +1,24 @@
 import datetime
+import gzip
 import logging
 import os
+import time
+import warnings
 from unittest.mock import Mock
 
+import orjson
 import psycopg
 import pytest
+from ocdskit.combine import merge
 from ocdskit.exceptions import MergeErrorWarning
 from ocdsmerge.exceptions import DuplicateIdValueWarning
 from psycopg import sql
 from scrapy.exceptions import NotConfigured
 
-from kingfisher_scrapy.extensions import DatabaseStore, FilesStore
+from kingfisher_scrapy.exceptions import InvalidSettingError
+from kingfisher_scrapy.extensions import DatabaseStore, FilesStore, database_store
+from kingfisher_scrapy.extensions.database_store import PhaseTimer, read_items
+from kingfisher_scrapy.items import FileItem
 from tests import spider_with_crawler
 
 DATABASE_URL = os.getenv("KINGFISHER_COLLECT_DATABASE_URL")
@@ -47,6 +55,115 @@ def test_from_crawler_missing_arguments():
     assert str(excinfo.value) == "FILES_STORE is not set."
 
 
+@pytest.mark.parametrize(
+    "settings",
+    [
+        {},
+        {"FILES_STORE_COMPRESSION": "gzip"},
+        {"FILES_STORE_COMPRESSION": "zstd"},
+        {"FILES_STORE_SEGMENT_SIZE": 60},
+    ],
+)
+@pytest.mark.parametrize(("workers", "max_size"), [(0, 0), (2, 0), (2, 30)])
+def test_yield_items_from_directory(settings, workers, max_size, tmpdir):
+    spider = spider_with_crawler(crawl_time="2021-05-25T00:00:00", settings={"FILES_STORE": tmpdir, **settings})
+    files_store_extension = FilesStore.from_crawler(spider.crawler)
+    for number in range(1, 4):
+        item = FileItem(
+            file_name="test.json",
+            url="http://example.com",
+            data_type="release_package",
+            data={"releases": [{"ocid": str(number)}]},
+            number=number,
+        )
+        files_store_extension.item_scraped(item, spider)
+    files_store_extension.spider_closed(spider, "shutdown")
+
+    extension = DatabaseStore("test", tmpdir, workers=workers, max_size=max_size)
+    crawl_directory = os.path.join(tmpdir, FilesStore.relative_crawl_directory(spider))
+
+    assert sorted(item["ocid"] for item in extension.yield_items_from_directory(crawl_directory, "releases.item")) == [
+        "1",
+        "2",
+        "3",
+    ]
+
+
+@pytest.mark.parametrize("max_size", [0, 30, 1000])
+def test_task_groups(max_size, monkeypatch, tmpdir):
+    monkeypatch.setattr(database_store, "TASKS_PER_GROUP", 100)
+    large = set()
+    for i in range(250):
+        path = tmpdir.join(f"{i:03}.json")
+        # Some files are larger than the maximum size.
+        path.write_binary(b'{"releases": [%s]}' % (b" " * 1000 if i % 100 == 0 else b""))
+        if i % 100 == 0:
+            large.add(str(path))
+
+    extension = DatabaseStore("test", tmpdir, workers=2, max_size=max_size)
+    groups = list(extension._task_groups(str(tmpdir), None))  # noqa: SLF001
+    paths = [[path for path, _ in group] for group in groups]
+
+    assert sorted(path for group in paths for path in group) == sorted(str(path) for path in tmpdir.listdir())
+    if max_size == 0:
+        assert sorted(len(group) for group in paths) == [50, 100, 100]
+    elif max_size == 30:
+        # The small files are 16 bytes.
+        assert all(len(group) == 1 for group in paths)
+    else:
+        assert all(len(group) == 1 for group in paths if large & set(group))
+        assert all(len(group) <= 100 for group in paths)
+
+
+def test_yield_items_from_directory_in_parallel(tmpdir):
+    for i in range(500):
+        tmpdir.join(f"{i:03}.json").write_binary(b'{"releases": [{"ocid": "%d"}]}' % i)
+
+    extension = DatabaseStore("test", tmpdir, workers=2)
+    items = extension.yield_items_from_directory(str(tmpdir), "releases.item")
+
+    assert sorted(int(item["ocid"]) for item in items) == list(range(500))
+
+    # Stop reading early.
+    items = extension.yield_items_from_directory(str(tmpdir), "releases.item")
+    next(items)
+    items.close()
+
+
+def test_yield_items_from_directory_in_parallel_error(tmpdir):
+    tmpdir.join("valid.json").write_binary(b'{"releases": [{"ocid": "1"}]}')
+    tmpdir.join("invalid.json").write_binary(b'{"releases": [')
+
+    extension = DatabaseStore("test", tmpdir, workers=2)
+
+    with pytest.raises(orjson.JSONDecodeError):
+        list(extension.yield_items_from_directory(str(tmpdir), "releases.item"))
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_yield_items_from_directory_compressed(workers, tmpdir):
+    spider = spider_with_crawler(
+        crawl_time="2021-05-25T00:00:00", settings={"FILES_STORE": tmpdir, "FILES_STORE_COMPRESSION": "gzip"}
+    )
+    files_store_extension = FilesStore.from_crawler(spider.crawler)
+    item = FileItem(
+        file_name="test.json",
+        url="http://example.com",
+        data_type="release_package",
+        data={"releases": [{"ocid": "1"}] * 1000},
+        number=1,
+    )
+    files_store_extension.item_scraped(item, spider)
+    files_store_extension.spider_closed(spider, "shutdown")
+
+    path = os.path.join(tmpdir, item.path)
+    # The file is smaller than the maximum size on disk, but larger once decompressed.
+    extension = DatabaseStore("test", tmpdir, workers=workers, max_size=os.path.getsize(path) * 2)
+    crawl_directory = os.path.join(tmpdir, FilesStore.relative_crawl_directory(spider))
+
+    assert list(extension.yield_items_from_directory(crawl_directory, "releases.item")) == [{"ocid": "1"}] * 1000
+
+
 @pytest.mark.skipif(SKIP_TEST_IF, reason="KINGFISHER_COLLECT_DATABASE_URL must be set")
 @pytest.mark.parametrize(
     ("from_date", "default_from_date", "messages"),
@@ -351,6 +468,184 @@ def test_spider_closed(cursor, caplog, tmpdir, data, data_type, sample, compile_
     assert [record.message for record in caplog.records] == expected_messages
 
 
+@pytest.mark.skipif(SKIP_TEST_IF, reason="KINGFISHER_COLLECT_DATABASE_URL must be set")
+@pytest.mark.parametrize("copy_mode", ["stream", "binary"])
+def test_spider_closed_copy_mode(cursor, caplog, tmpdir, copy_mode):
+    spider = spider_with_crawler(
+        crawl_time="2021-05-25T00:00:00",
+        settings={
+            "DATABASE_URL": DATABASE_URL,
+            "FILES_STORE": tmpdir,
+            "KINGFISHER_DATABASE_STORE_COPY_MODE": copy_mode,
+        },
+    )
+    spider.data_type = "release_package"
+
+    extension = DatabaseStore.from_crawler(spider.crawler)
+    files_store_extension = FilesStore.from_crawler(spider.crawler)
+    for number in range(1, 3):
+        item = FileItem(
+            file_name="file.json",
+            url="http://example.com",
+            data_type="release_package",
+            data={"releases": [{"ocid": str(number), "date": "2021-05-26T10:00:00Z", "value": 1.5, "text": "\u00e9"}]},
+            number=number,
+        )
+        files_store_extension.item_scraped(item, spider)
+
+    extension.spider_opened(spider)
+
+    caplog.clear()
+    with caplog.at_level(logging.INFO):
+        extension.spider_closed(spider, "finished")
+
+    cursor.execute("SELECT data FROM test ORDER BY data ->> 'ocid'")
+
+    assert cursor.fetchall() == [
+        ({"ocid": "1", "date": "2021-05-26T10:00:00Z", "value": 1.5, "text": "\u00e9"},),
+        ({"ocid": "2", "date": "2021-05-26T10:00:00Z", "value": 1.5, "text": "\u00e9"},),
+    ]
+    assert [record.message for record in caplog.records] == [
+        f"Reading the {tmpdir}/test/20210525_000000 crawl directory with the releases.item prefix",
+        "Streaming the JSON data to the test table",
+        "Replacing the JSON data in the test table (2 rows)",
+    ]
+    assert not os.path.exists(tmpdir.join("test", "20210525_000000", "data.jsonl"))
+
+
+@pytest.mark.skipif(SKIP_TEST_IF, reason="KINGFISHER_COLLECT_DATABASE_URL must be set")
+@pytest.mark.parametrize("copy_mode", ["file", "stream"])
+def test_spider_closed_unlogged_concurrent_index(cursor, tmpdir, copy_mode):
+    spider = spider_with_crawler(
+        crawl_time="2021-05-25T00:00:00",
+        settings={
+            "DATABASE_URL": DATABASE_URL,
+            "FILES_STORE": tmpdir,
+            "KINGFISHER_DATABASE_STORE_COPY_MODE": copy_mode,
+            "KINGFISHER_DATABASE_STORE_COPY_BLOCK_SIZE": 16,
+            "KINGFISHER_DATABASE_STORE_UNLOGGED": True,
+            "KINGFISHER_DATABASE_STORE_CONCURRENT_INDEX": True,
+        },
+    )
+    spider.data_type = "release_package"
+
+    extension = DatabaseStore.from_crawler(spider.crawler)
+    files_store_extension = FilesStore.from_crawler(spider.crawler)
+    item = FileItem(
+        file_name="file.json",
+        url="http://example.com",
+        data_type="release_package",
+        data={"releases": [{"ocid": str(number), "date": "2021-05-26T10:00:00Z"} for number in range(10)]},
+        number=1,
+    )
+    files_store_extension.item_scraped(item, spider)
+
+    extension.spider_opened(spider)
+    extension.spider_closed(spider, "finished")
+
+    cursor.execute("SELECT count(*) FROM test")
+    count = cursor.fetchone()[0]
+    cursor.execute("SELECT relpersistence FROM pg_class WHERE relname = 'test'")
+    persistence = cursor.fetchone()[0]
+    cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'test'")
+    indexes = cursor.fetchall()
+
+    assert count == 10
+    assert persistence == "p"
+    assert indexes == [("idx_test",)]
+
+    stats = spider.crawler.stats.get_stats()
+    phases = {"read", "copy", "index"} | ({"write"} if copy_mode == "file" else set())
+    assert {key for key in stats if key.startswith("database_store_")} == {
+        f"database_store_{phase}_time_seconds" for phase in phases
+    }
+
+
+def test_phase_timer():
+    timer = PhaseTimer()
+
+    def generate():
+        time.sleep(0.02)
+        yield 1
+        time.sleep(0.02)
+        yield 2
+
+    with timer.phase("outer"):
+        for _ in timer.iterate(generate(), "inner"):
+            time.sleep(0.01)
+
+    assert timer.totals["inner"] >= 0.04
+    assert 0.02 <= timer.totals["outer"] < timer.totals["inner"]
+
+
+def test_from_crawler_invalid_copy_mode(tmpdir):
+    spider = spider_with_crawler(
+        crawl_time="2021-05-25T00:00:00",
+        settings={"DATABASE_URL": "test", "FILES_STORE": tmpdir, "KINGFISHER_DATABASE_STORE_COPY_MODE": "invalid"},
+    )
+
+    with pytest.raises(InvalidSettingError) as excinfo:
+        DatabaseStore.from_crawler(spider.crawler)
+
+    assert str(excinfo.value) == "KINGFISHER_DATABASE_STORE_COPY_MODE must be one of file, stream, binary."
+
+
+@pytest.mark.skipif(SKIP_TEST_IF, reason="KINGFISHER_COLLECT_DATABASE_URL must be set")
+@pytest.mark.parametrize("copy_mode", ["file", "stream"])
+def test_spider_closed_upsert(cursor, caplog, tmpdir, copy_mode):
+    releases = [
+        [
+            {"ocid": "a", "id": "1", "date": "2021-05-26T10:00:00Z"},
+            {"ocid": "b", "id": "2", "date": "2021-05-26T10:00:00Z"},
+            {"id": "4"},
+        ],
+        [
+            {"ocid": "a", "id": "1", "date": "2021-05-26T10:00:00Z", "tag": ["update"]},
+            {"ocid": "c", "id": "3"},
+            {"id": "4", "tag": ["update"]},
+        ],
+    ]
+
+    for number, data in enumerate(releases, 1):
+        spider = spider_with_crawler(
+            crawl_time="2021-05-25T00:00:00",
+            upsert="true",
+            settings={
+                "DATABASE_URL": DATABASE_URL,
+                "FILES_STORE": tmpdir,
+                "KINGFISHER_DATABASE_STORE_COPY_MODE": copy_mode,
+            },
+        )
+        spider.data_type = "release_package"
+
+        extension = DatabaseStore.from_crawler(spider.crawler)
+        files_store_extension = FilesStore.from_crawler(spider.crawler)
+        item = FileItem(
+            file_name="file.json",
+            url="http://example.com",
+            data_type="release_package",
+            data={"releases": data},
+            number=number,
+        )
+        files_store_extension.item_scraped(item, spider)
+
+        extension.spider_opened(spider)
+
+        caplog.clear()
+        with caplog.at_level(logging.INFO):
+            extension.spider_closed(spider, "finished")
+
+    cursor.execute("SELECT data FROM test ORDER BY data ->> 'ocid'")
+
+    assert cursor.fetchall() == [
+        ({"ocid": "a", "id": "1", "date": "2021-05-26T10:00:00Z", "tag": ["update"]},),
+        ({"ocid": "b", "id": "2", "date": "2021-05-26T10:00:00Z"},),
+        ({"ocid": "c", "id": "3"},),
+        ({"id": "4", "tag": ["update"]},),
+    ]
+    assert caplog.records[-1].message == "Upserting the JSON data in the test table (3 rows)"
+
+
 @pytest.mark.skipif(SKIP_TEST_IF, reason="KINGFISHER_COLLECT_DATABASE_URL must be set")
 def test_spider_closed_error(caplog, tmpdir):
     spider = spider_with_crawler(
@@ -367,3 +662,69 @@ def test_spider_closed_error(caplog, tmpdir):
         extension.spider_closed(spider, "closed")
 
     assert not caplog.records
+
+
+@pytest.mark.parametrize(
+    ("prefix", "expected"),
+    [
+        ("", [{"releases": [{"ocid": "a"}, {"ocid": "b"}]}]),
+        ("releases.item", [{"ocid": "a"}, {"ocid": "b"}]),
+        ("releases.item.ocid", ["a", "b"]),
+        ("records.item.compiledRelease", []),
+    ],
+)
+def test_read_items(prefix, expected, tmpdir):
+    path = tmpdir.join("file.json")
+    path.write_binary(b'{"releases": [{"ocid": "a"}, {"ocid": "b"}]}')
+
+    assert list(read_items(str(path), None, prefix)) == expected
+
+
+@pytest.mark.parametrize(("file_name", "max_size"), [("file.json", 1), ("file.json.gz", 1000)])
+def test_read_items_stream(file_name, max_size, monkeypatch, tmpdir):
+    # The file is streamed with ijson, instead of read into memory with orjson.
+    monkeypatch.setattr(database_store, "orjson", Mock())
+    path = tmpdir.join(file_name)
+    data = b'{"releases": [{"ocid": "a"}, {"ocid": "b"}]}'
+    path.write_binary(gzip.compress(data) if file_name.endswith(".gz") else data)
+
+    assert list(read_items(str(path), None, "releases.item", max_size)) == [{"ocid": "a"}, {"ocid": "b"}]
+    database_store.orjson.loads.assert_not_called()
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+@pytest.mark.parametrize("prefix", ["", "records.item.releases.item"])
+def test_compile_in_shards(workers, prefix, tmpdir):
+    # Pass a schema, to not retrieve it.
+    kwargs = {
+        "schema": {
+            "properties": {
+                "ocid": {"type": "string"},
+                "id": {"type": "string"},
+                "date": {"type": "string"},
+                "tag": {"type": "array"},
+                "parties": {"type": "array", "items": {"type": "object", "properties": {"id": {"type": "string"}}}},
+            }
+        }
+    }
+    releases = [
+        {"ocid": str(i % 7), "id": str(i), "date": f"2021-01-{i + 1:02d}", "parties": [{"id": str(i)}]}
+        for i in range(20)
+    ]
+    releases.append({"ocid": "x", "id": "x", "date": "2021-01-01", "parties": [{"id": "x"}, {"id": "x"}]})
+    data = [{"version": "1.1", "releases": releases}] if prefix == "" else releases
+
+    extension = DatabaseStore("test", tmpdir, workers=workers, shards=3)
+
+    with pytest.warns(DuplicateIdValueWarning) as records:
+        actual = sorted(extension.compile_in_shards(iter(data), prefix, str(tmpdir), kwargs), key=lambda r: r["ocid"])
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=DuplicateIdValueWarning)
+        expected = sorted(merge(data, convert_exceptions_to_warnings=True, **kwargs), key=lambda r: r["ocid"])
+
+    assert actual == expected
+    assert [str(record.message) for record in records] == [
+        "x: Multiple objects have the `id` value 'x' in the `parties` array"
+    ]
+    assert os.listdir(tmpdir) == []
@@ -1,12 +1,17 @@
+import gzip
 import logging
 import os
 from tempfile import TemporaryDirectory
 from unittest.mock import Mock
 
 import pytest
+import zstandard
 from scrapy.exceptions import NotConfigured
+from twisted.internet.defer import DeferredList
 
+from kingfisher_scrapy.exceptions import InvalidSettingError
 from kingfisher_scrapy.extensions import FilesStore
+from kingfisher_scrapy.extensions.files_store import Segments, item_stored
 from kingfisher_scrapy.items import File, FileItem
 from tests import response_fixture, spider_with_crawler
 
@@ -205,3 +210,122 @@ def test_item_scraped_with_build_file_and_existing_directory():
 
         # No FileExistsError exception.
         extension.item_scraped(item, spider)
+
+
+def test_item_scraped_resume(tmpdir):
+    spider = spider_with_crawler(settings={"FILES_STORE": tmpdir, "KINGFISHER_RESUME": True})
+    extension = FilesStore.from_crawler(spider.crawler)
+    item = FileItem(file_name="file.json", url="http://example.com", data_type="release_package", data=b"{}", number=1)
+
+    extension.item_scraped(item, spider)
+    extension.spider_closed(spider, "finished")
+
+    stored = FilesStore.fingerprint_file(tmpdir, spider, "files")
+
+    assert len(stored) == 1
+    assert os.path.join("3E7", "file-1.json") in stored
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+async def test_item_scraped_workers(workers, tmpdir):
+    spider = spider_with_crawler(settings={"FILES_STORE": tmpdir, "KINGFISHER_FILES_STORE_WORKERS": workers})
+    extension = FilesStore.from_crawler(spider.crawler)
+    stored = []
+
+    def handler(item):
+        stored.append((item.path, os.path.exists(tmpdir.join(item.path))))
+
+    spider.crawler.signals.connect(handler, signal=item_stored)
+
+    items = [
+        FileItem(file_name="file.json", url="http://example.com", data_type="release_package", data={"n": i}, number=i)
+        for i in range(1, 11)
+    ]
+    results = [extension.item_scraped(item, spider) for item in items]
+    if workers:
+        await DeferredList(results, fireOnOneErrback=True)
+    else:
+        assert results == [None] * 10
+    extension.spider_closed(spider, "finished")
+
+    assert sorted(stored) == sorted((item.path, True) for item in items)
+    for item in items:
+        assert tmpdir.join(item.path).read_binary() == b'{"n":%d}' % item.number
+
+
+@pytest.mark.parametrize(("compression", "module"), [("gzip", gzip), ("zstd", zstandard)])
+def test_item_scraped_compression(compression, module, tmpdir):
+    spider = spider_with_crawler(settings={"FILES_STORE": tmpdir, "FILES_STORE_COMPRESSION": compression})
+    extension = FilesStore.from_crawler(spider.crawler)
+    item = File(file_name="file.json", url="http://example.com", data_type="release_package", data=b'{"key": "value"}')
+
+    extension.item_scraped(item, spider)
+
+    suffix = ".gz" if compression == "gzip" else ".zst"
+    assert item.path == os.path.join("test", "20010203_040506", "389", f"file.json{suffix}")
+    with module.open(tmpdir.join(item.path), "rb") as f:
+        assert f.read() == b'{"key": "value"}'
+
+
+def test_from_crawler_invalid_compression(tmpdir):
+    spider = spider_with_crawler(settings={"FILES_STORE": tmpdir, "FILES_STORE_COMPRESSION": "bz2"})
+
+    with pytest.raises(InvalidSettingError) as excinfo:
+        FilesStore.from_crawler(spider.crawler)
+
+    assert str(excinfo.value) == "FILES_STORE_COMPRESSION must be one of gzip, zstd."
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+async def test_item_scraped_segments(workers, tmpdir):
+    spider = spider_with_crawler(
+        settings={"FILES_STORE": tmpdir, "FILES_STORE_SEGMENT_SIZE": 20, "KINGFISHER_FILES_STORE_WORKERS": workers}
+    )
+    extension = FilesStore.from_crawler(spider.crawler)
+    items = [
+        FileItem(file_name="file.json", url="http://example.com", data_type="release", data={"n": n}, number=n)
+        for n in range(1, 5)
+    ]
+
+    results = [extension.item_scraped(item, spider) for item in items]
+    if workers:
+        await DeferredList(results, fireOnOneErrback=True)
+    extension.spider_closed(spider, "shutdown")
+
+    directory = os.path.join("test", "20010203_040506", "segments")
+    assert sorted(item.path for item in items) == [
+        os.path.join(directory, "000001.jsonl:0:7"),
+        os.path.join(directory, "000001.jsonl:8:7"),
+        os.path.join(directory, "000002.jsonl:0:7"),
+        os.path.join(directory, "000002.jsonl:8:7"),
+    ]
+    for item in items:
+        path, offset, length = item.path.rsplit(":", 2)
+        data = tmpdir.join(path).read_binary()
+        assert data[int(offset) : int(offset) + int(length)] == b'{"n":%d}' % item.number
+    assert sorted(
+        data for name in ("000001.index", "000002.index") for data in Segments.read(str(tmpdir.join(directory, name)))
+    ) == [b'{"n":1}', b'{"n":2}', b'{"n":3}', b'{"n":4}']
+
+
+def test_item_scraped_segments_restart(tmpdir):
+    for _ in range(2):
+        spider = spider_with_crawler(settings={"FILES_STORE": tmpdir, "FILES_STORE_SEGMENT_SIZE": 100})
+        extension = FilesStore.from_crawler(spider.crawler)
+        item = File(file_name="file.json", url="http://example.com", data_type="release_package", data=b"{}")
+
+        extension.item_scraped(item, spider)
+        extension.spider_closed(spider, "shutdown")
+
+    assert item.path == os.path.join("test", "20010203_040506", "segments", "000002.jsonl:0:2")
+
+
+def test_from_crawler_compression_and_segments(tmpdir):
+    spider = spider_with_crawler(
+        settings={"FILES_STORE": tmpdir, "FILES_STORE_COMPRESSION": "gzip", "FILES_STORE_SEGMENT_SIZE": 100}
+    )
+
+    with pytest.raises(InvalidSettingError) as excinfo:
+        FilesStore.from_crawler(spider.crawler)
+
+    assert str(excinfo.value) == "FILES_STORE_COMPRESSION and FILES_STORE_SEGMENT_SIZE can't both be set."
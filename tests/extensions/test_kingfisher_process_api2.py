@@ -1,8 +1,9 @@
+import asyncio
 import datetime
 import logging
 import os
 import time
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 from urllib.parse import urlsplit
 
 import orjson
@@ -10,10 +11,12 @@ import pika
 import pytest
 from scrapy.crawler import CrawlerRunner
 from scrapy.exceptions import NotConfigured
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import Deferred, inlineCallbacks
 
 from kingfisher_scrapy.base_spiders import BaseSpider
+from kingfisher_scrapy.exceptions import InvalidSettingError
 from kingfisher_scrapy.extensions import KingfisherProcessAPI2
+from kingfisher_scrapy.extensions.kingfisher_process_api2 import Publisher, publishers, session
 from kingfisher_scrapy.items import File, FileItem, PluckedItem
 from tests import spider_with_crawler
 
@@ -126,6 +129,57 @@ def test_from_crawler_with_database_url():
     assert str(excinfo.value) == "DATABASE_URL is set."
 
 
+@pytest.mark.parametrize(
+    ("setting", "value", "message"),
+    [
+        (
+            "FILES_STORE_SEGMENT_SIZE",
+            1,
+            "FILES_STORE_SEGMENT_SIZE can't be set, as Kingfisher Process can't read segments.",
+        ),
+        (
+            "FILES_STORE_COMPRESSION",
+            "gzip",
+            "FILES_STORE_COMPRESSION can't be set, as Kingfisher Process can't read compressed files.",
+        ),
+    ],
+)
+def test_from_crawler_with_files_store_setting(setting, value, message):
+    spider = spider_with_crawler(settings=SETTINGS | {"RABBIT_URL": "amqp://localhost", setting: value})
+
+    with pytest.raises(InvalidSettingError) as excinfo:
+        KingfisherProcessAPI2.from_crawler(spider.crawler)
+
+    assert str(excinfo.value) == message
+
+
+def test_session():
+    adapter = session().get_adapter(KINGFISHER_API2_URL)
+
+    assert session() is session()
+    assert adapter.max_retries.read == 0  # don't retry requests that the server might have acted on
+    assert adapter.max_retries.connect == 3
+
+
+@pytest.mark.parametrize(
+    ("method", "status_code", "expected"),
+    [
+        ("POST", 502, False),
+        ("POST", 503, True),
+        ("POST", 504, False),
+        ("POST", 500, False),
+        ("GET", 502, True),
+        ("GET", 503, True),
+        ("GET", 504, True),
+        ("GET", 500, False),
+    ],
+)
+def test_session_retry(method, status_code, expected):
+    retry = session().get_adapter(KINGFISHER_API2_URL).max_retries
+
+    assert retry.is_retry(method, status_code) is expected
+
+
 @pytest.mark.skipif(SKIP_TEST_IF, reason="RABBIT_URL must be set")
 @pytest.mark.parametrize("crawl_time", [None, "2020-01-01T00:00:00"])
 @pytest.mark.parametrize(("sample", "is_sample"), [(None, False), ("true", True)])
@@ -183,9 +237,7 @@ def test_spider_opened(
     close_response = Response(status_code=200)
     caplog.set_level(logging.DEBUG)
 
-    with patch.object(
-        KingfisherProcessAPI2, "_post_synchronous", side_effect=[create_response, close_response]
-    ) as mock:
+    with patch.object(KingfisherProcessAPI2, "_post", side_effect=[create_response, close_response]) as mock:
         runner = CrawlerRunner(settings=SETTINGS | {"FILES_STORE": tmpdir})
         yield runner.crawl(
             Spider, job=job, crawl_time=crawl_time, sample=sample, note=note, ocds_version=ocds_version, steps=steps
@@ -237,9 +289,7 @@ def test_spider_closed_error(tmpdir, caplog):
     close_response = Response(status_code=500)  # error
     caplog.set_level(logging.DEBUG)
 
-    with patch.object(
-        KingfisherProcessAPI2, "_post_synchronous", side_effect=[create_response, close_response]
-    ) as mock:
+    with patch.object(KingfisherProcessAPI2, "_post", side_effect=[create_response, close_response]) as mock:
         runner = CrawlerRunner(settings=SETTINGS | {"FILES_STORE": tmpdir})
         yield runner.crawl(Spider)
 
@@ -263,7 +313,7 @@ def test_spider_closed_error(tmpdir, caplog):
 def test_spider_closed_missing_collection_id(tmpdir):
     create_response = Response(status_code=500)  # error
 
-    with patch.object(KingfisherProcessAPI2, "_post_synchronous", side_effect=[create_response]) as mock:
+    with patch.object(KingfisherProcessAPI2, "_post", side_effect=[create_response]) as mock:
         runner = CrawlerRunner(settings=SETTINGS | {"FILES_STORE": tmpdir})
         yield runner.crawl(Spider)
 
@@ -276,7 +326,7 @@ def test_spider_closed_missing_collection_id(tmpdir):
 def test_spider_closed_return(kwargs, tmpdir):
     create_response = Response(status_code=200, content={"collection_id": 1})
 
-    with patch.object(KingfisherProcessAPI2, "_post_synchronous", side_effect=[create_response]) as mock:
+    with patch.object(KingfisherProcessAPI2, "_post", side_effect=[create_response]) as mock:
         runner = CrawlerRunner(settings=SETTINGS | {"FILES_STORE": tmpdir})
         yield runner.crawl(Spider, **kwargs)
 
@@ -319,7 +369,7 @@ def test_item_scraped(directory, filename, item, channel, tmpdir):
     url = f"https://example.com/remote.{time.time()}.json"
     item.url = url
 
-    with patch.object(KingfisherProcessAPI2, "_post_synchronous", side_effect=[create_response, close_response]):
+    with patch.object(KingfisherProcessAPI2, "_post", side_effect=[create_response, close_response]):
         runner = CrawlerRunner(settings=SETTINGS | {"FILES_STORE": tmpdir})
         yield runner.crawl(Spider, crawl_time="2001-02-03T04:05:06", start_urls=[START_URL], item=item)
 
@@ -343,7 +393,7 @@ def test_item_scraped_path(item_file, channel, tmpdir):
 
     with (
         tmpdir.as_cwd(),
-        patch.object(KingfisherProcessAPI2, "_post_synchronous", side_effect=[create_response, close_response]),
+        patch.object(KingfisherProcessAPI2, "_post", side_effect=[create_response, close_response]),
     ):
         runner = CrawlerRunner(settings=SETTINGS | {"FILES_STORE": "subdir"})
         yield runner.crawl(Spider, crawl_time="2001-02-03T04:05:06", start_urls=[START_URL], item=item_file)
@@ -364,7 +414,7 @@ def test_item_scraped_missing_collection_id(item_file, channel, tmpdir):
     create_response = Response(status_code=500)  # error
     close_response = Response(status_code=200)
 
-    with patch.object(KingfisherProcessAPI2, "_post_synchronous", side_effect=[create_response, close_response]):
+    with patch.object(KingfisherProcessAPI2, "_post", side_effect=[create_response, close_response]):
         runner = CrawlerRunner(settings=SETTINGS | {"FILES_STORE": tmpdir})
         yield runner.crawl(Spider, crawl_time="2001-02-03T04:05:06", start_urls=[START_URL], item=item_file)
 
@@ -378,8 +428,168 @@ def test_item_scraped_return(channel, tmpdir):
     close_response = Response(status_code=200)
     item_plucked = PluckedItem(value="123")
 
-    with patch.object(KingfisherProcessAPI2, "_post_synchronous", side_effect=[create_response, close_response]):
+    with patch.object(KingfisherProcessAPI2, "_post", side_effect=[create_response, close_response]):
         runner = CrawlerRunner(settings=SETTINGS | {"FILES_STORE": tmpdir})
         yield runner.crawl(Spider, crawl_time="2001-02-03T04:05:06", start_urls=[START_URL], item=item_plucked)
 
     assert channel.basic_get(RABBIT_QUEUE_NAME, auto_ack=True) == (None, None, None)
+
+
+def publisher(**kwargs):
+    client = Publisher(
+        url="amqp://127.0.0.1", exchange=RABBIT_EXCHANGE_NAME, routing_key_template="{routing_key}", **kwargs
+    )
+    client.connection = Mock(ioloop=asyncio.get_running_loop())
+    client.channel = Mock()
+    client.confirming = True
+    return client
+
+
+async def next_tick():
+    # pytest-twisted runs coroutines with Twisted, which doesn't suspend on a bare `await asyncio.sleep(0)`.
+    await Deferred.fromFuture(asyncio.ensure_future(asyncio.sleep(0)))
+
+
+def confirm(client, method):
+    client.confirm_callback(pika.frame.Method(1, method))
+
+
+async def test_publisher_window():
+    client = publisher(window=2)
+
+    for i in range(5):
+        client.queue_message({"n": i}, RABBIT_ROUTING_KEY)
+    await next_tick()
+
+    assert client.channel.basic_publish.call_count == 2
+    assert client.pending == 5
+
+    confirm(client, pika.spec.Basic.Ack(delivery_tag=2, multiple=True))
+    await next_tick()
+
+    assert client.channel.basic_publish.call_count == 4
+    assert client.pending == 3
+
+    confirm(client, pika.spec.Basic.Nack(delivery_tag=3))
+    await next_tick()
+
+    assert client.channel.basic_publish.call_count == 5
+    assert [orjson.loads(call.kwargs["body"]) for call in client.channel.basic_publish.call_args_list] == [
+        {"n": 0},
+        {"n": 1},
+        {"n": 2},
+        {"n": 3},
+        {"n": 4},
+    ]
+    assert list(client.queue) == [({"n": 2}, RABBIT_ROUTING_KEY)]
+
+
+async def test_publisher_not_confirming():
+    client = publisher()
+    client.confirming = False
+
+    client.queue_message({"n": 1}, RABBIT_ROUTING_KEY)
+    await next_tick()
+
+    assert client.channel.basic_publish.call_count == 0
+
+    client.confirm_selectok_callback(None)
+    await next_tick()
+
+    assert client.channel.basic_publish.call_count == 1
+
+
+async def test_publisher_pause():
+    calls = []
+    client = publisher(max_pending=4)
+    client.subscribe(
+        "a",
+        on_pause=lambda pending: calls.append(("pause", "a", pending)),
+        on_resume=lambda pending: calls.append(("resume", "a", pending)),
+    )
+
+    for i in range(5):
+        client.queue_message({"n": i}, RABBIT_ROUTING_KEY)
+    client.subscribe("b", on_pause=lambda pending: calls.append(("pause", "b", pending)))
+    await next_tick()
+    confirm(client, pika.spec.Basic.Ack(delivery_tag=1))
+    confirm(client, pika.spec.Basic.Ack(delivery_tag=3, multiple=True))
+
+    assert calls == [("pause", "a", 4), ("pause", "b", 5), ("resume", "a", 2)]
+
+
+async def test_publisher_reset():
+    client = publisher(window=2)
+
+    for i in range(3):
+        client.queue_message({"n": i}, RABBIT_ROUTING_KEY)
+    await next_tick()
+    client.reset()
+
+    assert list(client.queue) == [({"n": i}, RABBIT_ROUTING_KEY) for i in range(3)]
+    assert client.unconfirmed == {}
+    assert not client.confirming
+
+
+async def test_publisher_close():
+    client = publisher()
+    client.interrupt = Mock()
+
+    client.queue_message({"n": 1}, RABBIT_ROUTING_KEY)
+    await next_tick()
+    future = client.close()
+
+    assert not future.done()
+
+    confirm(client, pika.spec.Basic.Ack(delivery_tag=1))
+
+    assert future.done()
+    client.interrupt.assert_called_once_with()
+
+
+async def test_publisher_close_not_confirming():
+    client = publisher()
+    client.interrupt = Mock()
+    client.confirming = False
+
+    client.queue_message({"n": 1}, RABBIT_ROUTING_KEY)
+    await next_tick()
+    future = client.close()
+
+    assert not future.done()
+    assert client.channel.basic_publish.call_count == 0
+
+    client.confirm_selectok_callback(None)
+    await next_tick()
+
+    assert client.channel.basic_publish.call_count == 1
+    assert not future.done()
+
+    confirm(client, pika.spec.Basic.Ack(delivery_tag=1))
+
+    assert future.done()
+    client.interrupt.assert_called_once_with()
+
+
+async def test_publisher_shared():
+    with patch.dict(publishers, clear=True), patch.object(Publisher, "start") as start:
+        client = Publisher.shared("amqp://127.0.0.1", RABBIT_EXCHANGE_NAME, custom_ioloop=asyncio.get_running_loop())
+        other = Publisher.shared("amqp://127.0.0.1", RABBIT_EXCHANGE_NAME)
+
+        assert client is other
+        start.assert_called_once_with()
+
+        client.connection = Mock(ioloop=asyncio.get_running_loop())
+        client.interrupt = Mock()
+        client.subscribe("a")
+        client.subscribe("b")
+
+        assert client.unsubscribe("a").done()
+        client.interrupt.assert_not_called()
+
+        assert client.unsubscribe("b").done()
+        client.interrupt.assert_called_once_with()
+
+        # A new client is created once the shared client is closed.
+        assert Publisher.shared("amqp://127.0.0.1", RABBIT_EXCHANGE_NAME) is not client
+        assert start.call_count == 2
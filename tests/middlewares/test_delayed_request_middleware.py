@@ -1,11 +1,72 @@
+from unittest.mock import Mock
+
 import pytest
 from scrapy import Request
+from scrapy.exceptions import DontCloseSpider, IgnoreRequest
 
+from kingfisher_scrapy import downloadermiddlewares
 from kingfisher_scrapy.downloadermiddlewares import DelayedRequestMiddleware
+from tests import spider_with_crawler
+
+
+def middleware_with_engine():
+    spider = spider_with_crawler()
+    spider.crawler.engine = Mock()
+    return DelayedRequestMiddleware.from_crawler(spider.crawler)
 
 
 @pytest.mark.parametrize("meta", [None, {"wait_time": 0}])
 async def test_middleware_output(meta):
-    middleware = DelayedRequestMiddleware()
+    middleware = middleware_with_engine()
     request = Request("http://example.com", meta=meta)
-    await middleware.process_request(request)
+
+    assert middleware.process_request(request) is None
+    assert middleware.queue == []
+    assert middleware.crawler.stats.get_value("delayed_request/count") is None
+
+
+async def test_delayed_request(monkeypatch):
+    monkeypatch.setattr(downloadermiddlewares.time, "monotonic", lambda: 100)
+    middleware = middleware_with_engine()
+    engine = middleware.crawler.engine
+
+    for url, wait_time in (("http://example.com/a", 5), ("http://example.com/b", 1)):
+        with pytest.raises(IgnoreRequest):
+            middleware.process_request(Request(url, meta={"wait_time": wait_time, "retries": 1}))
+
+    assert len(middleware.queue) == 2
+    assert middleware.crawler.stats.get_value("delayed_request/count") == 2
+    assert middleware.timer_due == 101
+    with pytest.raises(DontCloseSpider):
+        middleware.spider_idle()
+
+    monkeypatch.setattr(downloadermiddlewares.time, "monotonic", lambda: 102)
+    middleware.release()
+
+    engine.crawl.assert_called_once()
+    request = engine.crawl.call_args.args[0]
+    assert request.url == "http://example.com/b"
+    assert request.meta == {"retries": 1}
+    assert request.dont_filter
+    assert middleware.timer_due == 105
+
+    monkeypatch.setattr(downloadermiddlewares.time, "monotonic", lambda: 105)
+    middleware.release()
+
+    assert engine.crawl.call_count == 2
+    assert engine.crawl.call_args.args[0].url == "http://example.com/a"
+    assert middleware.queue == []
+    assert middleware.timer is None
+    middleware.spider_idle()  # does not raise
+
+
+async def test_spider_closed():
+    middleware = middleware_with_engine()
+
+    with pytest.raises(IgnoreRequest):
+        middleware.process_request(Request("http://example.com", meta={"wait_time": 300}))
+    middleware.spider_closed(middleware.crawler.spider)
+
+    assert middleware.queue == []
+    assert middleware.timer is None
+    middleware.crawler.engine.crawl.assert_not_called()
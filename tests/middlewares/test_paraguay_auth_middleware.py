@@ -0,0 +1,188 @@
+import asyncio
+import time
+from unittest.mock import AsyncMock, Mock
+
+import pytest
+from scrapy import Request
+from scrapy.exceptions import DownloadTimeoutError, IgnoreRequest
+from scrapy.http import JsonResponse, Response
+from scrapy.utils.defer import deferred_from_coro
+
+from kingfisher_scrapy.base_spiders import BaseSpider
+from kingfisher_scrapy.downloadermiddlewares import ParaguayAuthMiddleware
+from tests import spider_with_crawler
+
+
+class ParaguaySpider(BaseSpider):
+    name = "test"
+
+    # ParaguayAuthMiddleware
+    access_token_maximum_age = 14 * 60
+    max_access_token_attempts = 3
+
+    def build_access_token_request(self):
+        return Request("https://example.com/token", meta={"auth": False})
+
+    def parse_access_token(self, response):
+        return response.json().get("access_token")
+
+
+def middleware_for(*responses):
+    spider = spider_with_crawler(ParaguaySpider)
+    responses = iter(responses)
+
+    async def download_async(request):
+        await asyncio.sleep(0)
+        response = next(responses)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    spider.crawler.engine = Mock(close_spider_async=AsyncMock())
+    spider.crawler.engine.download_async = Mock(side_effect=download_async)
+    return ParaguayAuthMiddleware(spider.crawler)
+
+
+def token_response(token, status=200):
+    return JsonResponse("https://example.com/token", status=status, body=f'{{"access_token": "{token}"}}'.encode())
+
+
+def process_requests(middleware, *requests):
+    async def gather():
+        return await asyncio.gather(*(middleware.process_request(request) for request in requests))
+
+    return deferred_from_coro(gather())
+
+
+async def test_process_request_no_auth():
+    middleware = middleware_for()
+    request = Request("https://example.com", meta={"auth": False})
+
+    await process_requests(middleware, request)
+
+    assert b"Authorization" not in request.headers
+    middleware.crawler.engine.download_async.assert_not_called()
+
+
+async def test_process_request_concurrent():
+    middleware = middleware_for(token_response("a"))
+    requests = [Request(f"https://example.com/{i}") for i in range(3)]
+
+    await process_requests(middleware, *requests)
+
+    assert [request.headers["Authorization"] for request in requests] == [b"a", b"a", b"a"]
+    middleware.crawler.engine.download_async.assert_called_once()
+
+
+async def test_process_request_refresh_ahead():
+    middleware = middleware_for(token_response("a"), token_response("b"))
+    await process_requests(middleware, Request("https://example.com/0"))
+
+    # The token is nearly too old.
+    middleware.access_token_requested_at = time.monotonic() - 14 * 60 + 30
+    request = Request("https://example.com/1")
+    await process_requests(middleware, request)
+
+    assert request.headers["Authorization"] == b"a"
+
+    await deferred_from_coro(asyncio.shield(middleware.refreshing))
+    request = Request("https://example.com/2")
+    await process_requests(middleware, request)
+
+    assert request.headers["Authorization"] == b"b"
+    assert middleware.crawler.engine.download_async.call_count == 2
+
+
+async def test_process_request_expired():
+    middleware = middleware_for(token_response("a"), token_response("b"))
+    await process_requests(middleware, Request("https://example.com/0"))
+
+    middleware.access_token_requested_at = time.monotonic() - 14 * 60
+    request = Request("https://example.com/1")
+    await process_requests(middleware, request)
+
+    assert request.headers["Authorization"] == b"b"
+
+
+@pytest.mark.parametrize(
+    "responses",
+    [
+        [token_response("a", status=500)],
+        [token_response(""), token_response(""), token_response("")],
+        [DownloadTimeoutError(), DownloadTimeoutError(), DownloadTimeoutError()],
+    ],
+)
+async def test_process_request_failed(responses):
+    middleware = middleware_for(*responses)
+
+    with pytest.raises(IgnoreRequest):
+        await process_requests(middleware, Request("https://example.com"))
+
+    assert middleware.failed
+    assert middleware.crawler.engine.download_async.call_count == len(responses)
+    middleware.crawler.engine.close_spider_async.assert_called_once_with(reason="access_token_request_failed")
+
+    with pytest.raises(IgnoreRequest):
+        await process_requests(middleware, Request("https://example.com"))
+
+
+async def test_process_request_download_error():
+    middleware = middleware_for(DownloadTimeoutError(), token_response("a"))
+    request = Request("https://example.com")
+
+    await process_requests(middleware, request)
+
+    assert request.headers["Authorization"] == b"a"
+    assert middleware.crawler.engine.download_async.call_count == 2
+
+
+async def test_process_request_refresh_ahead_error(caplog):
+    middleware = middleware_for(token_response("a"), token_response("b"))
+    await process_requests(middleware, Request("https://example.com/0"))
+    middleware.spider.parse_access_token = Mock(side_effect=ValueError("invalid"))
+
+    # The token is nearly too old.
+    middleware.access_token_requested_at = time.monotonic() - 14 * 60 + 30
+    request = Request("https://example.com/1")
+    await process_requests(middleware, request)
+    await deferred_from_coro(asyncio.wait([middleware.refreshing]))
+
+    assert request.headers["Authorization"] == b"a"
+    assert [record.message for record in caplog.records if record.levelname == "ERROR"] == [
+        "Error while requesting access token"
+    ]
+
+
+@pytest.mark.parametrize(("authorization", "expected"), [("a", None), ("old", "a")])
+async def test_process_response_unauthorized(authorization, expected):
+    middleware = middleware_for(token_response("a"))
+    await process_requests(middleware, Request("https://example.com/0"))
+    request = Request("https://example.com", headers={"Authorization": authorization})
+
+    actual = await deferred_from_coro(middleware.process_response(request, Response(request.url, status=401)))
+
+    assert actual is request
+    assert middleware.access_token == expected
+
+
+@pytest.mark.parametrize(("headers", "wait_time"), [({}, 30), ({"Retry-After": "5"}, 5)])
+async def test_process_response_too_many_requests(headers, wait_time):
+    middleware = middleware_for(token_response("a"))
+    await process_requests(middleware, Request("https://example.com/0"))
+    request = Request("https://example.com", headers={"Authorization": "a"}, meta={"file_name": "test.json"})
+
+    actual = await deferred_from_coro(
+        middleware.process_response(request, Response(request.url, status=429, headers=headers))
+    )
+
+    assert actual.url == request.url
+    assert actual.meta == {"file_name": "test.json", "wait_time": wait_time}
+    assert middleware.access_token == "a"
+
+
+async def test_process_response():
+    middleware = middleware_for()
+    request = Request("https://example.com")
+    response = Response(request.url, status=200)
+
+    assert await deferred_from_coro(middleware.process_response(request, response)) is response
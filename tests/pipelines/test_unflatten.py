@@ -1,17 +1,23 @@
+import json
 from io import BytesIO
+from unittest.mock import patch
 
+import flattentool
 import pytest
 from flattentool.input import BadXLSXZipFile
+from flattentool.schema import SchemaParser
 from openpyxl import Workbook
 from scrapy.exceptions import NotSupported
+from scrapy.utils.defer import deferred_from_coro
 
 from kingfisher_scrapy.items import File
-from kingfisher_scrapy.pipelines import Unflatten
+from kingfisher_scrapy.pipelines import Unflatten, _schema_parsers, _unflatten, dereferenced_schema
 from tests import spider_with_crawler
 
 
-def test_process_item_csv():
-    spider = spider_with_crawler(unflatten=True)
+@pytest.mark.parametrize("max_workers", [0, 1])
+async def test_process_item_csv(max_workers):
+    spider = spider_with_crawler(unflatten=True, settings={"KINGFISHER_UNFLATTEN_MAX_WORKERS": max_workers})
     pipeline = Unflatten(spider.crawler)
     item = File(
         file_name="test.csv",
@@ -20,14 +26,17 @@ def test_process_item_csv():
         data=b"a,b,c\n1,2,3",
     )
 
-    assert pipeline.process_item(item) == item
+    try:
+        assert await deferred_from_coro(pipeline.process_item(item)) == item
+    finally:
+        pipeline.close_spider()
 
 
-def test_process_item_xlsx():
+async def test_process_item_xlsx():
     io = BytesIO()
     Workbook().save(io)
 
-    spider = spider_with_crawler(unflatten=True)
+    spider = spider_with_crawler(unflatten=True, settings={"KINGFISHER_UNFLATTEN_MAX_WORKERS": 1})
     pipeline = Unflatten(spider.crawler)
     item = File(
         file_name="test.xlsx",
@@ -36,11 +45,14 @@ def test_process_item_xlsx():
         data=io.getvalue(),
     )
 
-    assert pipeline.process_item(item) == item
+    try:
+        assert await deferred_from_coro(pipeline.process_item(item)) == item
+    finally:
+        pipeline.close_spider()
 
 
-def test_process_item_extension_error():
-    spider = spider_with_crawler(unflatten=True)
+async def test_process_item_extension_error():
+    spider = spider_with_crawler(unflatten=True, settings={"KINGFISHER_UNFLATTEN_MAX_WORKERS": 1})
     pipeline = Unflatten(spider.crawler)
     item = File(
         file_name="file",
@@ -50,11 +62,11 @@ def test_process_item_extension_error():
     )
 
     with pytest.raises(NotSupported):
-        pipeline.process_item(item)
+        await deferred_from_coro(pipeline.process_item(item))
 
 
-def test_process_item_xlsx_error():
-    spider = spider_with_crawler(unflatten=True)
+async def test_process_item_xlsx_error():
+    spider = spider_with_crawler(unflatten=True, settings={"KINGFISHER_UNFLATTEN_MAX_WORKERS": 1})
     pipeline = Unflatten(spider.crawler)
     item = File(
         file_name="test.xlsx",
@@ -63,5 +75,30 @@ def test_process_item_xlsx_error():
         data=b"not xlsx data",
     )
 
-    with pytest.raises(BadXLSXZipFile):
-        pipeline.process_item(item)
+    try:
+        with pytest.raises(BadXLSXZipFile):
+            await deferred_from_coro(pipeline.process_item(item))
+    finally:
+        pipeline.close_spider()
+
+
+def test_unflatten_schema_cache():
+    data = b"id,ocid,tag,date\n1,ocds-213czf-1,planning,2001-02-03T00:00:00Z"
+    args = (data, "test.csv", "test.json", "csv", "1.1", {})
+
+    dereferenced_schema.cache_clear()
+    _schema_parsers.clear()
+
+    with patch.object(SchemaParser, "parse", autospec=True, side_effect=SchemaParser.parse) as parse:
+        results = [json.loads(_unflatten(*args)) for _ in range(3)]
+
+    # The schema is dereferenced and parsed once.
+    assert dereferenced_schema.cache_info().misses == 1
+    assert parse.call_count == 1
+    assert (
+        results
+        == [{"releases": [{"id": "1", "ocid": "ocds-213czf-1", "tag": ["planning"], "date": "2001-02-03T00:00:00Z"}]}]
+        * 3
+    )
+    # Flatten Tool isn't patched.
+    assert flattentool.SchemaParser is SchemaParser
@@ -1,12 +1,15 @@
 import pytest
 from scrapy.exceptions import DropItem
 
+from kingfisher_scrapy.extensions import FilesStore
 from kingfisher_scrapy.items import File, FileItem
 from kingfisher_scrapy.pipelines import Validate
+from tests import spider_with_crawler
 
 
-def test_process_item_with_file():
-    pipeline = Validate()
+@pytest.mark.parametrize("bloom_capacity", [0, 1000])
+def test_process_item_with_file(bloom_capacity):
+    pipeline = Validate(bloom_capacity)
     item = File(
         file_name="test",
         url="http://test.com",
@@ -21,8 +24,9 @@ def test_process_item_with_file():
     assert pipeline.process_item(item) == item
 
 
-def test_process_item_with_file_item():
-    pipeline = Validate()
+@pytest.mark.parametrize("bloom_capacity", [0, 1000])
+def test_process_item_with_file_item(bloom_capacity):
+    pipeline = Validate(bloom_capacity)
     item = FileItem(
         file_name="test",
         url="http://test.com",
@@ -38,8 +42,9 @@ def test_process_item_with_file_item():
     assert pipeline.process_item(item) == item
 
 
-def test_process_item_with_duplicate_file(caplog):
-    pipeline = Validate()
+@pytest.mark.parametrize("bloom_capacity", [0, 1000])
+def test_process_item_with_duplicate_file(caplog, bloom_capacity):
+    pipeline = Validate(bloom_capacity)
     item = File(
         file_name="test1",
         url="http://example.com",
@@ -62,8 +67,9 @@ def test_process_item_with_duplicate_file(caplog):
     assert str(excinfo.value) == "Duplicate File: 'test1'"
 
 
-def test_process_item_with_duplicate_file_item(caplog):
-    pipeline = Validate()
+@pytest.mark.parametrize("bloom_capacity", [0, 1000])
+def test_process_item_with_duplicate_file_item(caplog, bloom_capacity):
+    pipeline = Validate(bloom_capacity)
     item = FileItem(
         file_name="test1",
         url="http://example.com",
@@ -86,3 +92,38 @@ def test_process_item_with_duplicate_file_item(caplog):
     pipeline.process_item(item2)
 
     assert str(excinfo.value) == "Duplicate FileItem: ('test1', 1)"
+
+
+def test_process_item_many_file_items():
+    pipeline = Validate()
+    item = FileItem(file_name="test", url="http://test.com", data_type="release_package", data=b"{}", number=1)
+
+    for number in range(1, 5001):
+        item.number = number
+        pipeline.process_item(item)
+
+    assert len(pipeline.file_items) == 5000
+
+    for number in range(1, 5001):
+        item.number = number
+        with pytest.raises(DropItem):
+            pipeline.process_item(item)
+
+
+@pytest.mark.parametrize("cls", [File, FileItem])
+def test_process_item_stored(cls, tmpdir):
+    spider = spider_with_crawler(settings={"FILES_STORE": tmpdir, "KINGFISHER_RESUME": True})
+    kwargs = {"number": 1} if cls is FileItem else {}
+    item = cls(file_name="test", url="http://test.com", data_type="release_package", data=b"{}", **kwargs)
+
+    stored = FilesStore.fingerprint_file(tmpdir, spider, "files")
+    stored.add(FilesStore.relative_file_path(item))
+    stored.close()
+
+    pipeline = Validate.from_crawler(spider.crawler)
+
+    with pytest.raises(DropItem) as excinfo:
+        pipeline.process_item(item)
+
+    assert excinfo.value.log_level == "DEBUG"
+    assert str(excinfo.value).startswith(f"Stored {cls.__name__}: ")
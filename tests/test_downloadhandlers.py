@@ -1,37 +1,70 @@
+import inspect
+from unittest.mock import Mock
+
 import pytest
 from curl_cffi.const import CurlIpResolve, CurlOpt
+from curl_cffi.requests import AsyncSession
 from curl_cffi.requests.exceptions import ConnectionError as CurlConnectionError
 from curl_cffi.requests.exceptions import Timeout
 from curl_cffi.requests.headers import Headers
-from scrapy import Request
-from scrapy.exceptions import DownloadFailedError, DownloadTimeoutError
+from scrapy import Request, signals
+from scrapy.core.downloader.handlers.http11 import _ResponseReader, _ScrapyAgent
+from scrapy.exceptions import DownloadCancelledError, DownloadFailedError, DownloadTimeoutError, StopDownload
 from scrapy.http import Response
-from scrapy.settings import Settings
+from scrapy.utils.defer import deferred_from_coro
+from twisted.internet.defer import Deferred
+from twisted.web.resource import Resource
+from twisted.web.server import Site
 
-from kingfisher_scrapy import downloadhandlers
-from kingfisher_scrapy.downloadhandlers import CurlImpersonateDownloadHandler
+from kingfisher_scrapy.base_spiders import BaseSpider, CompressedFileSpider
+from kingfisher_scrapy.downloadhandlers import CurlImpersonateDownloadHandler, SpooledBody, SpoolingDownloadHandler
+from kingfisher_scrapy.responses import FileResponse
+from tests import spider_with_crawler
 
 
 class FakeResponse:
-    def __init__(self, *, status_code=200, headers=None, content=b"", url="https://example.com"):
+    def __init__(self, *, status_code=200, headers=None, content=b"", url="https://example.com", chunk_size=None):
         self.status_code = status_code
         self.headers = Headers(headers or {"Content-Type": "application/zip"})
         self.content = content
         self.url = url
+        self.chunk_size = chunk_size or len(content) or 1
+        self.closed = False
+
+    async def aiter_content(self):
+        for i in range(0, len(self.content), self.chunk_size):
+            yield self.content[i : i + self.chunk_size]
 
+    async def aclose(self):
+        self.closed = True
 
-def handler(**settings):
-    return CurlImpersonateDownloadHandler(Settings(settings))
 
+def handler(spider_class=CompressedFileSpider, **settings):
+    return CurlImpersonateDownloadHandler(spider_with_crawler(spider_class, settings=settings).crawler)
 
-def test_forwards_request(monkeypatch):
+
+def fake_session(monkeypatch, response=None, exception=None):
     captured = {}
 
-    def fake_request(**kwargs):
-        captured.update(kwargs)
-        return FakeResponse(status_code=200, headers={"Content-Type": "application/zip"}, content=b"PK\x03\x04")
+    async def fake_request(self, **kwargs):
+        captured.update(kwargs, session=self)
+        if exception:
+            raise exception
+        return response or FakeResponse(content=b"PK")
+
+    monkeypatch.setattr(AsyncSession, "request", fake_request)
+    return captured
 
-    monkeypatch.setattr(downloadhandlers.requests, "request", fake_request)
+
+def download(handler, request):
+    return deferred_from_coro(handler.download_request(request))
+
+
+async def test_forwards_request(monkeypatch):
+    captured = fake_session(
+        monkeypatch,
+        FakeResponse(status_code=200, headers={"Content-Type": "application/zip"}, content=b"PK\x03\x04"),
+    )
 
     request = Request(
         "https://opentender.eu/data/downloads/data-ie-ocds-json.zip",
@@ -39,15 +72,17 @@ def test_forwards_request(monkeypatch):
         meta={"download_timeout": 42, "proxy": "http://proxy:8080"},
     )
 
-    response = handler(CURL_IMPERSONATE="chrome")._download(request)  # noqa: SLF001
+    response = await download(handler(CURL_IMPERSONATE="chrome"), request)
 
-    assert captured["impersonate"] == "chrome"
+    assert captured["session"].impersonate == "chrome"
     assert captured["allow_redirects"] is False
+    assert captured["discard_cookies"] is True
+    assert captured["stream"] is True
     assert captured["timeout"] == 42
     assert captured["proxies"] == {"http": "http://proxy:8080", "https": "http://proxy:8080"}
     assert captured["headers"]["User-Agent"] == "Mozilla/5.0 Chrome"
     assert captured["headers"]["Cookie"] == "cf_clearance=abc"
-    assert "curl_options" not in captured
+    assert not captured["session"].curl_options
 
     assert isinstance(response, Response)
     assert response.status == 200
@@ -55,16 +90,16 @@ def test_forwards_request(monkeypatch):
     assert response.body == b"PK\x03\x04"
 
 
-def test_drops_content_encoding(monkeypatch):
-    def fake_request(**kwargs):
-        return FakeResponse(
+async def test_drops_content_encoding(monkeypatch):
+    fake_session(
+        monkeypatch,
+        FakeResponse(
             headers={"Content-Type": "text/html", "Content-Encoding": "gzip", "Content-Length": "20"},
             content=b"<!DOCTYPE html>",
-        )
-
-    monkeypatch.setattr(downloadhandlers.requests, "request", fake_request)
+        ),
+    )
 
-    response = handler()._download(Request("https://example.com"))  # noqa: SLF001
+    response = await download(handler(), Request("https://example.com"))
 
     assert b"Content-Encoding" not in response.headers
     assert b"Content-Length" not in response.headers
@@ -72,64 +107,238 @@ def test_drops_content_encoding(monkeypatch):
     assert response.body == b"<!DOCTYPE html>"
 
 
-def test_no_proxy_disables_env_proxy(monkeypatch):
-    captured = {}
-
-    def fake_request(**kwargs):
-        captured.update(kwargs)
-        return FakeResponse(content=b"PK")
-
-    monkeypatch.setattr(downloadhandlers.requests, "request", fake_request)
+async def test_no_proxy_disables_env_proxy(monkeypatch):
+    captured = fake_session(monkeypatch)
 
-    handler()._download(Request("https://example.com"))  # noqa: SLF001
+    await download(handler(), Request("https://example.com"))
 
     assert captured["proxies"] == {"http": "", "https": ""}
 
 
 @pytest.mark.parametrize(("value", "expected"), [("4", CurlIpResolve.V4), ("6", CurlIpResolve.V6)])
-def test_ip_version(monkeypatch, value, expected):
-    captured = {}
+async def test_ip_version(monkeypatch, value, expected):
+    captured = fake_session(monkeypatch)
 
-    def fake_request(**kwargs):
-        captured.update(kwargs)
-        return FakeResponse(content=b"PK")
+    await download(handler(CURL_IP_VERSION=value), Request("https://example.com"))
 
-    monkeypatch.setattr(downloadhandlers.requests, "request", fake_request)
+    assert captured["session"].curl_options == {CurlOpt.IPRESOLVE: expected}
 
-    handler(CURL_IP_VERSION=value)._download(Request("https://example.com"))  # noqa: SLF001
 
-    assert captured["curl_options"] == {CurlOpt.IPRESOLVE: expected}
+async def test_ip_version_invalid(monkeypatch):
+    captured = fake_session(monkeypatch)
 
+    await download(handler(CURL_IP_VERSION="5"), Request("https://example.com"))
 
-def test_ip_version_invalid(monkeypatch):
-    captured = {}
+    assert not captured["session"].curl_options
 
-    def fake_request(**kwargs):
-        captured.update(kwargs)
-        return FakeResponse(content=b"PK")
 
-    monkeypatch.setattr(downloadhandlers.requests, "request", fake_request)
+async def test_sessions(monkeypatch):
+    captured = fake_session(monkeypatch)
+    instance = handler(CURL_IMPERSONATE="chrome", CONCURRENT_REQUESTS_PER_DOMAIN=3)
 
-    handler(CURL_IP_VERSION="5")._download(Request("https://example.com"))  # noqa: SLF001
+    await download(instance, Request("https://example.com/a"))
+    chrome = captured["session"]
+    await download(instance, Request("https://example.com/b"))
 
-    assert "curl_options" not in captured
+    assert captured["session"] is chrome
+    assert chrome.max_clients == 3
 
+    await download(instance, Request("https://example.com/c", meta={"impersonate": "firefox"}))
 
-def test_download_timeout(monkeypatch):
-    def fake_request(**kwargs):
-        raise Timeout("timed out")
+    assert captured["session"] is not chrome
+    assert captured["session"].impersonate == "firefox"
+    assert len(instance.sessions) == 2
 
-    monkeypatch.setattr(downloadhandlers.requests, "request", fake_request)
+    await deferred_from_coro(instance.close())
 
-    with pytest.raises(DownloadTimeoutError):
-        handler()._download(Request("https://example.com"))  # noqa: SLF001
+    assert instance.sessions == {}
+
+
+@pytest.mark.parametrize(("spool_size", "response_class"), [(0, Response), (100, Response), (10, FileResponse)])
+async def test_streams_response(monkeypatch, spool_size, response_class):
+    fake_response = FakeResponse(content=b"0123456789ABCDEF", chunk_size=4)
+    fake_session(monkeypatch, fake_response)
+    instance = handler(KINGFISHER_DOWNLOAD_SPOOL_SIZE=spool_size)
+    chunks = []
+
+    def bytes_received(data, **kwargs):
+        chunks.append(data)
+
+    instance.crawler.signals.connect(bytes_received, signal=signals.bytes_received)
+
+    response = await download(instance, Request("https://example.com"))
+
+    assert chunks == [b"0123", b"4567", b"89AB", b"CDEF"]
+    assert fake_response.closed
+    assert isinstance(response, response_class)
+    if response_class is FileResponse:
+        assert response.body == b""
+        with response.open() as f:
+            assert f.read() == b"0123456789ABCDEF"
+    else:
+        assert response.body == b"0123456789ABCDEF"
+
+
+async def test_streams_response_other_callback(monkeypatch):
+    class ListSpider(CompressedFileSpider):
+        def parse_list(self, response):
+            pass
+
+    fake_session(monkeypatch, FakeResponse(content=b"0123456789ABCDEF", chunk_size=4))
+    instance = handler(ListSpider, KINGFISHER_DOWNLOAD_SPOOL_SIZE=10)
+
+    # Only the parse callback reads a FileResponse.
+    response = await download(instance, Request("https://example.com", callback=instance.crawler.spider.parse_list))
 
+    assert not isinstance(response, FileResponse)
+    assert response.body == b"0123456789ABCDEF"
 
-def test_download_failed(monkeypatch):
-    def fake_request(**kwargs):
-        raise CurlConnectionError("connection reset")
 
-    monkeypatch.setattr(downloadhandlers.requests, "request", fake_request)
+@pytest.mark.parametrize("signal", [signals.headers_received, signals.bytes_received])
+@pytest.mark.parametrize("fail", [False, True])
+async def test_stop_download(monkeypatch, signal, fail):
+    fake_response = FakeResponse(content=b"0123456789ABCDEF", chunk_size=4)
+    fake_session(monkeypatch, fake_response)
+    instance = handler()
+
+    def stop(**kwargs):
+        raise StopDownload(fail=fail)
+
+    instance.crawler.signals.connect(stop, signal=signal)
+
+    if fail:
+        with pytest.raises(StopDownload) as excinfo:
+            await download(instance, Request("https://example.com"))
+        response = excinfo.value.response
+    else:
+        response = await download(instance, Request("https://example.com"))
+
+    assert fake_response.closed
+    assert response.flags == ["download_stopped"]
+    assert response.body == (b"" if signal is signals.headers_received else b"0123")
+
+
+@pytest.mark.parametrize(
+    ("headers", "meta"),
+    [
+        ({"Content-Type": "application/zip", "Content-Length": "16"}, {"download_maxsize": 10}),
+        ({"Content-Type": "application/zip"}, {"download_maxsize": 10}),
+    ],
+)
+async def test_download_maxsize(monkeypatch, headers, meta):
+    fake_response = FakeResponse(headers=headers, content=b"0123456789ABCDEF", chunk_size=4)
+    fake_session(monkeypatch, fake_response)
+
+    with pytest.raises(DownloadCancelledError):
+        await download(handler(), Request("https://example.com", meta=meta))
+
+    assert fake_response.closed
+
+
+async def test_download_timeout(monkeypatch):
+    fake_session(monkeypatch, exception=Timeout("timed out"))
+
+    with pytest.raises(DownloadTimeoutError):
+        await download(handler(), Request("https://example.com"))
+
+
+async def test_download_failed(monkeypatch):
+    fake_session(monkeypatch, exception=CurlConnectionError("connection reset"))
 
     with pytest.raises(DownloadFailedError):
-        handler()._download(Request("https://example.com"))  # noqa: SLF001
+        await download(handler(), Request("https://example.com"))
+
+
+class PackageResource(Resource):
+    isLeaf = True  # noqa: N815 # Twisted API
+
+    def render_GET(self, request):  # noqa: N802 # Twisted API
+        request.setHeader(b"Content-Type", b"application/json")
+        return b'{"releases": []}'
+
+
+@pytest.fixture
+def server():
+    from twisted.internet import reactor  # noqa: PLC0415
+
+    port = reactor.listenTCP(0, Site(PackageResource()), interface="127.0.0.1")
+    yield f"http://127.0.0.1:{port.getHost().port}/"
+    port.stopListening()
+
+
+@pytest.mark.parametrize(("spool_size", "response_class"), [(0, Response), (1000, Response), (10, FileResponse)])
+@pytest.mark.parametrize("spider_class", [CompressedFileSpider, BaseSpider])
+async def test_spooling_download_handler(server, spool_size, response_class, spider_class):
+    spider = spider_with_crawler(spider_class, settings={"KINGFISHER_DOWNLOAD_SPOOL_SIZE": spool_size})
+    handler = SpoolingDownloadHandler(spider.crawler)
+    if spider_class is BaseSpider:
+        response_class = Response
+
+    try:
+        response = await deferred_from_coro(handler.download_request(Request(server)))
+    finally:
+        await deferred_from_coro(handler.close())
+
+    assert response.status == 200
+    assert isinstance(response, response_class)
+    if response_class is FileResponse:
+        assert response.body == b""
+        with response.open() as f:
+            assert f.read() == b'{"releases": []}'
+    else:
+        assert response.body == b'{"releases": []}'
+
+
+# SpoolingDownloadHandler overrides private APIs of Scrapy's HTTP/1.1 download handler. Check they are unchanged.
+def test_spooling_download_handler_private_api():
+    spider = spider_with_crawler(CompressedFileSpider, settings={"KINGFISHER_DOWNLOAD_SPOOL_SIZE": 1})
+    handler = SpoolingDownloadHandler(spider.crawler)
+
+    for name in (
+        "_crawler",
+        "_contextFactory",
+        "_bind_address",
+        "_pool",
+        "_default_maxsize",
+        "_default_warnsize",
+        "_fail_on_dataloss",
+        "_fail_on_dataloss_warned",
+        "_tls_verbose_logging",
+    ):
+        assert hasattr(handler, name), name
+
+    assert set(inspect.signature(_ScrapyAgent).parameters) >= {
+        "contextFactory",
+        "bindAddress",
+        "pool",
+        "maxsize",
+        "warnsize",
+        "fail_on_dataloss",
+        "crawler",
+        "tls_verbose_logging",
+    }
+    assert list(inspect.signature(_ScrapyAgent._cb_bodyready).parameters) == ["self", "txresponse", "request"]  # noqa: SLF001
+    assert list(inspect.signature(_ScrapyAgent._cb_bodydone).parameters) == ["self", "result", "url"]  # noqa: SLF001
+
+    # _ResponseReader writes the body to its _bodybuf attribute.
+    reader = _ResponseReader(Deferred(), Mock(), Request("https://example.com"), 0, 0, True, spider.crawler)  # noqa: FBT003
+    reader.transport = Mock()
+    reader._bodybuf = body = SpooledBody(1)  # noqa: SLF001
+    reader.dataReceived(b"abc")
+    body.file.seek(0)
+
+    assert body.file.read() == b"abc"
+
+
+def test_spooled_body():
+    body = SpooledBody(5)
+    body.write(b"abc")
+
+    assert body.file is None
+    assert body.getvalue() == b"abc"
+
+    body.write(b"def")
+    body.file.seek(0)
+
+    assert body.getvalue() == b""
+    assert body.file.read() == b"abcdef"
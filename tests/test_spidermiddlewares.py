@@ -6,12 +6,13 @@ import orjson
 import pydantic
 import pytest
 import scrapy
+from scrapy.exceptions import NotConfigured
 from scrapy.spidermiddlewares.httperror import HttpError
 from scrapy.spidermiddlewares.httperror import HttpErrorMiddleware as ScrapyHttpErrorMiddleware
 from scrapy.utils.defer import deferred_from_coro
 
 from kingfisher_scrapy import settings
-from kingfisher_scrapy.base_spiders import CompressedFileSpider, SimpleSpider
+from kingfisher_scrapy.base_spiders import BigFileSpider, CompressedFileSpider, SimpleSpider
 from kingfisher_scrapy.exceptions import RetryableError
 from kingfisher_scrapy.items import File, FileItem
 from kingfisher_scrapy.spidermiddlewares import (
@@ -21,11 +22,12 @@ from kingfisher_scrapy.spidermiddlewares import (
     LineDelimitedMiddleware,
     ReadDataMiddleware,
     ResizePackageMiddleware,
+    ResumeMiddleware,
     RetryDataErrorMiddleware,
     RootPathMiddleware,
     ValidateJSONMiddleware,
 )
-from tests import FILE_ITEM_LENGTH, response_fixture, spider_with_crawler
+from tests import FILE_ITEM_LENGTH, file_response_fixture, response_fixture, spider_with_crawler
 
 
 # https://discuss.python.org/t/enhance-builtin-iterables-like-list-range-with-async-methods-like-aiter-anext/21352/11
@@ -295,9 +297,125 @@ async def test_resize_package_middleware(
         assert item.file_name == "archive-test.json"
         assert item.url == pydantic.HttpUrl("http://example.com")
         assert item.number == i
-        assert len(item.data[key]) == len_releases
+        data = orjson.loads(item.data)
+        assert data["publisher"] == {"name": "TIBÚ"}
+        assert len(data[key]) == len_releases
         assert item.data_type == data_type
-        assert all("ocid" in entry if ocid_fallback else "ocid" not in entry for entry in item.data[key])
+        assert all("ocid" in entry if ocid_fallback else "ocid" not in entry for entry in data[key])
+
+
+@pytest.mark.parametrize(
+    "metadata",
+    [{}, {"uri": "http://example.com", "publisher": {"name": "Example"}, "extensions": ["http://example.com"]}],
+)
+@pytest.mark.parametrize("metadata_first", [True, False])
+async def test_resize_package_middleware_metadata(metadata, metadata_first):
+    spider = spider_with_crawler(spider_class=BigFileSpider, data_type="release_package")
+
+    middleware = ResizePackageMiddleware(spider.crawler)
+
+    releases = [{"ocid": str(i), "tag": ["planning"]} for i in range(150)]
+    package = {**metadata, "releases": releases} if metadata_first else {"releases": releases, **metadata}
+
+    response = response_fixture(body=orjson.dumps(package), meta={"file_name": "test.json"})
+    generator = spider.parse(response)
+    item = next(generator)
+
+    generator = middleware.process_spider_output(response, _aiter([item]))
+    transformed_items = await deferred_from_coro(alist(generator))
+
+    assert [orjson.loads(item.data) for item in transformed_items] == [
+        {**metadata, "releases": releases[:100]},
+        {**metadata, "releases": releases[100:]},
+    ]
+    assert transformed_items[0].data.startswith(orjson.dumps(metadata)[:-1])
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+async def test_resize_package_middleware_file_response(workers):
+    spider = spider_with_crawler(
+        spider_class=BigFileSpider, data_type="release_package", settings={"KINGFISHER_PROCESS_POOL_WORKERS": workers}
+    )
+
+    middleware = ResizePackageMiddleware(spider.crawler)
+
+    releases = [{"ocid": str(i)} for i in range(150)]
+
+    # A response body spooled to a temporary file by a download handler.
+    response = file_response_fixture(orjson.dumps({"releases": releases}), meta={"file_name": "test.json"})
+    assert spider.accepts_file_response(response.request)
+    item = next(spider.parse(response))
+    assert hasattr(item.data, "read")
+
+    generator = middleware.process_spider_output(response, _aiter([item]))
+    try:
+        transformed_items = await deferred_from_coro(alist(generator))
+    finally:
+        if middleware.pool:
+            middleware.pool.close()
+
+    assert [orjson.loads(item.data) for item in transformed_items] == [
+        {"releases": releases[:100]},
+        {"releases": releases[100:]},
+    ]
+
+
+@pytest.mark.parametrize(
+    ("middleware_class", "attribute", "data"),
+    [
+        (ConcatenatedJSONMiddleware, "concatenated_json", b"".join(b'{"key": %d}' % i for i in range(250))),
+        (RootPathMiddleware, "root_path", orjson.dumps({"x": [{"ocid": str(i)} for i in range(250)]})),
+        (
+            ResizePackageMiddleware,
+            "resize_package",
+            orjson.dumps({"releases": [{"ocid": str(i)} for i in range(250)]}),
+        ),
+    ],
+)
+@pytest.mark.parametrize("sample", [None, "0", 5])
+async def test_process_pool(middleware_class, attribute, data, sample):
+    results = []
+    for workers in (0, 2):
+        spider = spider_with_crawler(
+            spider_class=CompressedFileSpider, sample=sample, settings={"KINGFISHER_PROCESS_POOL_WORKERS": workers}
+        )
+        spider.data_type = "release"
+        setattr(spider, attribute, "x.item" if attribute == "root_path" else True)
+        if attribute == "resize_package":
+            spider.data_type = "release_package"
+
+        middleware = middleware_class(spider.crawler)
+
+        io = BytesIO()
+        with ZipFile(io, "w", compression=ZIP_DEFLATED) as zipfile:
+            zipfile.writestr("test.json", data)
+
+        response = response_fixture(body=io.getvalue(), meta={"file_name": "archive.zip"})
+        item = next(spider.parse(response))
+
+        generator = middleware.process_spider_output(response, _aiter([item]))
+        try:
+            results.append([item.model_dump() for item in await deferred_from_coro(alist(generator))])
+        finally:
+            if middleware.pool:
+                middleware.pool.close()
+
+    assert results[0] == results[1]
+    assert len(results[1]) == (int(sample or 0) or (250 if attribute == "concatenated_json" else 3))
+
+
+def test_process_pool_shared():
+    spider = spider_with_crawler(settings={"KINGFISHER_PROCESS_POOL_WORKERS": 2})
+
+    pool = RootPathMiddleware(spider.crawler).pool
+
+    assert pool is not None
+    assert ConcatenatedJSONMiddleware(spider.crawler).pool is pool
+    assert (
+        RootPathMiddleware(spider_with_crawler(settings={"KINGFISHER_PROCESS_POOL_WORKERS": 2}).crawler).pool
+        is not pool
+    )
+    assert RootPathMiddleware(spider_with_crawler().crawler).pool is None
 
 
 @pytest.mark.parametrize(
@@ -422,6 +540,50 @@ async def test_json_streaming_middleware_with_compressed_file_spider(middleware_
         }
 
 
+@pytest.mark.parametrize(
+    ("yield_request", "signal", "expected"),
+    [
+        (False, "item_stored", True),
+        (False, "item_dropped", True),
+        (False, "item_error", False),
+        (True, "item_stored", False),
+    ],
+)
+async def test_resume_middleware(yield_request, signal, expected, tmpdir):
+    settings = {"FILES_STORE": tmpdir, "KINGFISHER_RESUME": True}
+    spider = spider_with_crawler(spider_class=SimpleSpider, settings=settings)
+    spider.data_type = "release_package"
+    middleware = ResumeMiddleware.from_crawler(spider.crawler)
+
+    response = response_fixture(body=b"{}", meta={"file_name": "test.json"})
+    item = next(spider.parse(response))
+    other = scrapy.Request("http://example.com/other", meta={"file_name": "other.json"})
+
+    transformed_items = await alist(
+        middleware.process_spider_output(response, _aiter([item, other] if yield_request else [item]))
+    )
+    getattr(middleware, signal)(item, response)
+    middleware.close()
+
+    assert transformed_items == ([item, other] if yield_request else [item])
+
+    # Restart the crawl.
+    spider = spider_with_crawler(spider_class=SimpleSpider, settings=settings)
+    middleware = ResumeMiddleware.from_crawler(spider.crawler)
+
+    requests = await alist(middleware.process_start(_aiter([response.request, other])))
+
+    assert requests == ([other] if expected else [response.request, other])
+    assert spider.crawler.stats.get_value("resume_skipped_request_count") == (1 if expected else None)
+
+
+def test_resume_middleware_not_configured():
+    spider = spider_with_crawler(settings={"FILES_STORE": "test"})
+
+    with pytest.raises(NotConfigured):
+        ResumeMiddleware.from_crawler(spider.crawler)
+
+
 async def test_read_data_middleware():
     spider = spider_with_crawler(spider_class=CompressedFileSpider)
     spider.data_type = "release_package"
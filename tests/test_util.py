@@ -3,6 +3,7 @@ from datetime import datetime
 import pytest
 
 from kingfisher_scrapy.util import (
+    FingerprintSet,
     components,
     date_range_by_interval,
     get_parameter_value,
@@ -71,3 +72,17 @@ def test_date_range_by_interval_edge_case():
         (datetime(2001, 1, 2, 0, 0), datetime(2001, 1, 3, 0, 0)),
         (datetime(2001, 1, 1, 0, 0), datetime(2001, 1, 2, 0, 0)),
     ]
+
+
+@pytest.mark.parametrize(("capacity", "expected"), [(0, 1), (1, 1), (2, 2), (3, 4), (1000, 1024), (1024, 1024)])
+def test_fingerprint_set_capacity(capacity, expected):
+    strings = FingerprintSet(capacity)
+
+    assert len(strings.slots) == expected
+
+    for i in range(100):
+        strings.add(str(i))
+
+    assert len(strings) == 100
+    assert all(str(i) in strings for i in range(100))
+    assert "100" not in strings